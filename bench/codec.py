@@ -0,0 +1,109 @@
+"""
+Message codec microbenchmark: parse + encode of typical frames, compare with the previous implementation.
+Implementations are measured in turns, the median of rounds is reported, as timings of shared machines drift.
+'server' is the parser configuration of the server (payloads are left as received).
+
+Usage (from project root):
+    PYTHONPATH=. python -m bench.codec [--number N] [--rounds N] [--payload-size BYTES]
+"""
+import statistics
+import timeit
+from optparse import OptionParser
+
+from protocol.data_utils import DataParser
+from protocol.messages import NormalMessage, PayloadMessage, ErrorMessage, ServiceMessage, Message, \
+    NORMAL_CMDS, PAYLOAD_CMDS, ERROR_CMDS, SERVICE_CMDS, PROTOCOL_V1, PROTOCOL_V2, \
+    CMD_LOGIN, CMD_FRIENDS, CMD_MSG_ACK, CMD_MESSAGE, CMD_CHAT_MESSAGE, CMD_CHANGE_STATUS
+
+
+def legacy_parse(data, version):
+    """
+    Previous DataParser.parse: the whole frame is decoded and stripped, command is looked up in lists
+    """
+    if version == PROTOCOL_V1:
+        data = str(data, 'utf-8').strip()
+        assert Message.TERM_SEQUENCE_STR not in data
+    else:
+        data = str(data, 'utf-8').lstrip()
+    cmd = data[:3]
+    if cmd in NORMAL_CMDS:
+        return NormalMessage.from_string(data.rstrip())
+    elif cmd in PAYLOAD_CMDS:
+        return PayloadMessage.from_string(data, version)
+    elif cmd in ERROR_CMDS:
+        return ErrorMessage.from_string(data)
+    elif cmd in SERVICE_CMDS:
+        return ServiceMessage.from_string(data.rstrip())
+
+
+def legacy_as_bytes(msg, version):
+    """
+    Previous as_bytes of normal and payload messages
+    """
+    if isinstance(msg, NormalMessage):
+        return "{cmd} {params}{term_seq}\n".format(cmd=msg.cmd, params=' '.join(msg.params),
+                                                   term_seq=Message.TERM_SEQUENCE_STR).encode('utf-8')
+    if version == PROTOCOL_V1:
+        return "{cmd} {params} {payload_size}{split_seq}{payload}{term_seq}\n".format(
+            cmd=msg.cmd, params=' '.join(str(param) for param in msg.params), payload_size=len(msg.payload),
+            split_seq=Message.SPLIT_SEQUENCE_STR, payload=msg.payload,
+            term_seq=Message.TERM_SEQUENCE_STR).encode('utf-8')
+    payload = msg.payload if isinstance(msg.payload, bytes) else str(msg.payload).encode('utf-8')
+    params = msg.params if msg.msg_id is None else msg.params + [msg.msg_id]
+    header = "{cmd} {params} {payload_size}".format(cmd=msg.cmd, params=' '.join(str(param) for param in params),
+                                                   payload_size=len(payload))
+    return b''.join([header.encode('utf-8'), Message.SPLIT_SEQUENCE, payload, Message.TERM_SEQUENCE, b'\n'])
+
+
+def frames(version, payload_size):
+    """
+    :return: list of frames as DataBuffer returns them (without TERM_SEQUENCE) and messages to encode
+    """
+    payload = 'x' * payload_size
+    msgs = [NormalMessage(CMD_LOGIN, ['user1', 'password1']),
+            NormalMessage(CMD_FRIENDS, []),
+            NormalMessage(CMD_MSG_ACK, ['12345']),
+            NormalMessage(CMD_CHANGE_STATUS, ['user2', 'ONLINE']),
+            PayloadMessage(CMD_MESSAGE, ['user2'], payload),
+            PayloadMessage(CMD_CHAT_MESSAGE, ['42'], payload)]
+    return [memoryview(legacy_as_bytes(msg, version).rstrip()[:-len(Message.TERM_SEQUENCE)]) for msg in msgs], msgs
+
+
+def parse_and_encode(parse, as_bytes, version, payload_size):
+    raw_frames, msgs = frames(version, payload_size)
+
+    def run():
+        for raw in raw_frames:
+            parse(raw)
+        for msg in msgs:
+            as_bytes(msg, version)
+
+    return run, len(msgs)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--number", dest="number", type="int", default=5000, help="iterations per run")
+    parser.add_option("--rounds", dest="rounds", type="int", default=15, help="runs of every implementation")
+    parser.add_option("--payload-size", dest="payload_size", type="int", default=100, help="payload size, bytes")
+    (options, args) = parser.parse_args()
+
+    print("Parse + encode per message, payload {size} bytes".format(size=options.payload_size))
+    for version in (PROTOCOL_V1, PROTOCOL_V2):
+        runs = [('legacy', parse_and_encode(lambda raw: legacy_parse(raw, version), legacy_as_bytes,
+                                            version, options.payload_size)),
+                ('current', parse_and_encode(DataParser(version).parse, lambda msg, v: msg.as_bytes(v),
+                                             version, options.payload_size)),
+                ('server', parse_and_encode(DataParser(version, opaque_payloads=True).parse,
+                                            lambda msg, v: msg.as_chunks(v), version, options.payload_size))]
+        elapsed = {name: [] for name, _ in runs}
+        for _ in range(options.rounds):
+            for name, (run, count) in runs:
+                elapsed[name].append(timeit.timeit(run, number=options.number) / options.number / count)
+        for name, _ in runs:
+            print("v{version} {name:<10}{ns:>10.0f} ns".format(version=version, name=name,
+                                                              ns=statistics.median(elapsed[name]) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
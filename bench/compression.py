@@ -0,0 +1,93 @@
+"""
+Payload compression benchmark: CPU cost vs bytes saved on chat-like text, per message size.
+
+Modes:
+- message: every payload is compressed on its own (server >> client, shared by all recipients of a broadcast)
+- stream: payloads are sync-flushed parts of one deflate stream of a connection (client >> server)
+
+Usage (from project root):
+    PYTHONPATH=. python -m bench.compression [--messages N] [--seed N]
+"""
+import random
+import time
+import zlib
+from optparse import OptionParser
+
+from protocol.compression import MessageCompressor, StreamCompressor, StreamDecompressor, decompress_payload, \
+    PAYLOAD_COMPRESS_MIN
+
+
+GREETINGS = ["hi", "hey", "morning", "hello everyone", "yo", "good evening"]
+PHRASES = ["are we still on for {time}?", "I'll be there at {time}", "running {n} minutes late, sorry",
+           "did you see the message from {name}?", "can you send me the link to the {thing}?",
+           "the {thing} is ready, take a look when you have a minute",
+           "let's move the {thing} to {day}", "{name} is joining the call at {time}",
+           "thanks! that fixed it", "I don't think the {thing} is deployed yet",
+           "could you review my changes to the {thing} before {day}?", "ok", "sounds good",
+           "lunch at {place}?", "I'm at {place} now", "{name} said the {thing} works on {day}",
+           "what do you think about {thing}?", "no worries", "see you {day}"]
+NAMES = ["Alex", "Sam", "Maria", "Jun", "Olga", "Ravi", "Chris", "Dana"]
+THINGS = ["report", "release notes", "budget", "slides", "build", "contract", "schedule", "demo"]
+DAYS = ["today", "tomorrow", "Monday", "Friday", "next week"]
+PLACES = ["the office", "the station", "the cafe", "home", "the airport"]
+
+# payload sizes (bytes) of measured message classes
+SIZES = [('short', 64), ('paragraph', 300), ('long', 1500), ('paste', 8000)]
+
+MODES = [('message L1', lambda: MessageCompressor(level=1), lambda: decompress_payload),
+         ('message L6', lambda: MessageCompressor(level=6), lambda: decompress_payload),
+         ('message L9', lambda: MessageCompressor(level=9), lambda: decompress_payload),
+         ('stream L6', lambda: StreamCompressor(level=6), StreamDecompressor)]
+
+
+def chat_text(rnd, size):
+    """
+    :return: chat-like text of about `size` bytes: sentences made of common phrases, names and times
+    """
+    parts = [rnd.choice(GREETINGS)]
+    while sum(len(part) + 1 for part in parts) < size:
+        parts.append(rnd.choice(PHRASES).format(time='{}:{:02d}'.format(rnd.randint(7, 22), rnd.choice([0, 15, 30, 45])),
+                                                n=rnd.randint(2, 30), name=rnd.choice(NAMES),
+                                                thing=rnd.choice(THINGS), day=rnd.choice(DAYS),
+                                                place=rnd.choice(PLACES)))
+    return ' '.join(parts)[:size].encode('utf-8')
+
+
+def measure(make_compressor, make_decompressor, payloads):
+    """
+    :return: (compressed bytes, compress seconds, decompress seconds) of all payloads
+    """
+    compress = make_compressor()
+    started = time.process_time()
+    compressed = [compress(payload) for payload in payloads]
+    compress_time = time.process_time() - started
+    decompress = make_decompressor()
+    started = time.process_time()
+    for payload in compressed:
+        decompress(payload)
+    return sum(map(len, compressed)), compress_time, time.process_time() - started
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--messages", dest="messages", type="int", default=2000, help="messages per size")
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="random seed of generated text")
+    (options, args) = parser.parse_args()
+
+    rnd = random.Random(options.seed)
+    print("zlib {version}, {n} messages per size, compression threshold {min} bytes".format(
+        version=zlib.ZLIB_VERSION, n=options.messages, min=PAYLOAD_COMPRESS_MIN))
+    print("{:<10}{:>7}  {:<11}{:>8}{:>13}{:>15}{:>15}".format(
+        'size', 'bytes', 'mode', 'ratio', 'saved B/msg', 'compress us', 'decompress us'))
+    for name, size in SIZES:
+        payloads = [chat_text(rnd, size) for _ in range(options.messages)]
+        plain = sum(map(len, payloads))
+        for mode, make_compressor, make_decompressor in MODES:
+            compressed, compress_time, decompress_time = measure(make_compressor, make_decompressor, payloads)
+            print("{:<10}{:>7}  {:<11}{:>8.2f}{:>13.0f}{:>15.1f}{:>15.1f}".format(
+                name, size, mode, compressed / plain, (plain - compressed) / options.messages,
+                compress_time / options.messages * 1e6, decompress_time / options.messages * 1e6))
+
+
+if __name__ == '__main__':
+    main()
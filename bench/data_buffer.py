@@ -0,0 +1,61 @@
+"""
+DataBuffer microbenchmark: push one big payload in small chunks, compare with the previous implementation.
+
+Usage (from project root):
+    PYTHONPATH=. python -m bench.data_buffer [--size MB] [--chunk BYTES]
+"""
+import time
+from optparse import OptionParser
+
+from protocol.data_utils import DataBuffer
+from protocol.messages import Message
+
+
+class LegacyDataBuffer:
+    """
+    Previous DataBuffer implementation (bytes concatenation + split of the whole buffer on every push),
+    without its per-push buffer logging
+    """
+
+    def __init__(self):
+        self._data = b""
+
+    def push(self, data):
+        raw_messages = []
+        if data == b'\n':
+            return raw_messages
+        self._data += data
+        if Message.TERM_SEQUENCE in self._data:
+            split_data = self._data.split(Message.TERM_SEQUENCE)
+            self._data = split_data[-1]
+            raw_messages = split_data[:-1]
+        return raw_messages
+
+
+def push_in_chunks(data_buffer, data, chunk):
+    started = time.perf_counter()
+    frames = 0
+    for pos in range(0, len(data), chunk):
+        frames += len(data_buffer.push(data[pos:pos + chunk]))
+    elapsed = time.perf_counter() - started
+    assert frames == 1
+    return elapsed
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--size", dest="size", type="int", default=10, help="payload size, MB")
+    parser.add_option("--chunk", dest="chunk", type="int", default=1024, help="chunk size, bytes")
+    (options, args) = parser.parse_args()
+
+    data = b'MSG user ' + b'x' * (options.size * 1024 * 1024) + Message.TERM_SEQUENCE
+    print("Pushing {size} MB in {chunk} bytes chunks".format(size=options.size, chunk=options.chunk))
+    results = [('legacy', push_in_chunks(LegacyDataBuffer(), data, options.chunk)),
+               ('current', push_in_chunks(DataBuffer(), data, options.chunk))]
+    for name, elapsed in results:
+        print("{name:<10}{elapsed:>10.3f} s{speed:>12.1f} MB/s".format(
+            name=name, elapsed=elapsed, speed=options.size / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Command dispatch microbenchmark: Client.handle through the precompiled handler table
+compared with the previous getattr lookup and login_required wrapper call per message.
+
+Usage (from project root):
+    PYTHONPATH=. python -m bench.dispatch [--number N]
+"""
+import timeit
+from optparse import OptionParser
+
+from server.client import Client, cmd_handler_cls, register_cmd, login_required, NoHandlerForCmdRegisteredException
+from protocol.messages import NormalMessage
+
+
+CMD_PING = 'PNG'
+CMD_AUTH_PING = 'PNA'
+
+
+class NullConnection:
+
+    def getpeername(self):
+        return ('127.0.0.1', 0)
+
+
+@cmd_handler_cls
+class BenchClient(Client):
+    """
+    Client with handlers doing nothing, so only dispatch is measured
+    """
+
+    user = 'bench'  # pretends to be logged in
+
+    @register_cmd(CMD_PING)
+    def ping(self, msg):
+        pass
+
+    @register_cmd(CMD_AUTH_PING)
+    @login_required
+    def auth_ping(self, msg):
+        pass
+
+
+def legacy_handle(client, msg, handlers={CMD_PING: 'ping', CMD_AUTH_PING: 'auth_ping'}):
+    """
+    Previous Client.handle: handler name lookup, getattr and login_required wrapper call per message
+    """
+    try:
+        msg_handler_func = getattr(client, handlers[msg.cmd])
+    except KeyError:
+        raise NoHandlerForCmdRegisteredException(msg.cmd)
+    return msg_handler_func(msg)
+
+
+def measure(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--number", dest="number", type="int", default=50000, help="iterations per run")
+    (options, args) = parser.parse_args()
+
+    client = BenchClient(NullConnection())
+    print("{:<6}{:>14}{:>14}".format('cmd', 'current ns', 'legacy ns'))
+    for cmd in [CMD_PING, CMD_AUTH_PING]:
+        msg = NormalMessage(cmd, [])
+        current = measure(lambda: client.handle(msg), options.number)
+        legacy = measure(lambda: legacy_handle(client, msg), options.number)
+        print("{:<6}{:>14.0f}{:>14.0f}".format(cmd, current * 1e9, legacy * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Side-by-side benchmark of server engines: selectors based MessServer and asyncio based AsyncMessServer.
+
+Usage (from project root):
+    PYTHONPATH=. python -m bench.engines [--connections N] [--pairs N] [--messages N] [--json]
+"""
+import asyncio
+import json
+import time
+from optparse import OptionParser
+
+from bench.load import remove_db
+from bench.server import BenchServer
+from protocol.data_utils import DataBuffer, DataParser
+from protocol.messages import NormalMessage, PayloadMessage, CMD_LOGIN, CMD_MESSAGE
+from server.models import init_db
+from server.models.utils import create_users, make_friends
+
+
+HOST = '127.0.0.1'
+
+
+def prepare_users(pairs):
+    """
+    Create `pairs` of (sender, receiver) friends
+    :return: list of tuples ((sender, password), (receiver, password))
+    """
+    users = []
+    for n in range(pairs):
+        sender = ('bench_sender{}'.format(n), 'pass')
+        receiver = ('bench_receiver{}'.format(n), 'pass')
+        created = create_users(name_pass=[sender, receiver])
+        if created[receiver[0]] not in created[sender[0]].all_friends:
+            make_friends(created[sender[0]], [created[receiver[0]]])
+        users.append((sender, receiver))
+    return users
+
+
+async def connections_per_sec(port, total, concurrency=100):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect():
+        async with semaphore:
+            reader, writer = await asyncio.open_connection(HOST, port)
+            writer.close()
+            await writer.wait_closed()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[connect() for _ in range(total)])
+    return total / (time.perf_counter() - started)
+
+
+async def login(port, name_pass):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(NormalMessage(cmd=CMD_LOGIN, params=list(name_pass)).as_bytes())
+    await writer.drain()
+    return reader, writer
+
+
+async def count_messages(reader, expected, payload):
+    data_buffer, data_parser = DataBuffer(), DataParser()
+    received = 0
+    while received < expected:
+        data = await reader.read(65536)
+        if not data:
+            break
+        for raw_msg in data_buffer.push(data):
+            msg = data_parser.parse(raw_msg)
+            if msg.cmd == CMD_MESSAGE and msg.payload == payload:
+                received += 1
+    return received
+
+
+async def messages_per_sec(port, users, count, payload):
+    receivers = [await login(port, receiver) for _, receiver in users]
+    senders = [await login(port, sender) for sender, _ in users]
+    await asyncio.sleep(0.5)  # let logins and offline messages replay finish
+
+    started = time.perf_counter()
+    counters = [asyncio.ensure_future(count_messages(reader, count, payload)) for reader, _ in receivers]
+    for (sender, receiver), (_, writer) in zip(users, senders):
+        frame = PayloadMessage(cmd=CMD_MESSAGE, params=[receiver[0]], payload=payload).as_bytes()
+        writer.write(frame * count)
+    await asyncio.gather(*[writer.drain() for _, writer in senders])
+    received = sum(await asyncio.gather(*counters))
+    elapsed = time.perf_counter() - started
+
+    for _, writer in receivers + senders:
+        writer.close()
+    return received / elapsed
+
+
+def run_engine(engine, port, users, options):
+    server = BenchServer(engine=engine, port=port)
+    server.up()
+    try:
+        loop = asyncio.new_event_loop()
+        result = {
+            'engine': engine,
+            'connections_per_sec': loop.run_until_complete(connections_per_sec(port, options.connections)),
+            'messages_per_sec': loop.run_until_complete(
+                messages_per_sec(port, users, options.messages, payload='ping-{}'.format(engine))),
+        }
+        loop.close()
+    finally:
+        server.down()
+    return result
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--connections", dest="connections", type="int", default=2000,
+                      help="connections to open for connections/sec test")
+    parser.add_option("--pairs", dest="pairs", type="int", default=5,
+                      help="number of sender/receiver pairs for messages/sec test")
+    parser.add_option("--messages", dest="messages", type="int", default=200,
+                      help="messages sent by every sender")
+    parser.add_option("--port", dest="port", type="int", default=9191)
+    parser.add_option("--json", dest="json", action="store_true", default=False,
+                      help="print results as JSON")
+    (options, args) = parser.parse_args()
+
+    config = BenchServer().config
+    remove_db(config)  # with WAL files of an interrupted run
+    init_db(db=config.db)
+    users = prepare_users(options.pairs)
+
+    results = []
+    try:
+        for engine in ['selectors', 'asyncio']:
+            results.append(run_engine(engine, options.port, users, options))
+    finally:
+        remove_db(config)
+
+    if options.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:<12}{:>20}{:>20}".format('engine', 'connections/sec', 'messages/sec'))
+        for res in results:
+            print("{engine:<12}{connections_per_sec:>20.1f}{messages_per_sec:>20.1f}".format(**res))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,563 @@
+"""
+Load generator: thousands of simulated users (asyncio, a connection per user) drive scenarios against
+a server running in a subprocess or in this process. Reports messages/sec, delivery latency percentiles
+and server RSS, JSON results are meant to be kept per release to track regressions.
+
+Scenarios:
+- direct - pairs of friends, every sender sends messages to its receiver
+- chat - one chat of all users, some of them send messages to it, everybody else receives them
+- login_storm - users with a backlog of offline messages log in at once, latency is from login to a message
+- presence - users log out and in again, latency of status changes seen by their online friends
+
+Usage (from project root):
+    PYTHONPATH=. python -m bench.load [--scenario NAME ...] [--users N] [--messages N] [--in-process]
+                                      [--engine selectors|asyncio] [--json FILE|-]
+"""
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import socket
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+from bench.server import BenchServer
+from protocol.data_utils import DataBuffer, DataParser
+from protocol.messages import NormalMessage, PayloadMessage, CMD_LOGIN, CMD_LOGOUT, CMD_FRIENDS, CMD_INFO, \
+    CMD_MESSAGE, CMD_CHAT_MESSAGE, CMD_CHANGE_STATUS, CMD_MSG_ACK, CMD_VERSION, CMD_ERROR, PROTOCOL_V1, PROTOCOL_V2
+from server.base_client import CLIENT_OFFLINE, USER_STATUS_DEFAULT
+from server.config import TestConfig
+from server.mess_server import MessServer
+from server.models import init_db
+from server.models.utils import s, MESSAGE_WRITER, create_users, make_friends, create_chat, create_message
+
+
+HOST = '127.0.0.1'
+CONNECT_CONCURRENCY = 200  # connections being opened at once, listen backlog of the server is limited
+SEND_WINDOW = 10  # messages written by a sender between drains
+
+
+def progress(text):
+    print("[{ts}] {text}".format(ts=time.strftime('%H:%M:%S'), text=text), file=sys.stderr, flush=True)
+
+
+def percentile(values, p):
+    """
+    :param values: sorted list
+    :param p: percentile, 0..100
+    :return: value or None for empty list
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def latency_summary(latencies):
+    """
+    :param latencies: seconds
+    :return: dict of percentiles, milliseconds
+    """
+    latencies = sorted(latencies)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {'count': len(latencies),
+            'p50': ms(percentile(latencies, 50)),
+            'p99': ms(percentile(latencies, 99)),
+            'p999': ms(percentile(latencies, 99.9)),
+            'max': ms(latencies[-1] if latencies else None)}
+
+
+def rss_kb(pid):
+    """
+    Resident set size of process, from /proc (Linux only)
+    :return: kB or None
+    """
+    try:
+        with open('/proc/{pid}/status'.format(pid=pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def raise_open_files_limit():
+    """
+    A connection per simulated user (and per server side client if the server is a child process)
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def make_payload(size):
+    """
+    Payload carrying the time it was made at, see sent_ts
+    """
+    ts = '{:.6f}'.format(time.perf_counter())
+    return ts + ' ' + 'x' * max(0, size - len(ts) - 1)
+
+
+def sent_ts(msg):
+    return float(msg.payload.split(' ', 1)[0])
+
+
+class SimUser:
+    """
+    Simulated user: one connection, received frames are parsed by a reader task and passed to
+    on_frame(user, msg), personal and chat messages are acknowledged (protocol v2)
+    """
+
+    def __init__(self, name, password, version=PROTOCOL_V2):
+        self.name = name
+        self.password = password
+        self.version = version
+        self.data_buffer = DataBuffer(version)
+        self.data_parser = DataParser(version)
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.replies = {}  # {cmd: future} of requests waiting for a reply
+        self.on_frame = None
+        self.login_ts = None
+        self.errors = []
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection(HOST, port)
+        self.reader_task = asyncio.ensure_future(self.read_frames())
+        if self.version != PROTOCOL_V1:
+            await self.request(NormalMessage(CMD_VERSION, [str(self.version)]), CMD_VERSION)
+
+    async def login(self):
+        self.login_ts = time.perf_counter()
+        self.send(NormalMessage(CMD_LOGIN, [self.name, self.password]))
+        # commands are handled in order, so the reply means login is done
+        await self.request(NormalMessage(CMD_FRIENDS), CMD_INFO)
+
+    def send(self, msg):
+        self.writer.write(msg.as_bytes(self.version))
+
+    async def request(self, msg, reply_cmd):
+        future = self.replies[reply_cmd] = asyncio.get_event_loop().create_future()
+        self.send(msg)
+        return await future
+
+    async def read_frames(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                break
+            acks = {}
+            for frame in self.data_buffer.push(data):
+                msg = self.data_parser.parse(bytes(frame))
+                future = self.replies.pop(msg.cmd, None)
+                if future is not None:
+                    future.set_result(msg)
+                elif msg.cmd == CMD_ERROR:
+                    self.errors.append(msg.code)
+                    for future in self.replies.values():
+                        future.set_exception(RuntimeError("{name}: {error}".format(name=self.name, error=msg.code)))
+                    self.replies.clear()
+                elif self.on_frame:
+                    self.on_frame(self, msg)
+                if self.version != PROTOCOL_V1 and msg.cmd in (CMD_MESSAGE, CMD_CHAT_MESSAGE):
+                    chat_id = msg.params[0] if msg.cmd == CMD_CHAT_MESSAGE else None
+                    acks[chat_id] = msg.params[-1]
+            for chat_id, msg_id in acks.items():
+                self.send(NormalMessage(CMD_MSG_ACK, [msg_id] if chat_id is None else [chat_id, msg_id]))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        if self.reader_task:
+            self.reader_task.cancel()
+
+
+class Recorder:
+    """
+    Latencies of expected deliveries
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.latencies = []
+        self.last_ts = None
+        self.done = asyncio.Event()
+
+    @property
+    def received(self):
+        return len(self.latencies)
+
+    def record(self, since_ts):
+        self.last_ts = time.perf_counter()
+        self.latencies.append(self.last_ts - since_ts)
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+    async def wait(self, timeout, idle=2.0):
+        """
+        Wait until everything is received, `timeout` seconds at most or `idle` seconds without progress
+        """
+        deadline = time.perf_counter() + timeout
+        received = -1
+        while received != self.received and time.perf_counter() < deadline:
+            received = self.received
+            try:
+                await asyncio.wait_for(self.done.wait(), min(idle, max(0, deadline - time.perf_counter())))
+                return
+            except asyncio.TimeoutError:
+                pass
+
+
+async def connect_all(users, port, login=True):
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(user):
+        async with semaphore:
+            await user.connect(port)
+            if login:
+                await user.login()
+
+    await asyncio.gather(*[connect(user) for user in users])
+
+
+class Scenario:
+    """
+    Users (and data) are created by prepare() before the server starts, run() drives the load
+    and returns results: expected and received deliveries, Recorder
+    """
+
+    name = None
+
+    def __init__(self, options):
+        self.options = options
+        self.users = []
+
+    def user_names(self, count):
+        return [('load_{scenario}_{n}'.format(scenario=self.name, n=n), 'pass') for n in range(count)]
+
+    def prepare(self):
+        raise NotImplementedError()
+
+    async def run(self, port):
+        raise NotImplementedError()
+
+    def sim_users(self, name_pass):
+        return [SimUser(name, password, version=self.options.protocol_version) for name, password in name_pass]
+
+
+class DirectScenario(Scenario):
+
+    name = 'direct'
+
+    def prepare(self):
+        self.pairs = []
+        name_pass = self.user_names(self.options.users // 2 * 2)
+        users = create_users(name_pass=name_pass)
+        for sender, receiver in zip(name_pass[::2], name_pass[1::2]):
+            make_friends(users[sender[0]], [users[receiver[0]]])
+            self.pairs.append((sender, receiver))
+
+    async def run(self, port):
+        senders = self.sim_users(sender for sender, _ in self.pairs)
+        receivers = self.sim_users(receiver for _, receiver in self.pairs)
+        await connect_all(senders + receivers, port)
+        recorder = Recorder(expected=len(self.pairs) * self.options.messages)
+        for receiver in receivers:
+            receiver.on_frame = lambda user, msg: msg.cmd == CMD_MESSAGE and recorder.record(sent_ts(msg))
+
+        async def send_messages(sender, receiver):
+            for n in range(self.options.messages):
+                sender.send(PayloadMessage(CMD_MESSAGE, [receiver.name], make_payload(self.options.payload_size)))
+                if n % SEND_WINDOW == SEND_WINDOW - 1:
+                    await sender.writer.drain()
+
+        started = time.perf_counter()
+        await asyncio.gather(*[send_messages(sender, receiver) for sender, receiver in zip(senders, receivers)])
+        await recorder.wait(self.options.timeout)
+        self.users = senders + receivers
+        return started, recorder, {}
+
+
+class ChatScenario(Scenario):
+
+    name = 'chat'
+
+    def prepare(self):
+        self.name_pass = self.user_names(self.options.users)
+        users = create_users(name_pass=self.name_pass)
+        owner, participants = self.name_pass[0][0], [users[name] for name, _ in self.name_pass[1:]]
+        self.chat_id = create_chat('load_chat', users[owner], participants).id
+
+    async def run(self, port):
+        members = self.sim_users(self.name_pass)
+        await connect_all(members, port)
+        senders = members[:self.options.chat_senders]
+        recorder = Recorder(expected=len(senders) * self.options.messages * (len(members) - 1))
+        for member in members:
+            member.on_frame = lambda user, msg: msg.cmd == CMD_CHAT_MESSAGE and recorder.record(sent_ts(msg))
+
+        async def send_messages(sender):
+            for n in range(self.options.messages):
+                sender.send(PayloadMessage(CMD_CHAT_MESSAGE, [str(self.chat_id)],
+                                           make_payload(self.options.payload_size)))
+                await sender.writer.drain()
+
+        started = time.perf_counter()
+        await asyncio.gather(*[send_messages(sender) for sender in senders])
+        await recorder.wait(self.options.timeout)
+        self.users = members
+        return started, recorder, {'members': len(members), 'senders': len(senders)}
+
+
+class LoginStormScenario(Scenario):
+
+    name = 'login_storm'
+
+    def prepare(self):
+        self.name_pass = self.user_names(self.options.users)
+        users = create_users(name_pass=self.name_pass + [('load_login_storm_sender', 'pass')])
+        sender = users.pop('load_login_storm_sender')
+        batch_size, flush_interval = MESSAGE_WRITER.batch_size, MESSAGE_WRITER.flush_interval
+        MESSAGE_WRITER.configure(batch_size=1000, flush_interval=60, durability=MESSAGE_WRITER.durability)
+        for user in users.values():
+            for n in range(self.options.messages):
+                create_message(user, sender, make_payload(self.options.payload_size))
+        MESSAGE_WRITER.configure(batch_size=batch_size, flush_interval=flush_interval,
+                                 durability=MESSAGE_WRITER.durability)
+
+    async def run(self, port):
+        users = self.sim_users(self.name_pass)
+        await connect_all(users, port, login=False)
+        recorder = Recorder(expected=len(users) * self.options.messages)
+        for user in users:
+            user.on_frame = lambda user, msg: msg.cmd == CMD_MESSAGE and recorder.record(user.login_ts)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[user.login() for user in users])
+        await recorder.wait(self.options.timeout)
+        self.users = users
+        return started, recorder, {'backlog_per_user': self.options.messages}
+
+
+class PresenceScenario(Scenario):
+    """
+    Groups of friends: first half of a group flaps (logs out and in), the other half watches
+    """
+
+    name = 'presence'
+
+    def prepare(self):
+        self.groups = []
+        name_pass = self.user_names(self.options.users)
+        users = create_users(name_pass=name_pass)
+        group_size = max(2, self.options.group)
+        for pos in range(0, len(name_pass), group_size):
+            group = name_pass[pos:pos + group_size]
+            for n, (name, _) in enumerate(group[:-1]):
+                make_friends(users[name], [users[friend] for friend, _ in group[n + 1:]])
+            self.groups.append(group)
+
+    async def run(self, port):
+        flappers, watchers = [], []
+        expected = 0
+        for group in self.groups:
+            half = len(group) // 2
+            flappers.extend(self.sim_users(group[:half]))
+            watchers.extend(self.sim_users(group[half:]))
+            expected += half * (len(group) - half) * 2 * self.options.messages
+        await connect_all(flappers + watchers, port)
+        await asyncio.sleep(0.5)  # status changes of the logins are delivered
+
+        flap_ts = {}  # {(name, status): time of the last change}
+        recorder = Recorder(expected=expected)
+        frames = []
+
+        def on_status(user, msg):
+            if msg.cmd != CMD_CHANGE_STATUS:
+                return
+            frames.append(len(msg.params) // 2)
+            for name, status in zip(msg.params[::2], msg.params[1::2]):
+                since_ts = flap_ts.get((name, status))
+                if since_ts is not None:
+                    recorder.record(since_ts)
+
+        for watcher in watchers:
+            watcher.on_frame = on_status
+
+        async def flap(user):
+            for n in range(self.options.messages):
+                flap_ts[(user.name, CLIENT_OFFLINE)] = time.perf_counter()
+                user.send(NormalMessage(CMD_LOGOUT))
+                await asyncio.sleep(self.options.flap_interval)
+                flap_ts[(user.name, USER_STATUS_DEFAULT)] = time.perf_counter()
+                user.send(NormalMessage(CMD_LOGIN, [user.name, user.password]))
+                await asyncio.sleep(self.options.flap_interval)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[flap(user) for user in flappers])
+        await recorder.wait(self.options.timeout)
+        self.users = flappers + watchers
+        return started, recorder, {'flappers': len(flappers), 'watchers': len(watchers),
+                                   'status_frames': len(frames), 'status_changes': sum(frames)}
+
+
+SCENARIOS = {scenario.name: scenario for scenario in [DirectScenario, ChatScenario, LoginStormScenario,
+                                                       PresenceScenario]}
+
+
+class InProcessServer:
+    """
+    MessServer (selectors engine) in a daemon thread of this process, for profiling and quick runs:
+    client side shares the process (and the GIL) with it, so it's included in RSS too
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.server = MessServer(port=port, config=TestConfig())
+        self.thread = threading.Thread(target=self.server.run, name='mess-server', daemon=True)
+
+    @property
+    def pid(self):
+        return os.getpid()
+
+    def up(self, timeout=10):
+        self.thread.start()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                socket.create_connection((HOST, self.port), timeout=1).close()
+                return self.pid
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("Server didn't start in {timeout}s".format(timeout=timeout))
+
+    def down(self):
+        pass  # stopped with the process
+
+
+async def run_scenario(scenario, server, options):
+    rss_before = rss_kb(server.pid)
+    started, recorder, extra = await scenario.run(server.port)
+    finished = recorder.last_ts or time.perf_counter()
+    elapsed = finished - started
+    result = {
+        'scenario': scenario.name,
+        'users': len(scenario.users),
+        'expected': recorder.expected,
+        'received': recorder.received,
+        'elapsed_s': round(elapsed, 3),
+        'msgs_per_sec': round(recorder.received / elapsed, 1) if elapsed > 0 else None,
+        'latency_ms': latency_summary(recorder.latencies),
+        'errors': sum(len(user.errors) for user in scenario.users),
+        'server_rss_kb': {'before': rss_before, 'after': rss_kb(server.pid)},
+    }
+    result.update(extra)
+    for user in scenario.users:
+        user.close()
+    await asyncio.sleep(0.5)  # logouts
+    return result
+
+
+def remove_db(config):
+    for path in [config.db_path, config.db_path + '-wal', config.db_path + '-shm']:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def print_results(report):
+    print("engine: {engine}, server: {server}".format(**report))
+    print("{:<14}{:>8}{:>10}{:>10}{:>12}{:>10}{:>10}{:>10}{:>12}".format(
+        'scenario', 'users', 'expected', 'received', 'msgs/sec', 'p50 ms', 'p99 ms', 'p999 ms', 'rss kB'))
+    for res in report['scenarios']:
+        print("{scenario:<14}{users:>8}{expected:>10}{received:>10}{rate:>12}{p50:>10}{p99:>10}{p999:>10}{rss:>12}".format(
+            rate=str(res['msgs_per_sec']), rss=str(res['server_rss_kb']['after']),
+            p50=str(res['latency_ms']['p50']), p99=str(res['latency_ms']['p99']),
+            p999=str(res['latency_ms']['p999']), **res))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--scenario", dest="scenarios", action="append", type="choice", choices=list(SCENARIOS),
+                      help="scenario to run, can be repeated: {names} (default: all)".format(
+                          names=', '.join(SCENARIOS)))
+    parser.add_option("--users", dest="users", type="int", default=1000, help="simulated users per scenario")
+    parser.add_option("--messages", dest="messages", type="int", default=20,
+                      help="messages per sender, offline messages per user (login_storm), flaps per user (presence)")
+    parser.add_option("--payload-size", dest="payload_size", type="int", default=64, help="bytes")
+    parser.add_option("--chat-senders", dest="chat_senders", type="int", default=10,
+                      help="chat members sending messages (chat)")
+    parser.add_option("--group", dest="group", type="int", default=10, help="friends per group (presence)")
+    parser.add_option("--flap-interval", dest="flap_interval", type="float", default=0.05,
+                      help="seconds between logout and login (presence)")
+    parser.add_option("--protocol", dest="protocol_version", type="int", default=PROTOCOL_V2,
+                      help="protocol version of simulated users")
+    parser.add_option("--engine", dest="engine", type="choice", choices=['selectors', 'asyncio'],
+                      default='selectors', help="server engine (subprocess server)")
+    parser.add_option("--in-process", dest="in_process", action="store_true", default=False,
+                      help="run server (selectors engine) in a thread of this process")
+    parser.add_option("--port", dest="port", type="int", default=9191)
+    parser.add_option("--timeout", dest="timeout", type="float", default=60,
+                      help="seconds to wait for deliveries of a scenario")
+    parser.add_option("--json", dest="json", help="write results as JSON to file, '-' for stdout")
+    (options, args) = parser.parse_args()
+    if options.in_process and options.engine != 'selectors':
+        parser.error("--in-process runs selectors engine only")
+
+    raise_open_files_limit()
+    config = TestConfig()
+    remove_db(config)
+    init_db(db=config.db)
+    scenarios = [SCENARIOS[name](options) for name in (options.scenarios or SCENARIOS)]
+    for scenario in scenarios:
+        progress("Preparing {scenario}...".format(scenario=scenario.name))
+        scenario.prepare()
+    s.close()  # server owns the database from now on
+
+    if options.in_process:
+        server = InProcessServer(options.port)
+    else:
+        server = BenchServer(engine=options.engine, port=options.port, extra_args=['--log-mode=production'])
+    report = {
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'engine': options.engine,
+        'server': 'in-process' if options.in_process else 'subprocess',
+        'python': platform.python_version(),
+        'options': {key: value for key, value in vars(options).items() if key not in ('json', 'port')},
+        'scenarios': [],
+    }
+    server.up()
+    try:
+        report['server_rss_kb_start'] = rss_kb(server.pid)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for scenario in scenarios:
+            progress("Running {scenario}...".format(scenario=scenario.name))
+            report['scenarios'].append(loop.run_until_complete(run_scenario(scenario, server, options)))
+        loop.close()
+    finally:
+        server.down()
+        remove_db(config)
+
+    if options.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif options.json:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print_results(report)
+    else:
+        print_results(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+MessageWriter benchmark: messages saved per second to SQLite file with commit per message and with group commit,
+with rollback journal and with write-ahead log.
+
+Usage (from project root):
+    PYTHONPATH=. python -m bench.message_writer [--messages N] [--batch N]
+"""
+import os
+import tempfile
+import time
+from optparse import OptionParser
+
+from server.models import init_db
+from server.models.utils import MESSAGE_WRITER, create_users, create_message
+
+
+def save_messages(batch_size, count, sender, receiver):
+    MESSAGE_WRITER.configure(batch_size=batch_size, flush_interval=60, durability=MESSAGE_WRITER.durability)
+    started = time.perf_counter()
+    for n in range(count):
+        create_message(receiver, sender, 'message {}'.format(n))
+    MESSAGE_WRITER.flush()
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--messages", dest="messages", type="int", default=2000, help="messages to save")
+    parser.add_option("--batch", dest="batch", type="int", default=100, help="group commit batch size")
+    (options, args) = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp()
+    print("{:<12}{:<12}{:>20}".format('journal', 'batch', 'messages/sec'))
+    try:
+        for sqlite_wal in [False, True]:
+            db_path = os.path.join(db_dir, 'bench_wal.db' if sqlite_wal else 'bench.db')
+            init_db(db='sqlite:///{db_path}'.format(db_path=db_path), sqlite_wal=sqlite_wal)
+            users = create_users(name_pass=[('bench_sender', 'pass'), ('bench_receiver', 'pass')])
+            sender, receiver = users['bench_sender'], users['bench_receiver']
+            for batch_size in [1, options.batch]:
+                rate = save_messages(batch_size, options.messages, sender, receiver)
+                print("{:<12}{:<12}{:>20.1f}".format('wal' if sqlite_wal else 'delete', batch_size, rate))
+        init_db(db='sqlite:///:memory:')  # close files
+    finally:
+        for name in os.listdir(db_dir):
+            os.remove(os.path.join(db_dir, name))
+        os.rmdir(db_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import signal
+import socket
+import subprocess
+
+from server.config import TestConfig
+
+
+class BenchServer:
+    """
+    Runs server/run.py in a subprocess (test mode) and waits until it accepts connections
+    """
+
+    def __init__(self, engine='selectors', port=9191, extra_args=None):
+        self.engine = engine
+        self.port = port
+        self.extra_args = extra_args if extra_args else []
+        self.config = TestConfig()
+        self.proc = None
+
+    @property
+    def pid(self):
+        return self.proc.pid if self.proc else None
+
+    def up(self, timeout=10):
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join([self.config.project_path, env.get('PYTHONPATH', '')])
+        cmd = [sys.executable, os.path.join(self.config.project_path, 'server', 'run.py'),
+               '--mode=test', '--engine={}'.format(self.engine), '--port={}'.format(self.port)] + self.extra_args
+        self.proc = subprocess.Popen(cmd, shell=False, env=env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return self.pid
+            except OSError:
+                time.sleep(0.05)
+        self.down()
+        raise RuntimeError("Server({engine}) didn't start in {timeout}s".format(engine=self.engine, timeout=timeout))
+
+    def down(self, timeout=10):
+        if not self.proc:
+            return
+        self.proc.send_signal(signal.SIGINT)  # emulate Ctrl+C
+        try:
+            self.proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
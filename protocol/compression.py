@@ -0,0 +1,117 @@
+"""
+Payload compression of protocol v2, enabled per connection by 'USR <name> <password> ZLIB'.
+
+Payloads of PAYLOAD_COMPRESS_MIN bytes and bigger are sent as raw deflate data,
+PAYLOAD_SIZE in the header of such frame is prefixed with COMPRESSED_SIZE_PREFIX and is the size
+of compressed data: 'MSG user1 z312 42||<deflate>..'. Frames without the prefix are plain.
+
+- client >> server: one deflate stream per connection (StreamCompressor), each payload is sync-flushed,
+  so later messages refer to earlier ones, server keeps the matching StreamDecompressor
+- server >> client: every payload is compressed on its own (MessageCompressor), so a message is compressed
+  once and the same bytes are sent to all recipients (chat broadcasts, see PayloadMessage.as_chunks),
+  client decompresses each frame with decompress_payload
+"""
+import zlib
+
+
+LOGIN_COMPRESSION = 'ZLIB'
+
+COMPRESSED_SIZE_PREFIX = 'z'
+COMPRESSED_SIZE_PREFIX_BYTES = COMPRESSED_SIZE_PREFIX.encode('utf-8')
+
+# smaller payloads are sent as they are, see bench/compression.py
+PAYLOAD_COMPRESS_MIN = 256
+COMPRESS_LEVEL = 6
+# raw deflate, without zlib header and checksum
+WBITS = -zlib.MAX_WBITS
+
+# limit of decompressed payload size, bytes
+DECOMPRESSED_PAYLOAD_MAX = 16 * 1024 * 1024
+
+
+class CompressionError(Exception):
+    pass
+
+
+class MessageCompressor:
+    """
+    Compresses every payload on its own, output doesn't depend on other messages and can be shared
+    """
+
+    shared = True
+
+    def __init__(self, level=COMPRESS_LEVEL):
+        self.level = level
+
+    def __call__(self, payload):
+        # window and hash table no bigger than the payload: setting up the full size state
+        # costs more than compressing a chat message, decompressor takes any window size
+        wbits = min(zlib.MAX_WBITS, max(9, (len(payload) - 1).bit_length()))
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -wbits, min(8, wbits - 6))
+        return compressor.compress(payload) + compressor.flush()
+
+
+class StreamCompressor:
+    """
+    Compression context of a connection: payloads are parts of one deflate stream,
+    every one of them has to be sent, in order
+    """
+
+    shared = False
+
+    def __init__(self, level=COMPRESS_LEVEL):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS)
+
+    def __call__(self, payload):
+        return self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class StreamDecompressor:
+    """
+    Decompression context of a connection, see StreamCompressor
+    """
+
+    def __init__(self, max_size=DECOMPRESSED_PAYLOAD_MAX):
+        self.decompressor = zlib.decompressobj(WBITS)
+        self.max_size = max_size
+
+    def __call__(self, payload):
+        try:
+            data = self.decompressor.decompress(payload, self.max_size)
+        except zlib.error as e:
+            raise CompressionError(e)
+        if self.decompressor.unconsumed_tail:
+            raise CompressionError("Decompressed payload is bigger than {} bytes".format(self.max_size))
+        return data
+
+
+def decompress_payload(payload, max_size=DECOMPRESSED_PAYLOAD_MAX):
+    """
+    Decompress payload compressed by MessageCompressor
+    :param payload: bytes-like object
+    :return: bytes
+    """
+    decompressor = zlib.decompressobj(WBITS)
+    try:
+        data = decompressor.decompress(payload, max_size)
+    except zlib.error as e:
+        raise CompressionError(e)
+    if decompressor.unconsumed_tail:
+        raise CompressionError("Decompressed payload is bigger than {} bytes".format(max_size))
+    if not decompressor.eof:
+        raise CompressionError("Compressed payload is truncated")
+    return data
+
+
+def parse_payload_size(token):
+    """
+    :param token: PAYLOAD_SIZE field of the header, str or bytes
+    :return: (size, compressed)
+    """
+    prefix = COMPRESSED_SIZE_PREFIX if isinstance(token, str) else COMPRESSED_SIZE_PREFIX_BYTES
+    if token[:1] == prefix:
+        return int(token[1:]), True
+    return int(token), False
+
+
+COMPRESSOR = MessageCompressor()
@@ -0,0 +1,77 @@
+import unittest
+
+from protocol.compression import MessageCompressor, StreamCompressor, StreamDecompressor, CompressionError, \
+    decompress_payload, parse_payload_size, PAYLOAD_COMPRESS_MIN
+from protocol.messages import PayloadMessage, PROTOCOL_V1, PROTOCOL_V2
+
+
+TEXT = "Are we still meeting at the cafe near the station tomorrow? I'll be there at nine. " * 10
+
+
+class CountingCompressor(MessageCompressor):
+
+    calls = 0
+
+    def __call__(self, payload):
+        self.calls += 1
+        return super().__call__(payload)
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_stream(self):
+        compress, decompress = StreamCompressor(), StreamDecompressor()
+        first, second = compress(TEXT.encode('utf-8')), compress(TEXT.encode('utf-8'))
+        # the second one refers to the first one
+        self.assertLess(len(second), len(first) // 4)
+        self.assertEqual(decompress(first), TEXT.encode('utf-8'))
+        self.assertEqual(decompress(second), TEXT.encode('utf-8'))
+
+    def test_limits(self):
+        payload = MessageCompressor()(b'x' * 1000)
+        self.assertEqual(decompress_payload(payload), b'x' * 1000)
+        with self.assertRaises(CompressionError):
+            decompress_payload(payload, max_size=999)
+        with self.assertRaises(CompressionError):
+            decompress_payload(payload[:-1])
+        with self.assertRaises(CompressionError):
+            StreamDecompressor(max_size=999)(StreamCompressor()(b'x' * 1000))
+        with self.assertRaises(CompressionError):
+            StreamDecompressor()(b'not deflate')
+
+    def test_payload_size(self):
+        self.assertEqual(parse_payload_size('12'), (12, False))
+        self.assertEqual(parse_payload_size(b'z12'), (12, True))
+        with self.assertRaises(ValueError):
+            parse_payload_size(b'z')
+
+
+class TestCompressedMessage(unittest.TestCase):
+
+    def test_compressed_once_for_all_recipients(self):
+        compress = CountingCompressor()
+        msg = PayloadMessage('CMS', ['1', 'user1'], TEXT)
+        data = msg.as_bytes(PROTOCOL_V2, compress)
+        self.assertEqual(msg.as_bytes(PROTOCOL_V2, compress), data)
+        self.assertEqual(compress.calls, 1)
+        size = len(msg.deflated)
+        self.assertTrue(data.startswith(b'CMS 1 user1 z%d||' % size))
+        self.assertEqual(decompress_payload(data[data.index(b'||') + 2:-3]), TEXT.encode('utf-8'))
+
+    def test_not_compressed(self):
+        compress = CountingCompressor()
+        # protocol v1, small payload
+        self.assertEqual(PayloadMessage('MSG', ['user1'], TEXT).as_bytes(PROTOCOL_V1, compress),
+                         PayloadMessage('MSG', ['user1'], TEXT).as_bytes(PROTOCOL_V1))
+        self.assertEqual(PayloadMessage('MSG', ['user1'], 'ping').as_bytes(PROTOCOL_V2, compress),
+                         b'MSG user1 4||ping..\n')
+        self.assertEqual(compress.calls, 0)
+        # incompressible payload is sent as it is
+        payload = bytes(range(256)) * (PAYLOAD_COMPRESS_MIN // 256)
+        data = PayloadMessage('MSG', ['user1'], payload).as_bytes(PROTOCOL_V2, compress)
+        self.assertEqual(compress.calls, 1)
+        self.assertTrue(data.startswith(b'MSG user1 %d||' % len(payload)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 import logging
+import re
 
-from protocol.messages import Message, NormalMessage, PayloadMessage, ErrorMessage, ParseError
-from protocol.messages import NORMAL_CMDS, PAYLOAD_CMDS, ERROR_CMDS, CMDS
+from protocol.compression import CompressionError, parse_payload_size
+from protocol.messages import Message, NormalMessage, PayloadMessage, ErrorMessage, ServiceMessage, ParseError
+from protocol.messages import NORMAL_CMDS, PAYLOAD_CMDS, ERROR_CMDS, SERVICE_CMDS, PROTOCOL_V1
 
 
 log = logging.getLogger(__name__)
@@ -11,60 +13,223 @@ class UnknownCommand(Exception):
     pass
 
 
-class DataBuffer:
+# end of frame header in protocol v2: payload follows SPLIT_SEQUENCE, normal frames end with TERM_SEQUENCE
+HEADER_END = re.compile(re.escape(Message.SPLIT_SEQUENCE) + b'|' + re.escape(Message.TERM_SEQUENCE))
+
 
-    def __init__(self):
-        self._data = b""
+class DataBuffer:
+    """
+    Accumulates received bytes and splits them into frames.
+
+    Protocol v1 frames end with TERM_SEQUENCE. In protocol v2 payload frames are
+    `HEADER<SPLIT_SEQUENCE><PAYLOAD_SIZE bytes><TERM_SEQUENCE>`, payload isn't scanned.
+
+    Search is resumed where the previous push stopped, so every byte is scanned once.
+    Frames are returned as memoryview slices of the buffer, consumed bytes are
+    dropped lazily on the next push.
+
+    Data can be received right into the buffer: reserve() returns free space for
+    socket.recv_into, commit() accounts received bytes and splits frames.
+    The storage is reused while received data fits in it, it is never resized in place
+    as frames returned earlier may still be exported, it's replaced with a new one instead.
+    """
+
+    def __init__(self, version=PROTOCOL_V1):
+        self.version = version
+        self._data = bytearray()
+        self._start = 0  # beginning of not consumed data
+        self._end = 0  # end of received data, the rest of the storage is free
+        self._scan = 0  # position to resume search from
+        self._payload_end = None  # v2: end of payload of the current frame
 
     def __repr__(self):
-        return "DataBuffer:{data_buffer})".format(data_buffer=self._data)
+        return "DataBuffer:{data_buffer})".format(data_buffer=self.data)
 
     @property
     def data(self):
-        return self._data
+        return bytes(self._data[self._start:self._end])
 
-    def push(self, data):
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    @property
+    def missing(self):
+        """
+        v2: number of bytes missing to complete the frame being received, 0 if frame size isn't known yet
+        """
+        if self._payload_end is None:
+            return 0
+        return max(0, self._payload_end + len(Message.TERM_SEQUENCE) - self._end)
+
+    def reserve(self, size):
+        """
+        Make room for at least `size` bytes after received data.
+        Frames returned earlier may be overwritten.
+        :param size: number of bytes
+        :return: writable memoryview of the free space, see commit()
+        """
+        pending = self._end - self._start
+        if not pending and len(self._data) > 2 * size:
+            # big frames are over, release grown storage
+            self._data = bytearray(size)
+            self._rebase()
+        elif len(self._data) - self._end < size or (self._start and not pending):
+            if pending + size <= len(self._data):
+                # slice assignment of the same size doesn't resize exported storage
+                self._data[:pending] = self._data[self._start:self._end]
+            else:
+                # grow geometrically, so frames received in small pieces are copied O(1) times per byte
+                data = bytearray(max(pending + size, 2 * pending))
+                data[:pending] = self._data[self._start:self._end]
+                self._data = data
+            self._rebase()
+        return memoryview(self._data)[self._end:]
+
+    def _rebase(self):
         """
-        Put data in buffers and returns list of bytes strings to parse
+        Move positions after not consumed data is moved to the beginning of the storage
         """
+        self._end -= self._start
+        self._scan -= self._start
+        if self._payload_end is not None:
+            self._payload_end -= self._start
+        self._start = 0
+
+    def commit(self, size):
+        """
+        Account `size` bytes received into reserved space and returns list of frames (memoryview objects) to parse.
+        Frames are valid until the next reserve/push/flush call.
+        """
+        self._end += size
         raw_messages = []
-        if data == b'\n':
-            return raw_messages  # ignore single newline symbols
-        self._data += data
-        log.info("Got {data} in data buffer".format(data=self._data))
-        if Message.TERM_SEQUENCE in self._data:
-            split_data = self._data.split(Message.TERM_SEQUENCE)
-            self._data = split_data[-1]
-            raw_messages = split_data[:-1]
+        if self.version == PROTOCOL_V1:
+            self._split_by_term(raw_messages)
+        else:
+            self._split_by_size(raw_messages)
         return raw_messages
 
+    def push(self, data):
+        """
+        Put data in buffers and returns list of frames (memoryview objects) to parse.
+        Frames are valid until the next reserve/push/flush call.
+        """
+        if data == b'\n' and self.version == PROTOCOL_V1:
+            return []  # ignore single newline symbols
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Got %d bytes in data buffer", len(data))
+        size = len(data)
+        with self.reserve(size) as free:
+            free[:size] = data
+        return self.commit(size)
+
+    def _split_by_term(self, raw_messages):
+        term_len = len(Message.TERM_SEQUENCE)
+        view = None
+        while True:
+            pos = self._data.find(Message.TERM_SEQUENCE, self._scan, self._end)
+            if pos < 0:
+                # last byte may be the beginning of TERM_SEQUENCE
+                self._scan = max(self._start, self._end - term_len + 1)
+                break
+            if view is None:
+                view = memoryview(self._data)
+            raw_messages.append(view[self._start:pos])
+            self._start = self._scan = pos + term_len
+
+    def _split_by_size(self, raw_messages):
+        term_len = len(Message.TERM_SEQUENCE)
+        view = memoryview(self._data)
+        while True:
+            if self._payload_end is None:
+                match = HEADER_END.search(self._data, self._scan, self._end)
+                if not match:
+                    # both separators are 2 bytes long, last byte may be the beginning of one
+                    self._scan = max(self._start, self._end - 1)
+                    break
+                if match.group() == Message.TERM_SEQUENCE:
+                    raw_messages.append(view[self._start:match.start()])
+                    self._start = self._scan = match.end()
+                    continue
+                header = bytes(view[self._start:match.start()])
+                try:
+                    payload_size, _ = parse_payload_size(header.rsplit(Message.SEPARATOR_SYMBOL, 1)[-1])
+                    if payload_size < 0:
+                        raise ValueError(payload_size)
+                except ValueError:
+                    self.flush()
+                    raise ParseError("Invalid payload size in header", header)
+                self._payload_end = match.end() + payload_size
+
+            frame_end = self._payload_end + term_len
+            if self._end < frame_end:
+                self._scan = self._start
+                break
+            if view[self._payload_end:frame_end] != Message.TERM_SEQUENCE:
+                self.flush()
+                raise ParseError("Payload is not followed by TERM_SEQUENCE")
+            raw_messages.append(view[self._start:self._payload_end])
+            self._start = self._scan = frame_end
+            self._payload_end = None
+
     def flush(self):
-        self._data = b""
+        self._data = bytearray()
+        self._start = 0
+        self._end = 0
+        self._scan = 0
+        self._payload_end = None
+
+
+# codes of bytes.strip() whitespaces
+WHITESPACE = frozenset(b' \t\n\r\x0b\x0c')
+
+# frame parser by the raw 3 bytes command
+FRAME_PARSERS = {}
+FRAME_PARSERS.update((cmd.encode('utf-8'), NormalMessage.from_bytes) for cmd in NORMAL_CMDS)
+FRAME_PARSERS.update((cmd.encode('utf-8'), PayloadMessage.from_bytes) for cmd in PAYLOAD_CMDS)
+FRAME_PARSERS.update((cmd.encode('utf-8'), ErrorMessage.from_bytes) for cmd in ERROR_CMDS)
+FRAME_PARSERS.update((cmd.encode('utf-8'), ServiceMessage.from_bytes) for cmd in SERVICE_CMDS)
 
 
 class DataParser:
 
-    def __init__(self):
-        pass
+    def __init__(self, version=PROTOCOL_V1, opaque_payloads=False, decompress=None):
+        self.version = version
+        # payloads are left as memoryview slices of received frames (server forwards them as they are)
+        self.opaque_payloads = opaque_payloads
+        # callable decompressing payloads of compressed frames, set once compression is enabled,
+        # see protocol.compression
+        self.decompress = decompress
 
     def parse(self, data):
         """
-        Parse bytes data to Message
+        Parse bytes data to Message.
+        Frame isn't decoded as a whole: parser is picked by the raw command, fields are split as bytes
+        and decoded one by one
         """
-        log.info("Parsing {data}".format(data=data))
-        assert Message.TERM_SEQUENCE not in data
-        data = data.decode('utf-8').strip()
-        cmd = data[:3]
-
-        if cmd in NORMAL_CMDS:
-            msg = NormalMessage.from_string(data)
-        elif cmd in PAYLOAD_CMDS:
-            msg = PayloadMessage.from_string(data)
-        elif cmd in ERROR_CMDS:
-            msg = ErrorMessage.from_string(data)
+        if self.version == PROTOCOL_V1:
+            data = bytes(data).strip()
+            assert data.find(Message.TERM_SEQUENCE) < 0  # 'in' is twice as slow for short needles
+        elif data and data[0] in WHITESPACE:
+            # new line after the previous frame is skipped before the frame is copied out of the buffer,
+            # payload may end with whitespaces
+            start = 1
+            while start < len(data) and data[start] in WHITESPACE:
+                start += 1
+            data = bytes(memoryview(data)[start:])
         else:
-            if cmd not in CMDS:
-                raise UnknownCommand(cmd)
-            else:
-                raise ParseError(cmd, data)
+            data = bytes(data)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Parsing %r", data)
+        try:
+            from_bytes = FRAME_PARSERS[data[:3]]
+        except KeyError:
+            raise UnknownCommand(data[:3].decode('utf-8', 'replace'))
+        msg = from_bytes(data, self.version, self.opaque_payloads)
+        if type(msg) is PayloadMessage and msg.compressed:
+            if self.decompress is None:
+                raise CompressionError("Compressed frame while compression is disabled")
+            payload = self.decompress(msg.payload)
+            msg.payload = payload if self.opaque_payloads else str(payload, 'utf-8')
+            msg.compressed = False
         return msg
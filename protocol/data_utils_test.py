@@ -1,5 +1,8 @@
 import unittest
-from server.data_utils import DataBuffer
+from protocol.compression import CompressionError, StreamCompressor, StreamDecompressor
+from protocol.data_utils import DataBuffer, DataParser, UnknownCommand
+from protocol.messages import PayloadMessage, NormalMessage, ServiceMessage, ErrorMessage, ParseError, UnsafePayload, \
+    PROTOCOL_V2
 
 
 class TestDataBuffer(unittest.TestCase):
@@ -14,7 +17,7 @@ class TestDataBuffer(unittest.TestCase):
         piece = b'AAA..'
 
         dlist = self.data_buffer.push(piece)
-        self.assertEqual(b'', self.data_buffer.data_buffer,
+        self.assertEqual(b'', self.data_buffer.data,
                          msg="Buffer should be empty")
         self.assertListEqual(dlist, [b'AAA', ])
 
@@ -24,10 +27,10 @@ class TestDataBuffer(unittest.TestCase):
 
         dlist = self.data_buffer.push(piece1)
         self.assertListEqual(dlist, [])
-        self.assertEqual(b'AA', self.data_buffer.data_buffer,
+        self.assertEqual(b'AA', self.data_buffer.data,
                          msg="Buffer should contains b'AA'")
         dlist = self.data_buffer.push(piece2)
-        self.assertEqual(b'', self.data_buffer.data_buffer,
+        self.assertEqual(b'', self.data_buffer.data,
                          msg="Buffer should be empty")
         self.assertListEqual(dlist, [b'AAA', ])
 
@@ -41,12 +44,12 @@ class TestDataBuffer(unittest.TestCase):
             self.assertListEqual(dlist, [])
             expected += piece
             self.assertEqual(expected,
-                             self.data_buffer.data_buffer,
+                             self.data_buffer.data,
                              msg="Buffer should contains {expected}".format(expected=expected))
 
         # push the last one
         dlist = self.data_buffer.push(pieces[-1])
-        self.assertEqual(b'', self.data_buffer.data_buffer,
+        self.assertEqual(b'', self.data_buffer.data,
                          msg="Buffer should be empty")
         self.assertListEqual(dlist, [b'AAA', ])
 
@@ -54,7 +57,7 @@ class TestDataBuffer(unittest.TestCase):
         piece = b'AAA..BBBBB..'
 
         dlist = self.data_buffer.push(piece)
-        self.assertEqual(b'', self.data_buffer.data_buffer,
+        self.assertEqual(b'', self.data_buffer.data,
                          msg="Buffer should be empty")
         self.assertListEqual(dlist, [b'AAA', b'BBBBB'])
 
@@ -62,7 +65,7 @@ class TestDataBuffer(unittest.TestCase):
         piece = b'AAA..11111..       ..$$$$$..```..'
 
         dlist = self.data_buffer.push(piece)
-        self.assertEqual(b'', self.data_buffer.data_buffer,
+        self.assertEqual(b'', self.data_buffer.data,
                          msg="Buffer should be empty")
         self.assertListEqual(dlist, [b'AAA', b'11111', b'       ', b'$$$$$', b'```'])
 
@@ -89,7 +92,7 @@ class TestDataBuffer(unittest.TestCase):
         for piece, exp in zip(pieces, expected):
             dlist = self.data_buffer.push(piece)
             self.assertEqual(exp[0],
-                             self.data_buffer.data_buffer,
+                             self.data_buffer.data,
                              msg="Buffer should contains {expected}".format(expected=exp))
             self.assertListEqual(dlist, exp[1])
 
@@ -98,7 +101,7 @@ class TestDataBuffer(unittest.TestCase):
         piece = b'\n'
         for i in range(5):
             dlist = self.data_buffer.push(piece)
-            self.assertEqual(b'', self.data_buffer.data_buffer,
+            self.assertEqual(b'', self.data_buffer.data,
                              msg="Buffer should be empty")
             self.assertListEqual(dlist, [])
 
@@ -112,11 +115,168 @@ class TestDataBuffer(unittest.TestCase):
         for piece, exp_buf, exp_mlist in pieces_and_results:
             dlist = self.data_buffer.push(piece)
             self.assertEqual(exp_buf,
-                             self.data_buffer.data_buffer,
+                             self.data_buffer.data,
                              msg="Buffer should contains {expected}".format(expected=exp_buf))
             self.assertListEqual(dlist, exp_mlist)
             self.data_buffer.flush()
 
+    def test_big_msg_in_small_pieces(self):
+        payload = b'x' * 100000
+        data = payload + b'..' + b'tail'
+        dlist = []
+        for pos in range(0, len(data), 1024):
+            dlist += [bytes(msg) for msg in self.data_buffer.push(data[pos:pos + 1024])]
+        self.assertListEqual(dlist, [payload])
+        self.assertEqual(b'tail', self.data_buffer.data)
+
+    def test_returned_frames_survive_next_push(self):
+        # frames are slices of the buffer, next push must not corrupt or fail on them
+        first = self.data_buffer.push(b'AAA..BB')
+        second = self.data_buffer.push(b'B..' + b'C' * 4096)
+        self.assertListEqual(first, [b'AAA'])
+        self.assertListEqual(second, [b'BBB'])
+        self.assertEqual(b'C' * 4096, self.data_buffer.data)
+
+    def test_receive_into_reserved_space(self):
+        free = self.data_buffer.reserve(16)
+        self.assertGreaterEqual(len(free), 16)
+        free[:7] = b'AAA..BB'
+        self.assertListEqual(self.data_buffer.commit(7), [b'AAA'])
+        storage = self.data_buffer._data
+        free = self.data_buffer.reserve(8)
+        free[:3] = b'B..'
+        self.assertListEqual(self.data_buffer.commit(3), [b'BBB'])
+        # storage is reused, not consumed bytes are moved to its beginning
+        self.assertIs(self.data_buffer._data, storage)
+        self.assertEqual(b'', self.data_buffer.data)
+
+    def test_reserved_space_grows(self):
+        frames = self.data_buffer.push(b'AAA..' + b'B' * 10)
+        free = self.data_buffer.reserve(1000)
+        self.assertGreaterEqual(len(free), 1000)
+        free[:2] = b'..'
+        self.assertListEqual(self.data_buffer.commit(2), [b'B' * 10])
+        self.assertListEqual(frames, [b'AAA'])  # frames of the previous storage are intact
+        self.data_buffer.reserve(100)
+        self.assertEqual(self.data_buffer.capacity, 100)  # released as nothing is pending
+
+
+class TestDataBufferV2(unittest.TestCase):
+
+    def setUp(self):
+        self.data_buffer = DataBuffer(PROTOCOL_V2)
+        self.data_parser = DataParser(PROTOCOL_V2)
+
+    def push_and_parse(self, data):
+        return [self.data_parser.parse(frame) for frame in self.data_buffer.push(data)]
+
+    def test_payload_with_separators(self):
+        msg = PayloadMessage('MSG', ['user1'], 'a..b||c ..')
+        self.assertListEqual(self.push_and_parse(msg.as_bytes(PROTOCOL_V2)), [msg])
+        # trailing new line becomes a part of the next frame header
+        self.assertEqual(b'\n', self.data_buffer.data)
+
+    def test_payload_size_is_in_bytes(self):
+        msg = PayloadMessage('MSG', ['user1'], 'привет..')
+        data = msg.as_bytes(PROTOCOL_V2)
+        self.assertTrue(data.startswith(b'MSG user1 14||'))
+        self.assertListEqual(self.push_and_parse(data), [msg])
+
+    def test_mixed_frames_byte_by_byte(self):
+        msgs = [NormalMessage('USR', ['user1', 'pass1']),
+                PayloadMessage('MSG', ['user2'], '..\n..'),
+                PayloadMessage('CMS', ['1'], ''),
+                NormalMessage('OUT')]
+        data = b''.join(msg.as_bytes(PROTOCOL_V2) for msg in msgs)
+        parsed = []
+        for pos in range(len(data)):
+            parsed += self.push_and_parse(data[pos:pos + 1])
+        self.assertListEqual(parsed, msgs)
+
+    def test_single_new_line_in_payload(self):
+        parsed = self.push_and_parse(b'MSG user1 3||a')
+        parsed += self.push_and_parse(b'\n')
+        parsed += self.push_and_parse(b'b..')
+        self.assertListEqual(parsed, [PayloadMessage('MSG', ['user1'], 'a\nb')])
+
+    def test_missing_bytes_of_frame(self):
+        self.assertEqual(self.data_buffer.missing, 0)
+        self.data_buffer.push(b'MSG user1 1000||abc')
+        self.assertEqual(self.data_buffer.missing, 999)
+        free = self.data_buffer.reserve(self.data_buffer.missing)
+        free[:999] = b'x' * 997 + b'..'
+        frames = self.data_buffer.commit(999)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(self.data_buffer.missing, 0)
+
+    def test_invalid_payload_size(self):
+        with self.assertRaises(ParseError):
+            self.data_buffer.push(b'MSG user1 abc||payload..')
+        self.assertEqual(b'', self.data_buffer.data)
+
+    def test_payload_without_term_sequence(self):
+        with self.assertRaises(ParseError):
+            self.data_buffer.push(b'MSG user1 2||abcd..')
+
+
+class TestDataParser(unittest.TestCase):
+
+    def test_frames(self):
+        parser = DataParser()
+        msg = parser.parse(memoryview(b' USR user1 pass1 \n'))
+        self.assertEqual((msg.cmd, msg.params), ('USR', ['user1', 'pass1']))
+        msg = parser.parse(b'OUT')
+        self.assertEqual((msg.cmd, msg.params), ('OUT', []))
+        msg = parser.parse(b'MSG user2 6||\xd0\xbf\xd1\x80\xd0\xb8\xd0\xb2\xd0\xb5\xd1\x82')
+        self.assertEqual(msg, PayloadMessage('MSG', ['user2'], 'привет'))
+        msg = parser.parse(b'SRV PROFILE 5')
+        self.assertIsInstance(msg, ServiceMessage)
+        self.assertEqual(msg.params, ['PROFILE', '5'])
+        self.assertIsInstance(parser.parse(b'ERR whatever'), ErrorMessage)
+        with self.assertRaises(UnknownCommand):
+            parser.parse(b'XYZ 1')
+
+    def test_opaque_payload(self):
+        frame = 'MSG user2 12||привет'.encode('utf-8')
+        msg = DataParser(PROTOCOL_V2, opaque_payloads=True).parse(frame)
+        self.assertIsInstance(msg.payload, memoryview)
+        self.assertEqual(bytes(msg.payload), 'привет'.encode('utf-8'))
+        # payload size is in characters for protocol v1
+        self.assertEqual(msg.as_bytes(), 'MSG user2 6||привет..\n'.encode('utf-8'))
+        self.assertEqual(msg.as_bytes(PROTOCOL_V2), 'MSG user2 12||привет..\n'.encode('utf-8'))
+        msg = DataParser(opaque_payloads=True).parse('MSG user2 6||привет'.encode('utf-8'))
+        self.assertEqual(bytes(msg.payload), 'привет'.encode('utf-8'))
+
+    def test_compressed_frames(self):
+        compress = StreamCompressor()
+        text = 'see you at the station at five, ' * 20
+        msgs = [PayloadMessage('MSG', ['user2'], text), PayloadMessage('MSG', ['user2'], 'ping'),
+                PayloadMessage('MSG', ['user2'], text)]
+        data = b''.join(msg.as_bytes(PROTOCOL_V2, compress) for msg in msgs)
+        self.assertTrue(data.startswith(b'MSG user2 z'))
+        self.assertLess(len(data), len(text))
+
+        data_buffer = DataBuffer(PROTOCOL_V2)
+        parser = DataParser(PROTOCOL_V2, opaque_payloads=True, decompress=StreamDecompressor())
+        parsed = [parser.parse(frame) for frame in data_buffer.push(data)]
+        self.assertEqual([bytes(msg.payload) for msg in parsed], [msg.payload.encode('utf-8') for msg in msgs])
+        self.assertFalse(parsed[0].compressed)
+
+        with self.assertRaises(CompressionError):
+            DataParser(PROTOCOL_V2).parse(msgs[0].as_bytes(PROTOCOL_V2, StreamCompressor()).rstrip()[:-2])
+
+    def test_unsafe_v1_payload(self):
+        for payload in ['one..ERR injected', 'the end.', b'one..two', memoryview(b'one..two')]:
+            msg = PayloadMessage('MSG', ['user2'], payload)
+            with self.assertRaises(UnsafePayload):
+                msg.as_chunks()
+            msg.as_chunks(PROTOCOL_V2)
+        self.assertEqual(PayloadMessage('MSG', ['user2'], 'one.two').as_bytes(), b'MSG user2 7||one.two..\n')
+
+    def test_messages_have_no_dict(self):
+        for msg in [NormalMessage('OUT'), PayloadMessage('MSG', [], ''), ErrorMessage(), ServiceMessage()]:
+            self.assertFalse(hasattr(msg, '__dict__'))
+
 
 if __name__ == '__main__':
     unittest.main()
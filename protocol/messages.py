@@ -1,5 +1,7 @@
 import logging
 
+from protocol.compression import COMPRESSED_SIZE_PREFIX, PAYLOAD_COMPRESS_MIN, parse_payload_size
+
 
 """
 All messages should start with 3 letter command name
@@ -13,6 +15,7 @@ All messages should start with 3 letter command name
 - ACK - acknowledgement message - [client >> server][server >> client]    
 - ACH - Add new participants to existent chat [client >> server]
 - GCH - Get list of available chats[clint >> server]
+- VER - negotiate protocol version, right after connect - [client >> server][server >> client]
 
 ##### PAYLOAD MESSAGES
 - MSG - send message with payload - [client >> server][server >> client]
@@ -23,16 +26,40 @@ All messages should start with 3 letter command name
 - ERR - error response
 
 ##### SERVICE MESSAGES
-- SRV - server info
+- SRV - runtime metrics of the server, reply is 'INF SRV <payload size>||<JSON>' - [client >> server]
+        'SRV PROFILE [seconds]' and 'SRV MEMORY [seconds]' (admin users only) start cProfile or tracemalloc capture,
+        dumped to the log directory of the server, reply is 'INF SRV PROFILE|MEMORY <payload size>||<JSON>'
+
+##### PROTOCOL VERSIONS
+- 1 - frames end with TERM_SEQUENCE, payload can't contain it (nor end with '.'): such messages
+      of v2 clients are sent to v2 recipients only, v1 users don't get them (live or replayed)
+- 2 - payload frames are read by PAYLOAD_SIZE (bytes) from header, payload is opaque.
+      Client sends 'VER 2' right after connect and waits for 'VER <version>' reply
+      before sending anything else.
+      MSG and CMS frames sent by server carry message id as the last param,
+      client confirms delivery with 'ACK <id>' (personal messages) or 'ACK <chat_id> <id>' (chat messages),
+      unconfirmed messages are sent again after the next login.
+      Server sends status changes of several users in one frame: 'CHG <name> <status> [<name> <status> ...]'.
+      'USR <name> <password> ZLIB' enables payload compression for the rest of the connection,
+      PAYLOAD_SIZE of compressed payloads is 'z<size>', see protocol.compression.
 
 """
 
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOL_VERSIONS = [PROTOCOL_V1, PROTOCOL_V2]
+
+# opaque payloads (bytes) of this size and bigger are sent as a separate chunk referencing them,
+# smaller ones are copied into the frame, see PayloadMessage.as_chunks
+PAYLOAD_CHUNK_MIN = 4096
+
 CMD_LOGIN = 'USR'
 CMD_LOGOUT = 'OUT'
 CMD_ADD_CONTACT = 'ADD'
 CMD_FRIENDS = 'FRD'
 CMD_CHANGE_STATUS = 'CHG'
 CMD_MSG_ACK = 'ACK'
+CMD_VERSION = 'VER'
 
 CMD_INFO = 'INF'
 CMD_MESSAGE = 'MSG'
@@ -46,6 +73,9 @@ CMD_CREATE_CHAT = 'CCH'
 CMD_ERROR = 'ERR'
 
 CMD_SERVICE = 'SRV'
+# SRV requests of profiling captures
+SERVICE_PROFILE = 'PROFILE'
+SERVICE_MEMORY = 'MEMORY'
 
 NORMAL_CMDS = [CMD_LOGIN,
                CMD_LOGOUT,
@@ -55,7 +85,8 @@ NORMAL_CMDS = [CMD_LOGIN,
                CMD_MSG_ACK,
                CMD_ADD_CHAT_PARTICIPANT,
                CMD_GET_CHATS,
-               CMD_CREATE_CHAT
+               CMD_CREATE_CHAT,
+               CMD_VERSION,
                ]
 
 PAYLOAD_CMDS = [CMD_MESSAGE,
@@ -80,8 +111,45 @@ class UnknownCommand(Exception):
     pass
 
 
+class UnsafePayload(Exception):
+    """
+    Payload can't be sent with protocol v1, see v1_safe_payload
+    """
+    pass
+
+
+def payload_length(payload):
+    """
+    Size of UTF-8 encoded payload in characters (protocol v1)
+    :param payload: bytes-like object
+    :return: int
+    """
+    # bytes.isascii and decoding are C loops, regex search for non-ASCII bytes is ~100 times slower
+    if type(payload) is bytes and payload.isascii():
+        return len(payload)
+    return len(str(payload, 'utf-8'))
+
+
+def v1_safe_payload(payload):
+    """
+    Protocol v1 frame ends with the first TERM_SEQUENCE: payload containing it (or ending with its first symbol)
+    would end the frame early and the rest of it would be parsed as frames chosen by the sender
+    :param payload: str or bytes-like object
+    :return: bool
+    """
+    if isinstance(payload, str):
+        term = Message.TERM_SEQUENCE_STR
+    else:
+        term = Message.TERM_SEQUENCE
+        if type(payload) is not bytes:
+            payload = bytes(payload)
+    return term not in payload and not payload.endswith(term[:1])
+
+
 class Message:
 
+    __slots__ = ('tr_id',)
+
     SEPARATOR_SYMBOL = b' '
     SEPARATOR_SYMBOL_STR = ' '
 
@@ -94,9 +162,16 @@ class Message:
     def __init__(self, transaction_id=None):
         self.tr_id = transaction_id
 
-    def as_bytes(self):
+    def as_bytes(self, version=PROTOCOL_V1):
         raise NotImplementedError()
 
+    def as_chunks(self, version=PROTOCOL_V1, compress=None):
+        """
+        :param compress: payload compressor of the connection (protocol.compression), None if it's disabled
+        :return: list of bytes-like objects to be written one after another
+        """
+        return [self.as_bytes(version)]
+
 
 class NormalMessage(Message):
     """
@@ -104,10 +179,12 @@ class NormalMessage(Message):
     CMD TR_ID PARAM_1 PARAM_2 PARAM_N<TERM_SEQUENCE>
     """
 
+    __slots__ = ('cmd', 'params')
+
     def __init__(self, cmd, params=None, transaction_id=None):
         self.cmd = cmd
         self.params = params if params else []
-        super().__init__(transaction_id)
+        self.tr_id = transaction_id
 
     def __repr__(self):
         return "NormalMessage(cmd: %s, params: %s)" % (self.cmd, self.params)
@@ -120,13 +197,8 @@ class NormalMessage(Message):
         else:
             return False
 
-    def as_bytes(self):
-        msg_template = "{cmd} {params}{term_seq}\n"
-        msg = msg_template.format(cmd=self.cmd,
-                                  params=' '.join(self.params),
-                                  term_seq=self.TERM_SEQUENCE_STR)
-        msg = msg.encode('utf-8')
-        return msg
+    def as_bytes(self, version=PROTOCOL_V1):
+        return (self.cmd + ' ' + ' '.join(self.params) + '..\n').encode('utf-8')
 
     @staticmethod
     def from_string(str_msg):
@@ -138,23 +210,41 @@ class NormalMessage(Message):
 
         return NormalMessage(cmd, params, transaction_id)
 
+    @staticmethod
+    def from_bytes(data, version=PROTOCOL_V1, opaque_payload=False):
+        """
+        :param data: stripped frame without TERM_SEQUENCE
+        """
+        splitted = str(data.rstrip(), 'utf-8').split(Message.SEPARATOR_SYMBOL_STR)
+        return NormalMessage(splitted[0], splitted[1:], 0)
+
 
 class PayloadMessage(Message):
     """
     Template:
     CMD TR_ID PARAM_1 PARAM_2 PARAM_N PAYLOAD_SIZE<SPLIT_SEQUENCE>
     <---------------   PAYLOAD   -----------------><TERM_SEQUENCE>
+
+    Payload is str or opaque bytes-like object (server forwards payloads as they were received,
+    see DataParser), the latter is never decoded for protocol v2.
+    Payload of a frame parsed by from_bytes may be compressed, DataParser decompresses it.
     """
 
-    def __init__(self, cmd, params, payload, transaction_id=None):
+    __slots__ = ('cmd', 'params', 'payload', 'msg_id', 'compressed', 'deflated')
+
+    def __init__(self, cmd, params, payload, transaction_id=None, msg_id=None):
         self.cmd = cmd
         self.params = params
         self.payload = payload
-        super().__init__(transaction_id)
+        self.msg_id = msg_id  # id of saved message, sent as the last param in protocol v2
+        self.tr_id = transaction_id
+        self.compressed = False  # payload is compressed data of a received frame
+        self.deflated = None  # payload compressed by a shared compressor, reused for all recipients
 
     def __repr__(self):
+        payload = bytes(self.payload) if isinstance(self.payload, memoryview) else self.payload
         return "PayloadMessage(cmd: {cmd}, params: {params}, payload: {payload})".format(
-            cmd=self.cmd, params=self.params, payload=self.payload)
+            cmd=self.cmd, params=self.params, payload=payload)
 
     def __eq__(self, other):
         if (isinstance(other, PayloadMessage) and
@@ -165,32 +255,98 @@ class PayloadMessage(Message):
         else:
             return False
 
-    def as_bytes(self):
-        msg_template = "{cmd} {params} {payload_size}{split_seq}{payload}{term_seq}\n"
-        msg = msg_template.format(cmd=self.cmd,
-                                  params=' '.join(str(param) for param in self.params),
-                                  payload_size=len(self.payload),
-                                  split_seq=self.SPLIT_SEQUENCE_STR,
-                                  payload=self.payload,
-                                  term_seq=self.TERM_SEQUENCE_STR)
-        msg = msg.encode('utf-8')
-        return msg
+    def as_bytes(self, version=PROTOCOL_V1, compress=None):
+        chunks = self.as_chunks(version, compress)
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+    def as_chunks(self, version=PROTOCOL_V1, compress=None):
+        """
+        Big opaque payload isn't copied: frame is header, payload itself and TERM_SEQUENCE.
+        Payloads of PAYLOAD_COMPRESS_MIN bytes and bigger are compressed if `compress` is given (protocol v2 only),
+        result of a shared compressor is kept, so the message is compressed once for all recipients.
+        Raises UnsafePayload if payload can't be framed with protocol v1.
+        """
+        payload = self.payload
+        opaque = isinstance(payload, (bytes, memoryview))
+        size_prefix = ''
+        if version == PROTOCOL_V1:
+            if not v1_safe_payload(payload):
+                raise UnsafePayload(self.cmd, self.params)
+            if not opaque:
+                payload = str(payload)
+                return [('%s %s %d||%s..\n' % (self.cmd, ' '.join(map(str, self.params)), len(payload),
+                                                payload)).encode('utf-8')]
+            params = self.params
+            payload_size = payload_length(payload)
+        else:
+            if not opaque:
+                payload = str(payload).encode('utf-8')
+            params = self.params if self.msg_id is None else self.params + [self.msg_id]
+            payload_size = len(payload)
+            if compress is not None and payload_size >= PAYLOAD_COMPRESS_MIN:
+                deflated = self.deflated if compress.shared else None
+                if deflated is None:
+                    deflated = compress(payload)
+                    if compress.shared:
+                        self.deflated = deflated
+                # output of a stream compressor is sent anyway, it's a part of the connection stream
+                if len(deflated) < payload_size or not compress.shared:
+                    payload, payload_size, size_prefix = deflated, len(deflated), COMPRESSED_SIZE_PREFIX
+        header = ('%s %s %s%d||' % (self.cmd, ' '.join(map(str, params)), size_prefix, payload_size)).encode('utf-8')
+        if payload_size < PAYLOAD_CHUNK_MIN:
+            return [b''.join([header, payload, b'..\n'])]
+        return [header, payload, b'..\n']
 
     @staticmethod
-    def from_string(str_msg):
-        service_part, payload = str_msg.split(Message.SPLIT_SEQUENCE_STR)
+    def from_string(str_msg, version=PROTOCOL_V1):
+        service_part, payload = str_msg.split(Message.SPLIT_SEQUENCE_STR, 1)
         service_part_splitted = service_part.split(Message.SEPARATOR_SYMBOL_STR)
         cmd = service_part_splitted[0]
         params = service_part_splitted[1:-1]
         payload_size = int(service_part_splitted[-1])
 
-        if len(payload) != payload_size:
+        actual_size = len(payload) if version == PROTOCOL_V1 else len(payload.encode('utf-8'))
+        if actual_size != payload_size:
             log.warning("Payload({payload}) size is not as expected: act:{act} exp:{exp}".format(payload=payload,
-                                                                                                 act=len(payload),
+                                                                                                 act=actual_size,
                                                                                                  exp=payload_size))
 
         return PayloadMessage(cmd, params, payload)
 
+    @staticmethod
+    def from_bytes(data, version=PROTOCOL_V1, opaque_payload=False):
+        """
+        :param data: frame (bytes) without TERM_SEQUENCE, stripped (v1) or with leading whitespaces stripped (v2)
+        :param opaque_payload: payload is a memoryview of `data`, not decoded
+        """
+        split = data.index(Message.SPLIT_SEQUENCE)
+        header = str(data[:split], 'utf-8').split(Message.SEPARATOR_SYMBOL_STR)
+        try:
+            payload_size, compressed = int(header[-1]), False
+        except ValueError:
+            payload_size, compressed = parse_payload_size(header[-1])
+        if compressed:
+            # decompressed by DataParser with the context of the connection
+            payload = data[split + len(Message.SPLIT_SEQUENCE):]
+            if len(payload) != payload_size:
+                raise ParseError("Compressed payload size is not as expected", len(payload), payload_size)
+            msg = PayloadMessage(header[0], header[1:-1], payload)
+            msg.compressed = True
+            return msg
+        if opaque_payload:
+            payload = memoryview(data)[split + len(Message.SPLIT_SEQUENCE):]
+            actual_size = len(payload)
+            if version == PROTOCOL_V1 and actual_size != payload_size:
+                actual_size = len(str(payload, 'utf-8'))  # size is in characters, fewer than bytes if not ASCII
+        else:
+            payload = str(data[split + len(Message.SPLIT_SEQUENCE):], 'utf-8')
+            actual_size = len(payload) if version == PROTOCOL_V1 else len(data) - split - len(Message.SPLIT_SEQUENCE)
+        if actual_size != payload_size:
+            log.warning("Payload({payload}) size is not as expected: act:{act} exp:{exp}".format(payload=payload,
+                                                                                                 act=actual_size,
+                                                                                                 exp=payload_size))
+        return PayloadMessage(header[0], header[1:-1], payload)
+
 
 class ErrorMessage(Message):
     """
@@ -198,15 +354,17 @@ class ErrorMessage(Message):
     CMD TR_ID ERR_CODE<TERM_SEQUENCE>
     """
 
+    __slots__ = ('cmd', 'code')
+
     def __init__(self, transaction_id=None, cmd=CMD_ERROR, err_code='ERR_CODE'):
         self.cmd = cmd
         self.code = err_code  # temporarily used for error description
-        super().__init__(transaction_id)
+        self.tr_id = transaction_id
 
     def __repr__(self):
         return "ErrorMessage(cmd={cmd}, code={code})".format(cmd=self.cmd, code=self.code)
 
-    def as_bytes(self):
+    def as_bytes(self, version=PROTOCOL_V1):
         msg = "{cmd} {code}{term_seq}".format(cmd=self.cmd,
                                               code=self.code,
                                               term_seq=self.TERM_SEQUENCE_STR)
@@ -221,23 +379,31 @@ class ErrorMessage(Message):
         code = 0
         return ErrorMessage(tr_id, cmd, code)
 
+    @staticmethod
+    def from_bytes(data, version=PROTOCOL_V1, opaque_payload=False):
+        return ErrorMessage(0, data.split(Message.SEPARATOR_SYMBOL, 1)[0].decode('utf-8'), 0)
+
 
 class ServiceMessage(Message):
     """
     Template:
-    CMD TR_ID<TERM_SEQUENCE>
+    CMD PARAM_1 PARAM_N<TERM_SEQUENCE>
     """
 
-    def __init__(self, transaction_id=None, cmd=CMD_ERROR):
+    __slots__ = ('cmd', 'params')
+
+    def __init__(self, transaction_id=None, cmd=CMD_ERROR, params=None):
         self.cmd = cmd
-        super().__init__(transaction_id)
+        self.params = params if params else []
+        self.tr_id = transaction_id
 
     def __repr__(self):
-        return "ServiceMessage(cmd: %s)" % (self.cmd)
+        return "ServiceMessage(cmd: %s, params: %s)" % (self.cmd, self.params)
 
-    def as_bytes(self):
-        msg = "{cmd}{term_seq}".format(cmd=self.cmd,
-                                       term_seq=self.TERM_SEQUENCE_STR)
+    def as_bytes(self, version=PROTOCOL_V1):
+        msg = "{cmd}{params}{term_seq}".format(cmd=self.cmd,
+                                               params=''.join(self.SEPARATOR_SYMBOL_STR + str(p) for p in self.params),
+                                               term_seq=self.TERM_SEQUENCE_STR)
         msg = msg.encode('utf-8')
         return msg
 
@@ -246,7 +412,12 @@ class ServiceMessage(Message):
         splitted = str_msg.split(Message.SEPARATOR_SYMBOL_STR)
         tr_id = 0
         cmd = splitted[0]
-        return ServiceMessage(tr_id, cmd)
+        return ServiceMessage(tr_id, cmd, splitted[1:])
+
+    @staticmethod
+    def from_bytes(data, version=PROTOCOL_V1, opaque_payload=False):
+        splitted = str(data.rstrip(), 'utf-8').split(Message.SEPARATOR_SYMBOL_STR)
+        return ServiceMessage(0, splitted[0], splitted[1:])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,299 @@
+import asyncio
+import concurrent.futures
+import logging
+import sys
+import traceback
+
+from server.base_client import PRESENCE
+from server.client import Client
+from server.online import ONLINE_USERS
+from server.config import Config
+from server.db_executor import HandoverExecutor
+from server.metrics import METRICS, output_buffers
+from server.models.utils import MESSAGE_WRITER
+from server.profiler import PROFILER
+from protocol.messages import ErrorMessage
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+log = logging.getLogger(__name__)
+
+
+class TransportConnection:
+    """
+    Socket-like wrapper around asyncio transport, so Client can be reused as is.
+    Writes may come from the client worker thread, so they are handed over to the loop.
+    """
+
+    def __init__(self, transport, loop):
+        self.transport = transport
+        self.loop = loop
+        self._socket = transport.get_extra_info('socket')
+        self._peername = transport.get_extra_info('peername')
+
+    def getpeername(self):
+        return self._peername
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def send(self, data):
+        data = bytes(data)
+        self.loop.call_soon_threadsafe(self.transport.write, data)
+        return len(data)
+
+
+class MessProtocol(asyncio.Protocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.client = None
+        self.paused = False  # transport buffer is above the high watermark
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.server.config.write_high_watermark,
+                                          low=self.server.config.write_low_watermark)
+        self.client = Client(TransportConnection(transport, self.server.loop), self.server,
+                             db_executor=self.server.db)
+        self.server.register_client(self.client)
+
+    def data_received(self, data):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('got data from %s: %r', self.client.addr, data)
+        self.server.submit(self.client.recv, data)
+
+    def connection_lost(self, exc):
+        if exc:
+            log.info('connection to %s lost: %r', self.client.addr, exc)
+        self.server.unregister_client(self.client)
+
+    def pause_writing(self):
+        # client doesn't keep up with its output, stop reading from it until the buffer is drained
+        self.paused = True
+        self.client.writing_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        self.client.writing_paused = False
+        self.transport.resume_reading()
+        self.server.submit(self.client.on_writable)
+
+
+class AsyncMessServer:
+    """
+    asyncio based server engine, alternative to selectors based MessServer.
+
+    Event loop does network I/O only. Client handlers are executed in a single worker thread,
+    which keeps messages ordering. Blocking DB calls made by them (see Client.run_db) and
+    message commits run in DB threads with their own sessions, their callbacks are handed
+    back to the handlers thread (see server.db_executor.HandoverExecutor).
+    """
+
+    def __init__(self, port=9090, config=None, use_uvloop=True):
+        self.host = '127.0.0.1'
+        self.port = port
+        self.config = config if config else Config()
+        self.use_uvloop = use_uvloop
+        self.clients = {}  # dict {Client: MessProtocol transport}
+        self.loop = None
+        self.server = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.db = HandoverExecutor(self.submit_threadsafe, max_workers=self.config.db_workers)
+        self.flush_due = None  # loop time _flush_messages is scheduled at
+
+    def register_client(self, client):
+        """
+        Register new client
+        :param client: Client instance
+        :return: None
+        """
+        self.clients[client] = client.conn.transport
+        log.info("Register new client: %s", client.addr)
+
+    def unregister_client(self, client):
+        """
+        Delete client and log it out if needed
+        :param client: Client instance
+        :return: asyncio future of logout or None if client is already unregistered
+        """
+        if self.clients.pop(client, None) is None:
+            return None
+        # client.user must not be touched outside of the worker thread, log address only
+        log.info("Unregister client: %s", client.addr)
+        return self.submit(self._logout, client)
+
+    @staticmethod
+    def _logout(client):
+        if client.user:
+            client.logout()
+        client.close()
+
+    def _disconnect(self, client):
+        client.send(ErrorMessage(err_code=repr("Server is stopping".encode('utf-8'))))
+        self.loop.call_soon_threadsafe(client.conn.transport.close)
+
+    def update_client_events(self, client):
+        """
+        Flow control is done by transports (see MessProtocol.pause_writing), nothing to do here
+        """
+        pass
+
+    def pace_output(self, client):
+        """
+        Data sent by the worker thread is written to the transport by the loop later, so output of the client
+        is held (client.output_blocked) until the loop gets to it: released right away if the transport buffer
+        is below the high watermark, by MessProtocol.resume_writing otherwise.
+        Offline messages are sent a page at a time this way (see Client.on_writable)
+        """
+        client.writing_paused = True
+        self.loop.call_soon_threadsafe(self._output_written, client)
+
+    def _output_written(self, client):
+        transport = client.conn.transport
+        if not transport.get_protocol().paused and not transport.is_closing():
+            client.writing_paused = False
+            self.submit(client.on_writable)
+
+    def submit(self, func, *args):
+        """
+        Execute func in client worker thread
+        :return: asyncio future
+        """
+        return self.loop.run_in_executor(self.executor, self._call, func, *args)
+
+    def submit_threadsafe(self, func, *args):
+        """
+        Execute func in client worker thread, can be called from any thread
+        :return: None
+        """
+        self.loop.call_soon_threadsafe(self.submit, func, *args)
+
+    @staticmethod
+    def _call(func, *args):
+        try:
+            return func(*args)
+        except Exception:
+            log.error(traceback.format_exc())
+        finally:
+            # status changes made by the call (and by earlier calls within the interval)
+            PRESENCE.tick()
+            # profiling is started and finished by the thread running handlers, periodic flushes included
+            PROFILER.tick()
+
+    def _flush_messages(self):
+        """
+        Flush pending messages in the worker thread periodically,
+        being late for that is the event loop lag
+        """
+        METRICS.loop_lag.observe(max(0, self.loop.time() - self.flush_due))
+        self.submit(MESSAGE_WRITER.tick)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        self.flush_due = self.loop.time() + self.config.message_flush_interval
+        self.loop.call_at(self.flush_due, self._flush_messages)
+
+    def call_in_loop(self, func, *args, timeout=5):
+        """
+        Call func(*args) in the event loop thread and wait for the result (called by the worker thread)
+        :return: result of func
+        """
+        future = concurrent.futures.Future()
+
+        def call():
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(call)
+        return future.result(timeout=timeout)
+
+    def metrics_gauges(self):
+        """
+        :return: {name: callable} server state reported by SRV command (called by the worker thread),
+            self.clients is owned by the event loop, so gauges of it are computed there
+        """
+        return {'connected_clients': lambda: self.call_in_loop(len, self.clients),
+                'online_users': lambda: len(ONLINE_USERS),
+                'user_statuses': lambda: {status: count for status, count in ONLINE_USERS.status_counts.items() if count},
+                'output_buffers': lambda: self.call_in_loop(lambda: output_buffers(list(self.clients))),
+                'messages_pending': lambda: len(MESSAGE_WRITER.pending),
+                'status_changes_pending': lambda: len(PRESENCE.changes)}
+
+    async def drain_db(self, timeout=5):
+        """
+        Wait for submitted DB calls (and calls submitted by their callbacks) and their callbacks
+        :return: True if nothing is pending
+        """
+        deadline = self.loop.time() + timeout
+        while self.db.pending:
+            if self.loop.time() > deadline:
+                log.warning("%d DB calls are still pending", self.db.pending)
+                return False
+            await asyncio.sleep(0.01)
+        return True
+
+    def setup(self):
+        """
+        Setup event loop and listening socket
+        :return: None
+        """
+        if self.use_uvloop and uvloop:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: MessProtocol(self), self.host, self.port,
+                                   reuse_address=True, backlog=self.config.listen_backlog))
+        MESSAGE_WRITER.configure(batch_size=self.config.message_batch_size,
+                                 flush_interval=self.config.message_flush_interval,
+                                 durability=self.config.message_durability,
+                                 executor=self.db)
+        PRESENCE.configure(flush_interval=self.config.presence_flush_interval)
+        PROFILER.configure(directory=self.config.log, seconds=self.config.profile_seconds)
+        METRICS.gauges.update(self.metrics_gauges())
+        self.schedule_flush()
+        log.info("Server({loop_impl}) is listening on {host}:{port}".format(
+            loop_impl=type(self.loop), host=self.host, port=self.port))
+
+    def run(self):
+        """
+        Run event loop until interrupted
+        :return: None
+        """
+        self.setup()
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop server
+        :return: None
+        """
+        log.warning("Server is stopping, %d users online...", len(ONLINE_USERS))
+        self.server.close()
+        pending = []
+        for client in list(self.clients):
+            self.submit(self._disconnect, client)
+            pending.append(self.unregister_client(client))
+        self.loop.run_until_complete(asyncio.gather(*pending))
+        self.loop.run_until_complete(self.submit(PRESENCE.flush))
+        self.loop.run_until_complete(self.submit(MESSAGE_WRITER.flush))
+        self.loop.run_until_complete(self.drain_db())
+        MESSAGE_WRITER.executor = None
+        self.db.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.run_until_complete(asyncio.sleep(0))  # let transports close
+        self.executor.shutdown(wait=True)
+        self.loop.close()
+        sys.exit(0)
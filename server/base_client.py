@@ -1,10 +1,16 @@
+import collections
+import itertools
 import logging
 import socket
+import time
 
-from server.online import ONLINE_USERS
+from server.metrics import METRICS
+from server.online import ONLINE_USERS, get_online_client, get_subscribers, publish_presence
 from server.models.user import User
+from server.models.utils import get_friend_names, MESSAGE_WRITER
 
-from protocol.messages import Message, NormalMessage, CMD_CHANGE_STATUS
+from protocol.compression import COMPRESSOR, StreamDecompressor
+from protocol.messages import Message, NormalMessage, CMD_CHANGE_STATUS, PROTOCOL_V1, UnsafePayload
 from protocol.data_utils import DataBuffer, DataParser
 
 
@@ -26,16 +32,208 @@ USER_STATUS_BUSY = 'BUSY'
 USER_STATUSES = [USER_STATUS_BUSY,
                  USER_STATUS_DEFAULT]
 
+# outbound buffer limits (bytes): reading from a client is paused once its
+# pending output grows above the high watermark and resumed below the low one
+WRITE_HIGH_WATERMARK = 256 * 1024
+WRITE_LOW_WATERMARK = 64 * 1024
+
+# max number of queued chunks written by one sendmsg() call
+SENDMSG_MAX_CHUNKS = 64
+
+# bytes read by one recv_into() call: doubled while reads fill the buffer, halved when they are much shorter,
+# frames of known size (protocol v2) are read up to the max at once
+READ_SIZE_MIN = 4096
+READ_SIZE_MAX = 1024 * 1024
+
+
+def broadcast(clients, msg):
+    """
+    Send the same message to many clients, it's encoded once per protocol version (and compression)
+    and all clients with that version queue the same chunks. Clients of protocol version the message
+    can't be sent with are skipped, see protocol.messages.v1_safe_payload
+    @param clients: iterable of Client (or RemoteClient) instances
+    @param msg: Message subclass instance
+    :return: None
+    """
+    encoded = {}
+    for client in clients:
+        key = client.protocol_version, client.compress
+        data = encoded.get(key)
+        if data is None:
+            try:
+                data = msg.as_chunks(client.protocol_version, client.compress)
+            except UnsafePayload:
+                log.warning("%s can't be sent with protocol v%d, skipped", msg.cmd, client.protocol_version)
+                data = False
+            encoded[key] = data
+        if data:
+            client.send(data)
+
+
+class PresenceFanout:
+    """
+    Status changes of local users are sent to their subscribers (see PresenceRegistry) once per tick:
+    changes made within `flush_interval` seconds are collected, repeated changes of a user
+    collapse to the last one (or to nothing if friends already know that status), and each subscriber
+    gets one CHG frame with all changes it is interested in: `CHG name status [name status ...]`
+    for protocol v2 clients, a CHG frame per change for v1 ones.
+
+    Server loop calls tick() (and waits for timeout() seconds at most), flush() sends pending changes.
+    Default (no flush interval) sends every change right away for scripts and tests.
+    """
+
+    def __init__(self, flush_interval=None, clock=time.monotonic):
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.changes = {}  # {name: (status message, subscriber names)} in order of the first change
+        self.announced = {}  # {name: status message} last status sent to friends of online users
+        self.oldest_ts = None  # clock() of the oldest pending change
+
+    def configure(self, flush_interval):
+        self.flush()
+        self.flush_interval = flush_interval
+
+    def publish(self, name, status_msg, subscribers):
+        """
+        Queue status change of a user
+        :param name: user name
+        :param status_msg: new status or CLIENT_OFFLINE
+        :param subscribers: names of users to notify
+        :return: None
+        """
+        if not self.changes:
+            self.oldest_ts = self.clock()
+        self.changes[name] = (status_msg, subscribers)
+        if self.flush_interval is None:
+            self.flush()
+
+    def timeout(self):
+        """
+        :return: seconds until pending changes have to be sent, None if there are no pending changes
+        """
+        if not self.changes:
+            return None
+        return max(0, self.oldest_ts + self.flush_interval - self.clock())
+
+    def tick(self):
+        """
+        Send pending changes if the oldest of them has waited long enough
+        :return: None
+        """
+        if self.changes and self.clock() - self.oldest_ts >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Send all pending changes
+        :return: number of sent frames
+        """
+        if not self.changes:
+            return 0
+        changes, self.changes, self.oldest_ts = self.changes, {}, None
+        updates = collections.defaultdict(list)  # {client: [name, status, ...]}
+        for name, (status_msg, subscriber_names) in changes.items():
+            if self.announced.get(name, CLIENT_OFFLINE) == status_msg:
+                continue  # e.g. logged in and out within one tick
+            if status_msg == CLIENT_OFFLINE:
+                del self.announced[name]
+            else:
+                self.announced[name] = status_msg
+            for subscriber_name in subscriber_names:
+                client = get_online_client(subscriber_name)
+                if client:
+                    updates[client].extend((name, status_msg))
+
+        # subscribers getting the same changes share encoded frames
+        subscribers = collections.defaultdict(list)  # {(name, status, ...): [client, ...]}
+        for client, params in updates.items():
+            subscribers[tuple(params)].append(client)
+        frames = 0
+        for params, clients in subscribers.items():
+            if len(params) > 2:
+                v1_clients = [client for client in clients if client.protocol_version == PROTOCOL_V1]
+                clients = [client for client in clients if client.protocol_version != PROTOCOL_V1]
+                for n in range(0, len(params), 2):
+                    broadcast(v1_clients, NormalMessage(cmd=CMD_CHANGE_STATUS, params=list(params[n:n + 2])))
+                frames += len(v1_clients) * len(params) // 2
+            broadcast(clients, NormalMessage(cmd=CMD_CHANGE_STATUS, params=list(params)))
+            frames += len(clients)
+        log.debug("%d status changes were sent in %d frames", len(changes), frames)
+        return frames
+
+
+PRESENCE = PresenceFanout()
+
+
+class FrameBatch:
+    """
+    Frames of one read (or results of DB calls completed together) are handled as a batch:
+    messages saved by the handlers are committed together (see MessageWriter.hold)
+    and output queued meanwhile is written at the end, one flush per client instead of one per frame
+    (queued chunks are gathered by sendmsg). Batches nest, the outermost one does the work.
+
+        with BATCH:
+            for msg in messages:
+                client.handle(msg)
+    """
+
+    def __init__(self, writer=MESSAGE_WRITER):
+        self.writer = writer
+        self.depth = 0
+        self.clients = {}  # {client: None} with output queued during the batch, in order of the first send
+
+    @property
+    def active(self):
+        return self.depth > 0
+
+    def defer_flush(self, client):
+        self.clients[client] = None
+
+    def __enter__(self):
+        if not self.depth:
+            self.writer.hold()
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.depth > 1:
+            self.depth -= 1
+            return False
+        try:
+            # deliveries of rows committed by release are still deferred
+            self.writer.release()
+        finally:
+            self.depth = 0
+            while self.clients:
+                clients, self.clients = self.clients, {}
+                for client in clients:
+                    client.flush()
+        return False
+
+
+BATCH = FrameBatch()
+
 
 class BaseClient:
 
-    def __init__(self, conn, server=None):
+    def __init__(self, conn, server=None,
+                 write_high_watermark=WRITE_HIGH_WATERMARK,
+                 write_low_watermark=WRITE_LOW_WATERMARK):
         self.conn = conn
-        self.server = server  # just to get debug info about server state
+        self.server = server  # server owning the connection, notified about outbound buffer changes
         self.__user = None
         self.__status = None
+        self.__protocol_version = PROTOCOL_V1
         self.data_buffer = DataBuffer()
-        self.data_parser = DataParser()
+        self.read_size = READ_SIZE_MIN  # see read_buffer
+        self.data_parser = DataParser(opaque_payloads=True)
+        self.compress = None  # compressor of outbound payloads, see enable_compression
+        self.out_queue = collections.deque()  # bytes/memoryview chunks waiting to be written
+        self.out_size = 0
+        self.write_high_watermark = write_high_watermark
+        self.write_low_watermark = write_low_watermark
+        self.reading_paused = False
+        self.writing_paused = False  # set by transports doing their own buffering (asyncio engine)
         self.addr = "({ip}:{port})".format(ip=self.conn.getpeername()[0],
                                            port=self.conn.getpeername()[1])
 
@@ -49,6 +247,33 @@ class BaseClient:
     def info(self):
         return None
 
+    @property
+    def protocol_version(self):
+        return self.__protocol_version
+
+    @protocol_version.setter
+    def protocol_version(self, version):
+        self.__protocol_version = version
+        self.data_buffer.version = version
+        self.data_parser.version = version
+
+    def enable_compression(self):
+        """
+        Compress payloads of both directions for the rest of the connection (protocol v2),
+        client's payloads are one deflate stream, the ones sent to it are compressed message by message
+        """
+        if self.compress is None:
+            self.compress = COMPRESSOR
+            self.data_parser.decompress = StreamDecompressor()
+
+    @property
+    def has_pending_output(self):
+        return self.out_size > 0
+
+    @property
+    def output_blocked(self):
+        return self.out_size >= self.write_high_watermark or self.writing_paused
+
     @property
     def user(self):
         return self.__user
@@ -60,11 +285,11 @@ class BaseClient:
                 raise ClientIsAlreadyLoggedInException(self.__user)
             else:
                 self.__user = user
-                ONLINE_USERS[user.name] = self
+                ONLINE_USERS.add(self)
                 self.status = USER_STATUS_DEFAULT
         elif user is None:
-            del ONLINE_USERS[self.user.name]
             self.status = None
+            ONLINE_USERS.remove(self.user.name)
             self.__user = None
         else:
             raise ValueError(user)
@@ -78,40 +303,131 @@ class BaseClient:
         if new_status in USER_STATUSES or new_status is None:
             self.__status = new_status
             status_msg = new_status if new_status else CLIENT_OFFLINE
-            for friend_name in [u.name for u in self.user.all_friends if u.name in ONLINE_USERS]:
-                client = ONLINE_USERS[friend_name]
-                client.send(NormalMessage(cmd=CMD_CHANGE_STATUS, params=[self.user.name, status_msg]))
+            friend_names = get_friend_names(self.user)
+            ONLINE_USERS.set_status(self.user.name, new_status, friend_names)
+            publish_presence(self.user.name, new_status)
+            PRESENCE.publish(self.user.name, status_msg, get_subscribers(self.user.name, friend_names))
         else:
             raise NoSuchStatusException(new_status)
 
     def handle(self, msg):
         raise NotImplementedError()
 
+    def on_writable(self):
+        """
+        Called by server once outbound queue is drained below the low watermark
+        """
+        pass
+
     def recv(self, data):
         """
         Receive bytes and handle them
         """
-        log.info("{self} got: {data}".format(self=self, data=data))
-        raw_messages = self.data_buffer.push(data)
-        # if we got complete message lets handle it
-        for raw_msg in raw_messages:
-            msg = self.data_parser.parse(raw_msg)
-            self.handle(msg)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%r got: %r", self, data)
+        METRICS.bytes_in.mark(len(data))
+        self.handle_frames(self.data_buffer.push(data))
+
+    def read_buffer(self):
+        """
+        Buffer to receive bytes into (socket.recv_into), they are handled by received()
+        :return: writable memoryview
+        """
+        return self.data_buffer.reserve(max(self.read_size, min(self.data_buffer.missing, READ_SIZE_MAX)))
+
+    def received(self, size):
+        """
+        Handle bytes received into read_buffer()
+        @param size: number of bytes
+        """
+        METRICS.bytes_in.mark(size)
+        if size >= self.read_size:
+            self.read_size = min(self.read_size * 2, READ_SIZE_MAX)
+        elif size < self.read_size // 4:
+            self.read_size = max(self.read_size // 2, READ_SIZE_MIN)
+        self.handle_frames(self.data_buffer.commit(size))
+
+    def handle_frames(self, raw_messages):
+        if not raw_messages:
+            return
+        METRICS.messages_in.mark(len(raw_messages))
+        # if we got complete message lets handle it, all frames of the read as one batch
+        with BATCH:
+            for raw_msg in raw_messages:
+                # every frame is timed (about 2us), so counts of the handler histograms are counts of commands
+                started, started_cpu = time.perf_counter(), time.thread_time()
+                msg = self.data_parser.parse(raw_msg)
+                try:
+                    self.handle(msg)
+                finally:
+                    METRICS.observe_handler(msg.cmd, time.perf_counter() - started, time.thread_time() - started_cpu)
 
     def send(self, msg):
         """
-        Sends Message or bytes to client
-        @param msg: Message subclass instance or bytes or string
+        Queue Message or bytes for the client and write as much as possible right away
+        (at the end of the batch if a FrameBatch is active)
+        @param msg: Message subclass instance or bytes or string or list of bytes-like chunks of a frame
         """
         if type(msg) is str:
             msg = msg.encode('utf-8')
         if isinstance(msg, Message):
-            msg = msg.as_bytes()
-        try:
-            self.conn.send(msg)
-        except BrokenPipeError:
-            self.log.warning('BrokenPipeError - %s' % self.user.name)
-            # TODO: clean all
-        except ConnectionResetError as cre:
-            log.warning(cre)
-        log.info("{client} <<< {msg}".format(client=self, msg=msg))
+            msg = msg.as_chunks(self.protocol_version, self.compress)
+        if type(msg) is list:
+            # big payloads are queued by reference, see PayloadMessage.as_chunks
+            for chunk in msg:
+                self.out_queue.append(chunk)
+                self.out_size += len(chunk)
+        else:
+            self.out_queue.append(msg)
+            self.out_size += len(msg)
+        METRICS.messages_out.mark()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%r <<< %r", self, msg)
+        if BATCH.depth:
+            BATCH.defer_flush(self)
+        else:
+            self.flush()
+
+    def flush(self):
+        """
+        Write queued data until the socket would block
+        :return: True if outbound queue is empty
+        """
+        sendmsg = getattr(self.conn, 'sendmsg', None)
+        while self.out_queue:
+            try:
+                if sendmsg and len(self.out_queue) > 1:
+                    # gather queued chunks into one syscall
+                    chunks = list(itertools.islice(self.out_queue, SENDMSG_MAX_CHUNKS))
+                    sent = sendmsg(chunks)
+                else:
+                    chunks = [self.out_queue[0]]
+                    sent = self.conn.send(chunks[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            except (BrokenPipeError, ConnectionResetError) as e:
+                log.warning("{client}: {err!r}, dropping {size} pending bytes".format(
+                    client=self, err=e, size=self.out_size))
+                self.out_queue.clear()
+                self.out_size = 0
+                break
+            self.out_size -= sent
+            METRICS.bytes_out.mark(sent)
+            for chunk in chunks:
+                if sent < len(chunk):
+                    break
+                sent -= len(chunk)
+                self.out_queue.popleft()
+            else:
+                continue
+            if sent:
+                self.out_queue[0] = memoryview(self.out_queue[0])[sent:]
+            break  # socket buffer is full
+
+        if self.out_size >= self.write_high_watermark:
+            self.reading_paused = True
+        elif self.out_size <= self.write_low_watermark:
+            self.reading_paused = False
+        if self.server:
+            self.server.update_client_events(self)
+        return not self.out_queue
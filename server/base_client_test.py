@@ -0,0 +1,315 @@
+import socket
+import unittest
+from unittest import mock
+
+from server.base_client import BaseClient, PresenceFanout, broadcast, CLIENT_OFFLINE, READ_SIZE_MIN, BATCH
+from server.models.writer import MessageWriter
+from server.models.writer_test import FakeSession
+from server.online import ONLINE_USERS
+from protocol.messages import PayloadMessage, CMD_MESSAGE, PROTOCOL_V1, PROTOCOL_V2, PAYLOAD_CHUNK_MIN
+
+
+class FakeConnection:
+    """
+    Non-blocking socket stand-in which accepts up to `capacity` bytes
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.sent = b""
+
+    def getpeername(self):
+        return ('127.0.0.1', 12345)
+
+    def send(self, data):
+        if not self.capacity:
+            raise BlockingIOError()
+        data = bytes(data[:self.capacity])
+        self.capacity -= len(data)
+        self.sent += data
+        return len(data)
+
+
+class FakeGatherConnection(FakeConnection):
+    """
+    FakeConnection with scatter/gather sendmsg
+    """
+
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.sendmsg_calls = 0
+
+    def sendmsg(self, buffers):
+        self.sendmsg_calls += 1
+        return self.send(b''.join(buffers))
+
+
+class CountingMessage(PayloadMessage):
+
+    encoded = 0
+
+    def as_chunks(self, version, compress=None):
+        CountingMessage.encoded += 1
+        return super().as_chunks(version, compress)
+
+
+class FakeServer:
+
+    def __init__(self):
+        self.updates = []
+
+    def update_client_events(self, client):
+        self.updates.append((client.has_pending_output, client.reading_paused))
+
+
+class TestReceive(unittest.TestCase):
+
+    def setUp(self):
+        self.conn, self.peer = socket.socketpair()
+        self.addCleanup(self.conn.close)
+        self.addCleanup(self.peer.close)
+        self.conn.setblocking(False)
+        self.client = BaseClient(FakeConnection(capacity=0))
+        self.frames = []
+        self.client.handle = self.frames.append
+
+    def read(self):
+        """
+        Read until the socket is drained
+        """
+        while True:
+            with self.client.read_buffer() as buffer:
+                free = len(buffer)
+                try:
+                    size = self.conn.recv_into(buffer)
+                except BlockingIOError:
+                    return
+            self.client.received(size)
+            if size < free:
+                return
+
+    def test_read_size_adapts(self):
+        self.peer.sendall(b'x' * 3 * READ_SIZE_MIN)
+        self.read()
+        self.assertEqual(self.client.read_size, 4 * READ_SIZE_MIN)
+        self.client.data_buffer.flush()
+        for _ in range(3):
+            self.peer.sendall(b'USR..')
+            self.read()
+        self.assertEqual(self.client.read_size, READ_SIZE_MIN)
+        self.assertEqual(len(self.frames), 3)
+
+    def test_frame_of_known_size(self):
+        self.client.protocol_version = PROTOCOL_V2
+        payload = 'x' * 200000
+        data = PayloadMessage(CMD_MESSAGE, ['user1'], payload).as_bytes(PROTOCOL_V2)
+        self.peer.sendall(data[:100])
+        self.read()
+        # the rest of the frame is received at once (as much as the socket has)
+        missing = self.client.data_buffer.missing
+        self.assertGreater(missing, READ_SIZE_MIN)
+        self.assertGreaterEqual(len(self.client.read_buffer()), missing)
+        self.peer.sendall(data[100:])
+        self.read()
+        self.assertEqual([bytes(msg.payload) for msg in self.frames], [payload.encode()])  # opaque payloads
+
+
+class TestOutboundQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection(capacity=4)
+        self.server = FakeServer()
+        self.client = BaseClient(self.conn, self.server, write_high_watermark=10, write_low_watermark=2)
+
+    def test_partial_write_is_queued(self):
+        self.client.send(b'AAAAAA')
+        self.assertEqual(self.conn.sent, b'AAAA')
+        self.assertEqual(self.client.out_size, 2)
+        self.assertEqual(self.server.updates[-1], (True, False))
+
+        self.conn.capacity = 100
+        self.assertTrue(self.client.flush())
+        self.assertEqual(self.conn.sent, b'AAAAAA')
+        self.assertFalse(self.client.has_pending_output)
+        self.assertEqual(self.server.updates[-1], (False, False))
+
+    def test_order_is_kept(self):
+        for chunk in [b'123', b'456', b'789']:
+            self.client.send(chunk)
+        self.conn.capacity = 100
+        self.client.flush()
+        self.assertEqual(self.conn.sent, b'123456789')
+
+    def test_watermarks(self):
+        self.client.send(b'X' * 16)
+        self.assertTrue(self.client.reading_paused)
+
+        # still above low watermark
+        self.conn.capacity = 5
+        self.client.flush()
+        self.assertEqual(self.client.out_size, 7)
+        self.assertTrue(self.client.reading_paused)
+
+        self.conn.capacity = 5
+        self.client.flush()
+        self.assertEqual(self.client.out_size, 2)
+        self.assertFalse(self.client.reading_paused)
+
+    def test_broken_pipe_drops_output(self):
+        def broken_send(data):
+            raise BrokenPipeError()
+        self.conn.send = broken_send
+        self.client.send(b'AAA')
+        self.assertFalse(self.client.has_pending_output)
+
+
+class TestGatherWrite(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeGatherConnection(capacity=0)
+        self.client = BaseClient(self.conn)
+
+    def test_queued_chunks_are_written_at_once(self):
+        for chunk in [b'123', b'456', b'789']:
+            self.client.send(chunk)
+        self.conn.capacity = 100
+        self.conn.sendmsg_calls = 0
+        self.assertTrue(self.client.flush())
+        self.assertEqual(self.conn.sent, b'123456789')
+        self.assertEqual(self.conn.sendmsg_calls, 1)
+
+    def test_partial_gather_write(self):
+        for chunk in [b'123', b'456', b'789']:
+            self.client.send(chunk)
+        self.conn.capacity = 5
+        self.assertFalse(self.client.flush())
+        self.assertEqual(list(map(bytes, self.client.out_queue)), [b'6', b'789'])
+        self.assertEqual(self.client.out_size, 4)
+
+        self.conn.capacity = 100
+        self.assertTrue(self.client.flush())
+        self.assertEqual(self.conn.sent, b'123456789')
+
+
+class TestFrameBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        self.writer = MessageWriter(self.session)  # commit per row outside of batches
+        patcher = mock.patch.object(BATCH, 'writer', self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sender = BaseClient(FakeGatherConnection(capacity=1000))
+        self.recipient = BaseClient(FakeGatherConnection(capacity=1000))
+        self.sender.handle = self.save_and_deliver
+
+    def save_and_deliver(self, msg):
+        self.writer.add(bytes(msg.payload), on_commit=lambda row: self.recipient.send(msg))
+        self.sender.send(b'ok\n')
+
+    def test_frames_of_one_read(self):
+        frames = [PayloadMessage(CMD_MESSAGE, ['user'], 'hello %d' % n).as_bytes(PROTOCOL_V1) for n in range(5)]
+        self.sender.recv(b''.join(frames))
+        self.assertEqual(self.session.commits, [[b'hello %d' % n for n in range(5)]])
+        self.assertEqual(self.sender.conn.sent, b'ok\n' * 5)
+        self.assertEqual(self.sender.conn.sendmsg_calls, 1)
+        self.assertEqual(self.recipient.conn.sent, b''.join(frames))
+        self.assertEqual(self.recipient.conn.sendmsg_calls, 1)
+        self.assertFalse(BATCH.active)
+
+    def test_output_is_written_if_handler_fails(self):
+        def fail(msg):
+            self.sender.send(b'error\n')
+            raise ValueError(msg)
+        self.sender.handle = fail
+        with self.assertRaises(ValueError):
+            self.sender.recv(PayloadMessage(CMD_MESSAGE, ['user'], 'hello').as_bytes(PROTOCOL_V1))
+        self.assertEqual(self.sender.conn.sent, b'error\n')
+        self.assertFalse(BATCH.active)
+        self.assertEqual(self.writer.holds, 0)
+
+
+class TestBroadcast(unittest.TestCase):
+
+    def test_encoded_once_per_version(self):
+        clients = [BaseClient(FakeConnection(capacity=100)) for _ in range(4)]
+        clients[0].protocol_version = PROTOCOL_V2
+        CountingMessage.encoded = 0
+        broadcast(clients, CountingMessage(CMD_MESSAGE, ['user'], 'hello'))
+        self.assertEqual(CountingMessage.encoded, 2)
+        self.assertEqual(clients[3].conn.sent, b'MSG user 5||hello..\n')
+
+    def test_compressed_once(self):
+        clients = [BaseClient(FakeConnection(capacity=10000)) for _ in range(3)]
+        for client in clients:
+            client.protocol_version = PROTOCOL_V2
+        clients[0].enable_compression()
+        clients[1].enable_compression()
+        CountingMessage.encoded = 0
+        msg = CountingMessage(CMD_MESSAGE, ['user'], 'hello ' * 100)
+        broadcast(clients, msg)
+        self.assertEqual(CountingMessage.encoded, 2)
+        self.assertEqual(clients[0].conn.sent, clients[1].conn.sent)
+        self.assertTrue(clients[0].conn.sent.startswith(b'MSG user z%d||' % len(msg.deflated)))
+        self.assertTrue(clients[2].conn.sent.startswith(b'MSG user 600||'))
+
+    def test_big_opaque_payload_is_not_copied(self):
+        clients = [BaseClient(FakeConnection(capacity=0)) for _ in range(2)]
+        clients[0].protocol_version = PROTOCOL_V2
+        payload = memoryview(b'x' * PAYLOAD_CHUNK_MIN)
+        broadcast(clients, PayloadMessage(CMD_MESSAGE, ['user'], payload))
+        for client in clients:
+            self.assertEqual([bytes(chunk) for chunk in client.out_queue],
+                             [b'MSG user %d||' % PAYLOAD_CHUNK_MIN, payload, b'..\n'])
+            self.assertIs(client.out_queue[1], payload)
+
+
+class TestPresenceFanout(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.presence = PresenceFanout(flush_interval=0.1, clock=lambda: self.now)
+        self.friends = {}
+        for name, version in (('fanA', PROTOCOL_V2), ('fanB', PROTOCOL_V2), ('fanC', 1)):
+            client = self.friends[name] = BaseClient(FakeConnection(capacity=1000))
+            client.protocol_version = version
+            ONLINE_USERS.by_name[name] = client  # only looked up by name
+
+    def tearDown(self):
+        for name in self.friends:
+            del ONLINE_USERS.by_name[name]
+
+    def test_changes_are_coalesced(self):
+        self.presence.publish('fanX', 'ONLINE', {'fanA', 'fanC'})
+        self.presence.publish('fanX', 'BUSY', {'fanA', 'fanC'})
+        self.presence.publish('fanY', 'ONLINE', {'fanA', 'fanB', 'fanC'})
+        self.now = 0.05
+        self.assertAlmostEqual(self.presence.timeout(), 0.05)
+        self.presence.tick()
+        self.assertEqual(self.friends['fanA'].conn.sent, b'')
+
+        self.now = 0.1
+        self.presence.tick()
+        self.assertIsNone(self.presence.timeout())
+        self.assertEqual(self.friends['fanA'].conn.sent, b'CHG fanX BUSY fanY ONLINE..\n')
+        self.assertEqual(self.friends['fanB'].conn.sent, b'CHG fanY ONLINE..\n')
+        self.assertEqual(self.friends['fanC'].conn.sent, b'CHG fanX BUSY..\nCHG fanY ONLINE..\n')
+
+    def test_unchanged_status_is_not_sent(self):
+        self.presence.publish('fanX', 'ONLINE', {'fanA'})
+        self.presence.flush()
+        self.presence.publish('fanX', 'BUSY', {'fanA'})
+        self.presence.publish('fanX', 'ONLINE', {'fanA'})
+        self.presence.publish('fanY', 'ONLINE', {'fanA'})
+        self.presence.publish('fanY', CLIENT_OFFLINE, {'fanA'})  # flapping connection
+        self.assertEqual(self.presence.flush(), 0)
+        self.assertEqual(self.friends['fanA'].conn.sent, b'CHG fanX ONLINE..\n')
+
+    def test_sent_right_away_without_interval(self):
+        presence = PresenceFanout()
+        presence.publish('fanX', 'ONLINE', {'fanB', 'fanZ'})
+        self.assertEqual(self.friends['fanB'].conn.sent, b'CHG fanX ONLINE..\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
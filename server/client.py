@@ -1,21 +1,37 @@
+import collections
+import json
 import logging
-from functools import wraps
+import time
+import traceback
+from functools import partial, wraps
 
-from server.models.utils import create_chat, get_chat_by_id, add_chat_participant, create_chat_message
-from server.online import ONLINE_USERS
+from server.db_executor import INLINE_EXECUTOR
+from server.metrics import METRICS
+from server.profiler import PROFILER
+from server.models.utils import create_chat_message, insert_chat, insert_chat_member, get_user_chats_info, \
+    load_user, cache_user, load_friend_names, cache_friend_names, load_chat_roster, cache_chat_roster, \
+    ChatRoster, CHAT_CACHE, USER_CACHE
+from server.online import get_online_client, is_online
 
-from server.base_client import BaseClient, CLIENT_OFFLINE, ClientIsAlreadyLoggedInException
+from server.base_client import BaseClient, CLIENT_OFFLINE, ClientIsAlreadyLoggedInException, broadcast
 
 from protocol.messages import CMD_INFO, CMD_LOGIN, CMD_LOGOUT, CMD_FRIENDS, CMD_MESSAGE, CMD_CHAT_MESSAGE, \
-    CMD_GET_CHATS, CMD_ADD_CHAT_PARTICIPANT, CMD_CREATE_CHAT
-from protocol.messages import PayloadMessage
+    CMD_GET_CHATS, CMD_ADD_CHAT_PARTICIPANT, CMD_CREATE_CHAT, CMD_VERSION, CMD_MSG_ACK, CMD_SERVICE, \
+    PROTOCOL_VERSIONS, PROTOCOL_V1, SERVICE_PROFILE, SERVICE_MEMORY
+from protocol.messages import NormalMessage, PayloadMessage, UnsafePayload
+from protocol.compression import LOGIN_COMPRESSION
 
-from server.models.utils import update_user_last_online_ts, create_message, get_messages, get_user_by_name,\
-    get_chat_messages
+from server.models.utils import MESSAGE_WRITER, update_user_last_online_ts, create_message, get_offline_messages, \
+    get_delivery_cursors, save_delivery_cursors, PERSONAL_CURSOR
 
 
 log = logging.getLogger(__name__)
 
+# delivery cursors are saved every CURSOR_SAVE_MOVES moves or once CURSOR_SAVE_INTERVAL seconds have passed,
+# what moved since is saved at logout
+CURSOR_SAVE_MOVES = 100
+CURSOR_SAVE_INTERVAL = 5.0
+
 
 class NoSuchUserException(Exception):
     pass
@@ -53,6 +69,98 @@ class InvalidChatID(Exception):
     pass
 
 
+class InvalidProtocolVersion(Exception):
+    pass
+
+
+class InvalidAck(Exception):
+    pass
+
+
+class InvalidServiceRequest(Exception):
+    pass
+
+
+class AdminRequiredException(Exception):
+    pass
+
+
+class InvalidLoginFlag(Exception):
+    pass
+
+
+def deliver(name, msg, row):
+    """
+    Send saved message to the user if they are online
+    :param name: user name
+    :param msg: PayloadMessage instance
+    :param row: saved Message
+    :return: None
+    """
+    client_to = get_online_client(name)
+    if not client_to:
+        return
+    if row.id is None and client_to.protocol_version != PROTOCOL_V1:
+        # DURABILITY_IMMEDIATE: v2 frames carry the id clients acknowledge, it's known once the row is committed
+        MESSAGE_WRITER.after_commit(row, partial(deliver, name, msg))
+        return
+    msg.msg_id = row.id
+    try:
+        client_to.send(msg)
+    except UnsafePayload:
+        log.warning("Message %s can't be sent to %s with protocol v%d, skipped", row.id, name,
+                    client_to.protocol_version)
+    client_to.note_delivered(PERSONAL_CURSOR, row)
+
+
+def deliver_to_chat(roster, sender, msg, row, names=None):
+    """
+    Send saved message to all online chat members except the sender, message is encoded once
+    :param roster: ChatRoster
+    :param sender: sender name
+    :param msg: PayloadMessage instance
+    :param row: saved ChatMessage
+    :param names: recipients, all chat members except the sender by default
+    :return: None
+    """
+    if names is None:
+        names = [user_to for user_to in roster.members if user_to != sender]
+    clients = [(user_to, get_online_client(user_to)) for user_to in names]
+    clients = [(user_to, client) for user_to, client in clients if client]
+    if row.id is None:
+        # DURABILITY_IMMEDIATE: v2 clients get the message once its id is known, see deliver
+        waiting = [user_to for user_to, client in clients if client.protocol_version != PROTOCOL_V1]
+        if waiting:
+            MESSAGE_WRITER.after_commit(row, partial(deliver_to_chat, roster, sender, msg, names=waiting))
+            clients = [(user_to, client) for user_to, client in clients if client.protocol_version == PROTOCOL_V1]
+    clients = [client for user_to, client in clients]
+    msg.msg_id = row.id
+    log.debug('Send MSG for chat with id %s to %d online users', roster.chat_id, len(clients))
+    broadcast(clients, msg)
+    for client in clients:
+        client.note_delivered(roster.chat_id, row)
+
+
+def save_logout_state(user_id, cursors):
+    """
+    DB part of logout
+    :param user_id: User id
+    :param cursors: delivery cursors to save
+    :return: None
+    """
+    update_user_last_online_ts(user_id)
+    save_delivery_cursors(user_id, cursors)
+
+
+def load_offline_messages(user_id):
+    """
+    DB part of login
+    :param user_id: User id
+    :return: iterator of pages of offline messages
+    """
+    return get_offline_messages(user_id, get_delivery_cursors(user_id))
+
+
 def login_required(func):
 
     @wraps(func)
@@ -63,16 +171,24 @@ def login_required(func):
             raise ClientIsNotLoggedInException()
         return func(*args, **kwargs)
 
+    # Client.handle checks it by itself and calls the original function
+    wrapped._login_required = True
     return wrapped
 
 
 def cmd_handler_cls(cls):
-
+    """
+    Build dispatch table of the class: {cmd: (handler function, login required)}.
+    Handlers in the table are unwrapped from login_required, auth check is done on lookup.
+    """
     cls.handlers = {}
     for methodname in dir(cls):
         method = getattr(cls, methodname)
         if hasattr(method, '_registered_cmd'):
-            cls.handlers.update({method._registered_cmd: methodname})
+            if getattr(method, '_login_required', False):
+                cls.handlers[method._registered_cmd] = (method.__wrapped__, True)
+            else:
+                cls.handlers[method._registered_cmd] = (method, False)
 
     return cls
 
@@ -89,48 +205,312 @@ def register_cmd(cmd):
 @cmd_handler_cls
 class Client(BaseClient):
 
+    def __init__(self, *args, db_executor=INLINE_EXECUTOR, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.db = db_executor  # runs blocking DB calls, see run_db
+        self.db_busy = False  # DB call of a command is running, next commands wait in self.deferred
+        self.deferred = collections.deque()
+        self.closed = False  # connection is closed, results of running DB calls are dropped
+        self.replay = None  # pages of offline messages being sent after login, see on_writable
+        self.replay_loading = False
+        self.replay_paging = False  # on_writable is loading pages
+        self.replay_skip = None  # (chat id, message) delivered live while offline messages are sent
+        self.replayed = {}  # {chat id or PERSONAL_CURSOR: id of the last offline message sent}
+        self.pending_acks = {}  # ACKs of live messages which don't cover offline ones yet, see acknowledge
+        # last messages {chat id or PERSONAL_CURSOR: message id or saved message} sent (protocol v1)
+        # or acknowledged by the client (protocol v2), delivery cursors are moved to them
+        self.delivered = {}
+        self.acknowledged = {}
+        self.cursor_moves = 0  # since delivery cursors were saved
+        self.cursors_saved_at = 0
+
+    def note_delivered(self, chat_id, message):
+        """
+        Remember message sent to the client.
+        While offline messages are sent the cursor stays at the last one of them:
+        live message is newer than the ones not sent yet, see end_replay
+        :param chat_id: chat id or PERSONAL_CURSOR
+        :param message: message id or saved message (its id is known after commit)
+        """
+        if self.replay_skip is not None:
+            self.replay_skip.append((chat_id, message))
+            return
+        self.delivered[chat_id] = message
+        if self.protocol_version == PROTOCOL_V1:
+            self.cursor_moved()
+
+    def delivery_cursors(self):
+        """
+        :return: dict {chat id or PERSONAL_CURSOR: message id} to move delivery cursors to
+        """
+        delivered = self.delivered if self.protocol_version == PROTOCOL_V1 else self.acknowledged
+        cursors = {chat_id: getattr(message, 'id', message) for chat_id, message in delivered.items()}
+        return {chat_id: message_id for chat_id, message_id in cursors.items() if message_id is not None}
+
+    def take_delivery_cursors(self):
+        """
+        :return: delivery cursors, see delivery_cursors, and forget them
+        """
+        cursors = self.delivery_cursors()
+        self.delivered, self.acknowledged, self.replayed, self.pending_acks = {}, {}, {}, {}
+        return cursors
+
+    def cursor_moved(self):
+        """
+        Save delivery cursors once enough of them moved, so they don't go back as far as login
+        if the server goes down
+        """
+        self.cursor_moves += 1
+        now = time.monotonic()
+        if self.cursor_moves < CURSOR_SAVE_MOVES and now - self.cursors_saved_at < CURSOR_SAVE_INTERVAL:
+            return
+        self.cursor_moves = 0
+        self.cursors_saved_at = now
+        cursors = self.delivery_cursors()
+        if cursors and self.user:
+            self.db.submit(save_delivery_cursors, self.user.id, cursors)
+
+    def close(self):
+        """
+        Called by server when connection is closed (and user is logged out)
+        """
+        self.closed = True
+        self.deferred.clear()
+
+    def run_db(self, func, *args, callback=None):
+        """
+        Call blocking DB function func(*args) by DB executor and continue with callback(result).
+        Commands received meanwhile are handled after that, in order.
+        """
+        self.db_busy = True
+        self.db.submit(func, *args, callback=partial(self._db_done, callback), errback=self._db_failed)
+
+    def _db_done(self, callback, result):
+        self.db_busy = False
+        if self.closed:
+            return
+        try:
+            if callback:
+                callback(result)
+        finally:
+            self.handle_deferred()
+
+    def _db_failed(self, error):
+        log.error("DB call of %r failed", self, exc_info=error)
+        self.db_busy = False
+        self.handle_deferred()
+
+    def with_user(self, name, callback):
+        """
+        Call callback(User or None), user missing in USER_CACHE is loaded by DB executor first
+        """
+        user = USER_CACHE.by_name.get(name)
+        if user is not None:
+            callback(user)
+        else:
+            self.run_db(load_user, name, callback=lambda loaded: callback(cache_user(loaded)))
+
+    def with_friend_names(self, user, callback):
+        """
+        Call callback(frozenset of names of user's friends), see with_user
+        """
+        names = USER_CACHE.friend_names.get(user.id)
+        if names is not None:
+            callback(names)
+        else:
+            self.run_db(load_friend_names, user.id,
+                        callback=lambda loaded: callback(cache_friend_names(user.id, loaded)))
+
+    def with_chat_roster(self, chat_id, callback):
+        """
+        Call callback(ChatRoster or None if there is no such chat), see with_user
+        :param chat_id: chat id, int or string
+        """
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            callback(None)
+            return
+        roster = CHAT_CACHE.rosters.get(chat_id)
+        if roster is not None:
+            callback(roster)
+        else:
+            self.run_db(load_chat_roster, chat_id,
+                        callback=partial(self._roster_loaded, CHAT_CACHE.generation, callback))
+
+    @staticmethod
+    def _roster_loaded(generation, callback, roster):
+        callback(cache_chat_roster(generation, roster))
+
+    def handle_deferred(self):
+        while self.deferred and not self.db_busy and not self.closed:
+            try:
+                self.handle(self.deferred.popleft())
+            except Exception:
+                log.error(traceback.format_exc())
+
+    def on_writable(self):
+        """
+        Load next pages of offline messages while outbound queue is below the high watermark,
+        server calls it again once the queue is drained.
+        Pages loaded by DB executor threads are sent by callbacks, which call it again, the ones loaded
+        right away (INLINE_EXECUTOR) are sent before submit returns and the loop goes on
+        """
+        if self.replay_paging:
+            return  # called by send_replay_page of a page loaded right away
+        self.replay_paging = True
+        try:
+            while self.replay is not None and not self.replay_loading and not self.output_blocked:
+                self.replay_loading = True
+                self.db.submit(next, self.replay, None, callback=partial(self.send_replay_page, self.replay))
+        finally:
+            self.replay_paging = False
+
+    def send_replay_page(self, replay, page):
+        self.replay_loading = False
+        if replay is not self.replay or self.closed:
+            return  # logged out meanwhile
+        if page is None:
+            self.end_replay()
+            return
+        skip = {(chat_id, getattr(message, 'id', message)) for chat_id, message in self.replay_skip or ()}
+        for m in page:
+            if (m.chat_id, m.id) not in skip:
+                try:
+                    if m.chat_id == PERSONAL_CURSOR:
+                        self.send(PayloadMessage(CMD_MESSAGE, [m.by], m.data, msg_id=m.id))
+                    else:
+                        self.send(PayloadMessage(CMD_CHAT_MESSAGE, [str(m.chat_id), m.by], m.data, msg_id=m.id))
+                except UnsafePayload:
+                    log.warning("Message %d can't be sent to %r with protocol v%d, skipped", m.id, self,
+                                self.protocol_version)
+            self.replayed[m.chat_id] = m.id
+            self.delivered[m.chat_id] = m.id
+        if self.server:
+            self.server.pace_output(self)
+        self.on_writable()
+
+    def end_replay(self):
+        """
+        All offline messages are sent: move cursors to messages delivered live meanwhile
+        and apply ACKs of them, see acknowledge
+        """
+        live, self.replay_skip = self.replay_skip, None
+        self.replay = None
+        for chat_id, message in live or ():
+            message_id = getattr(message, 'id', message)
+            if message_id is None or message_id > self.replayed.get(chat_id, 0):
+                self.note_delivered(chat_id, message)
+        for chat_id in list(self.pending_acks):
+            if self.acknowledged.get(chat_id, 0) >= self.replayed.get(chat_id, 0):
+                self.acknowledged[chat_id] = max(self.acknowledged.get(chat_id, 0), self.pending_acks.pop(chat_id))
+        self.db.submit(update_user_last_online_ts, self.user.id)
+
     def handle(self, msg):
+        if self.db_busy:
+            self.deferred.append(msg)
+            return
         try:
-            msg_handler_func = getattr(self, self.handlers[msg.cmd])
+            msg_handler_func, auth_required = self.handlers[msg.cmd]
         except KeyError:
             raise NoHandlerForCmdRegisteredException(msg.cmd)
-        return msg_handler_func(msg)
+        if auth_required and not self.user:
+            raise ClientIsNotLoggedInException()
+        return msg_handler_func(self, msg)
+
+    @register_cmd(CMD_SERVICE)
+    @login_required
+    def service_info(self, msg):
+        """
+        Runtime metrics snapshot of the server as JSON, see server.metrics.
+        'SRV PROFILE [seconds]' and 'SRV MEMORY [seconds]' request profiling or memory capture,
+        see server.profiler. Users listed in config.admin_users only.
+        """
+        admin_users = self.server.config.admin_users if self.server else []
+        if self.user.name not in admin_users:
+            raise AdminRequiredException(msg.params[0] if msg.params else CMD_SERVICE)
+        if not msg.params:
+            self.send(PayloadMessage(CMD_INFO, [CMD_SERVICE], json.dumps(METRICS.snapshot())))
+            return
+        action = msg.params[0]
+        if action not in (SERVICE_PROFILE, SERVICE_MEMORY):
+            raise InvalidServiceRequest(msg.params)
+        try:
+            seconds = float(msg.params[1]) if len(msg.params) > 1 else None
+        except ValueError:
+            raise InvalidServiceRequest(msg.params)
+        if action == SERVICE_PROFILE:
+            requested = PROFILER.request_profile(seconds)
+        else:
+            requested = PROFILER.request_memory_capture(seconds)
+        log.warning("%s is requested by %s: %s", action, self.user.name, requested)
+        self.send(PayloadMessage(CMD_INFO, [CMD_SERVICE, action],
+                                 json.dumps({'requested': requested, 'directory': PROFILER.directory})))
+
+    @register_cmd(CMD_VERSION)
+    def negotiate_version(self, msg):
+        """
+        Switch connection to the highest protocol version supported by both sides.
+        Allowed before login only.
+        """
+        if self.user:
+            raise InvalidProtocolVersion("Protocol version can't be changed after login")
+        try:
+            requested = int(msg.params[0])
+        except (IndexError, ValueError):
+            raise InvalidProtocolVersion(msg.params)
+        version = min(requested, max(PROTOCOL_VERSIONS))
+        if version not in PROTOCOL_VERSIONS:
+            raise InvalidProtocolVersion(requested)
+
+        # reply is the same in all versions, everything after it is framed by the new one
+        self.send(NormalMessage(CMD_VERSION, [str(version)]))
+        self.protocol_version = version
+        log.info("%r uses protocol v%d", self, version)
 
     @register_cmd(CMD_LOGIN)
     def login_as(self, msg):
         """
-        Login client
+        Login client, 'USR <name> <password> ZLIB' enables payload compression (protocol v2),
+        see protocol.compression
         """
-        if len(msg.params) != 2:
+        if len(msg.params) not in (2, 3):
             raise InvalidUserCredentials()
         else:
-            name, password = msg.params
+            name, password = msg.params[:2]
+            flags = msg.params[2:]
+        if flags and (flags[0] != LOGIN_COMPRESSION or self.protocol_version == PROTOCOL_V1):
+            raise InvalidLoginFlag(flags[0])
         if self.user:
             raise ClientIsAlreadyLoggedInException(self.user)
-        user = get_user_by_name(name)
-        if user:
-            if user.name in ONLINE_USERS:
-                raise UserAlreadyLoggedInException(user.name)
-            else:
-                if user.password == password:
-                    log.info("{user} was logged in from {client}".format(user=user, client=self))
-                else:
-                    raise InvalidUserCredentials()
-                self.user = user
-                messages = get_messages(self.user, from_ts=self.user.last_online_ts)
-                for m in messages:
-                    self.send(PayloadMessage(CMD_MESSAGE, [m.by.name], m.data))
-
-                log.debug("{user} have next chats: {chats}".format(user=user, chats=self.user.chats))
-                for chat in self.user.chats:
-                    log.debug("{user} tried to get offline messages from chat {chat}".format(user=user, chat=chat))
-                    chat_messages = get_chat_messages(chat_id=chat.id, from_ts=self.user.last_online_ts)
-                    log.debug("Next messages was found: {}".format(chat_messages))
-                    for msg in chat_messages:
-                        self.send(PayloadMessage(CMD_CHAT_MESSAGE, [str(msg.chat_id), msg.by.name], msg.data))
-                update_user_last_online_ts(self.user)
-        else:
+        # users and their friends missing in cache are loaded by DB executor, see with_user
+        self.with_user(name, partial(self.check_credentials, password, flags))
+
+    def check_credentials(self, password, flags, user):
+        if not user or user.password != password:
             raise InvalidUserCredentials()
+        # friends are notified about the new status at login
+        self.with_friend_names(user, partial(self.log_in, user, flags))
+
+    def log_in(self, user, flags, friend_names):
+        if self.user:
+            raise ClientIsAlreadyLoggedInException(self.user)
+        if is_online(user.name):
+            raise UserAlreadyLoggedInException(user.name)
+        log.info("%r was logged in from %r", user, self)
+        if flags:
+            self.enable_compression()
+        # user is online right away, messages saved while offline ones are looked up
+        # are delivered live and skipped by the replay
+        self.replay_skip = []
+        self.cursors_saved_at = time.monotonic()
+        self.user = user
+        self.run_db(load_offline_messages, user.id, callback=self.start_replay)
+
+    def start_replay(self, replay):
+        if self.user:
+            self.replay = replay
+            self.on_writable()
 
     @register_cmd(CMD_LOGOUT)
     @login_required
@@ -138,9 +518,39 @@ class Client(BaseClient):
         """
         Logout client
         """
-        log.info("{user} logged out from {client}".format(user=self.user, client=self))
-        update_user_last_online_ts(self.user)
+        log.info("%r logged out from %r", self.user, self)
+        user_id = self.user.id
+        self.replay = None
+        self.replay_skip = None
         self.user = None
+        self.run_db(save_logout_state, user_id, self.take_delivery_cursors())
+
+    @register_cmd(CMD_MSG_ACK)
+    @login_required
+    def acknowledge(self, msg):
+        """
+        Client has got messages: 'ACK <id>' - personal messages up to id, 'ACK <chat_id> <id>' - chat messages
+        """
+        try:
+            if len(msg.params) == 1:
+                chat_id, message_id = PERSONAL_CURSOR, int(msg.params[0])
+            else:
+                chat_id, message_id = int(msg.params[0]), int(msg.params[1])
+        except (IndexError, ValueError):
+            raise InvalidAck(msg.params)
+        acknowledged = self.acknowledged.get(chat_id, 0)
+        if message_id <= acknowledged:
+            return
+        replayed = self.replayed.get(chat_id, 0)
+        if message_id > replayed and (self.replay_skip is not None or acknowledged < replayed):
+            # live message sent before offline ones the client hasn't acknowledged yet,
+            # ACK doesn't cover them until it does
+            self.pending_acks[chat_id] = max(message_id, self.pending_acks.get(chat_id, 0))
+            return
+        self.acknowledged[chat_id] = message_id
+        if self.replay_skip is None and message_id >= replayed and chat_id in self.pending_acks:
+            self.acknowledged[chat_id] = max(message_id, self.pending_acks.pop(chat_id))
+        self.cursor_moved()
 
     @register_cmd(CMD_FRIENDS)
     @login_required
@@ -148,13 +558,17 @@ class Client(BaseClient):
         """
         Returns dict {friend's name: info}
         """
+        self.with_friend_names(self.user, self.send_friends)
+
+    def send_friends(self, friend_names):
         online_only = False  # TODO: to message params
         res = {}
-        for friend in self.user.all_friends:
-            if friend.name in ONLINE_USERS:
-                res[friend.name] = ONLINE_USERS[friend.name].status
+        for friend_name in friend_names:
+            client = get_online_client(friend_name)
+            if client:
+                res[friend_name] = client.status
             elif not online_only:
-                res[friend.name] = CLIENT_OFFLINE
+                res[friend_name] = CLIENT_OFFLINE
         self.send(PayloadMessage(CMD_INFO, [], res))
 
     @register_cmd(CMD_MESSAGE)
@@ -163,17 +577,20 @@ class Client(BaseClient):
         # verify msg
         to = msg.params[0]
         # verify to
-        user_to = get_user_by_name(to)
+        self.with_user(to, partial(self.check_friend, msg))
+
+    def check_friend(self, msg, user_to):
         if not user_to:
-            raise NoSuchUserException(to)
-        if user_to.name not in [u.name for u in self.user.all_friends]:
-            raise NoSuchFriendException(to)
+            raise NoSuchUserException(msg.params[0])
+        self.with_friend_names(self.user, partial(self.save_message, msg, user_to))
 
-        # save msg to db
-        create_message(user_to, self.user, msg.payload)
+    def save_message(self, msg, user_to, friend_names):
+        if user_to.name not in friend_names:
+            raise NoSuchFriendException(user_to.name)
 
-        if user_to.name in ONLINE_USERS:
-            ONLINE_USERS[to].send(PayloadMessage(msg.cmd, [self.user.name], msg.payload))
+        # save msg to db, recipient gets it when it's saved (see MessageWriter durability)
+        out_msg = PayloadMessage(msg.cmd, [self.user.name], msg.payload)
+        create_message(user_to, self.user, msg.payload, on_commit=partial(deliver, user_to.name, out_msg))
 
     @register_cmd(CMD_CREATE_CHAT)
     @login_required
@@ -182,10 +599,12 @@ class Client(BaseClient):
         Create new chat and send new chat id back to the client
         """
         chat_name = msg.params[0]
-        new_chat = create_chat(chat_name, self.user)
+        self.run_db(insert_chat, chat_name, self.user.id, callback=partial(self.chat_created, chat_name))
 
-        log.info("New chat '{}' has been created".format(new_chat))
-        self.send(PayloadMessage(CMD_INFO, [], str(new_chat.id)))
+    def chat_created(self, chat_name, chat_id):
+        CHAT_CACHE.rosters[chat_id] = ChatRoster(chat_id, self.user.name, frozenset([self.user.name]))
+        log.info("New chat '%s' has been created, id: %d", chat_name, chat_id)
+        self.send(PayloadMessage(CMD_INFO, [], str(chat_id)))
 
     @register_cmd(CMD_ADD_CHAT_PARTICIPANT)
     @login_required
@@ -194,14 +613,27 @@ class Client(BaseClient):
         Add new participants to the chat
         """
         chat_id = msg.params[0]
-        participant_name = msg.params[1]
-        chat = get_chat_by_id(chat_id)
-        if not chat:
-            raise InvalidChatID(chat)
-        if self.user.name not in [user.name for user in chat.users]:
-            raise InvalidChatID
+        self.with_chat_roster(chat_id, partial(self.check_participant, chat_id, msg.params[1]))
+
+    def check_participant(self, chat_id, participant_name, roster):
+        if not roster or self.user.name not in roster.members:
+            raise InvalidChatID(chat_id)
+        self.with_user(participant_name, partial(self.add_participant, roster, participant_name))
+
+    def add_participant(self, roster, participant_name, participant):
+        if not participant:
+            raise NoSuchUserException(participant_name)
+        if participant_name in roster.members:
+            return
 
-        add_chat_participant(chat_id, participant_name)
+        self.run_db(insert_chat_member, roster.chat_id, participant.id,
+                    callback=partial(self.chat_participant_added, roster.chat_id, participant_name))
+
+    def chat_participant_added(self, chat_id, participant_name, result):
+        roster = CHAT_CACHE.rosters.get(chat_id)
+        if roster:
+            CHAT_CACHE.rosters[chat_id] = roster._replace(members=roster.members | {participant_name})
+        CHAT_CACHE.changed(chat_id)
 
     @register_cmd(CMD_GET_CHATS)
     @login_required
@@ -209,7 +641,10 @@ class Client(BaseClient):
         """
         get all available chats for user
         """
-        self.send(PayloadMessage(CMD_INFO, [], self.user.chats))
+        self.run_db(get_user_chats_info, self.user.id, callback=partial(self.send_info, []))
+
+    def send_info(self, params, payload):
+        self.send(PayloadMessage(CMD_INFO, params, payload))
 
     @register_cmd(CMD_CHAT_MESSAGE)
     @login_required
@@ -217,27 +652,17 @@ class Client(BaseClient):
         """
         Send message to all online users in chat
         """
-        log.info('User {user} sent message {msg} to chat'.format(user=self.user, msg=msg))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('User %r sent message %r to chat', self.user, msg)
         chat_id = msg.params[0]
         # verify to
-        chat = get_chat_by_id(chat_id)
-        if not chat:
-            raise InvalidChatID(chat)
-        users_to = [user.name for user in chat.users]
-        log.debug('Found users {users_to} for chat with id {chat_id}'.format(users_to=users_to, chat_id=chat_id))
+        self.with_chat_roster(chat_id, partial(self.save_chat_message, msg))
 
-        if not users_to or self.user.name not in users_to:
+    def save_chat_message(self, msg, roster):
+        chat_id = msg.params[0]
+        if not roster or self.user.name not in roster.members:
             raise InvalidChatID(chat_id)
 
-        create_chat_message(chat, self.user, msg.payload)
-
-        for user_to in users_to:
-            if user_to == self.user.name:
-                continue
-            if user_to in ONLINE_USERS:
-                # send msg
-                log.info('Send MSG {msg} for chat with id {chat_id} to {usr}'.format(
-                    msg=msg.payload, chat_id=chat_id, usr=users_to))
-                ONLINE_USERS[user_to].send(PayloadMessage(msg.cmd, [chat_id, self.user.name], msg.payload))
-            else:
-                log.debug("User {} isn't online".format(user_to))
+        out_msg = PayloadMessage(msg.cmd, [chat_id, self.user.name], msg.payload)
+        create_chat_message(roster.chat_id, self.user, msg.payload,
+                            on_commit=partial(deliver_to_chat, roster, self.user.name, out_msg))
@@ -0,0 +1,402 @@
+import json
+import sys
+import time
+import unittest
+from functools import partial
+from types import SimpleNamespace
+from unittest import mock
+
+from server.client import Client, cmd_handler_cls, register_cmd, login_required, save_logout_state, deliver, \
+    deliver_to_chat, load_offline_messages, InvalidUserCredentials, \
+    ClientIsNotLoggedInException, NoHandlerForCmdRegisteredException, AdminRequiredException, InvalidServiceRequest, \
+    CURSOR_SAVE_MOVES
+from server.base_client_test import FakeConnection, FakeServer
+from server.config import Config
+from server.metrics import METRICS
+from server.profiler import PROFILER
+from server.models.writer import MessageWriter, DURABILITY_IMMEDIATE
+from server.models.writer_test import ManualExecutor, FakeSession
+from server.models import init_db
+from server.models.utils import OfflineMessage, ChatRoster, PERSONAL_CURSOR, USER_CACHE, CHAT_CACHE, \
+    save_delivery_cursors, create_users, make_friends, create_chat, load_user, load_friend_names, load_chat_roster
+from server.online import ONLINE_USERS
+from protocol.data_utils import DataBuffer, DataParser
+from protocol.messages import NormalMessage, ServiceMessage, CMD_GET_CHATS, CMD_LOGOUT, CMD_VERSION, CMD_INFO, \
+    CMD_SERVICE, CMD_MSG_ACK, CMD_MESSAGE, CMD_CHAT_MESSAGE, CMD_LOGIN, PROTOCOL_V1, PROTOCOL_V2, SERVICE_PROFILE, \
+    PayloadMessage
+
+
+CMD_PING = 'PNG'
+CMD_AUTH_PING = 'PNA'
+CMD_QUERY = 'QRY'
+
+
+@cmd_handler_cls
+class PingClient(Client):
+    """
+    Client with handlers of its own, see bench/dispatch.py for dispatch timing
+    """
+
+    user = 'ping'  # pretends to be logged in
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pings = []
+
+    @register_cmd(CMD_PING)
+    def ping(self, msg):
+        self.pings.append(msg.cmd)
+
+    @register_cmd(CMD_AUTH_PING)
+    @login_required
+    def auth_ping(self, msg):
+        self.pings.append(msg.cmd)
+
+
+@cmd_handler_cls
+class QueryClient(Client):
+    """
+    Client with a command doing DB call
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handled = []
+
+    @register_cmd(CMD_PING)
+    def ping(self, msg):
+        self.handled.append(msg.params[0])
+
+    @register_cmd(CMD_QUERY)
+    def query(self, msg):
+        self.run_db(str.upper, msg.params[0], callback=self.handled.append)
+
+
+class AdminClient(Client):
+
+    user = SimpleNamespace(name='admin')  # pretends to be logged in
+
+
+class ReplayClient(Client):
+
+    user = SimpleNamespace(id=1, name='userB')  # pretends to be logged in
+
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client(FakeConnection(capacity=1024))
+
+    def test_table_is_built(self):
+        self.assertEqual(Client.handlers[CMD_VERSION], (Client.negotiate_version, False))
+        handler, auth_required = Client.handlers[CMD_LOGOUT]
+        self.assertIs(handler, Client.logout.__wrapped__)
+        self.assertTrue(auth_required)
+
+    def test_subclass_table(self):
+        self.assertIn(CMD_PING, PingClient.handlers)
+        self.assertNotIn(CMD_PING, Client.handlers)
+        client = PingClient(FakeConnection(capacity=0))
+        for cmd in [CMD_PING, CMD_AUTH_PING]:
+            client.handle(NormalMessage(cmd, []))
+        self.assertEqual(client.pings, [CMD_PING, CMD_AUTH_PING])
+
+    def test_unknown_cmd(self):
+        with self.assertRaises(NoHandlerForCmdRegisteredException):
+            self.client.handle(NormalMessage('XXX', []))
+
+    def test_login_required(self):
+        with self.assertRaises(ClientIsNotLoggedInException):
+            self.client.handle(NormalMessage(CMD_GET_CHATS, []))
+
+    def test_handler_is_called(self):
+        self.client.handle(NormalMessage(CMD_VERSION, [str(PROTOCOL_V2)]))
+        self.assertEqual(self.client.protocol_version, PROTOCOL_V2)
+
+    def test_service_info(self):
+        with self.assertRaises(ClientIsNotLoggedInException):
+            self.client.handle(ServiceMessage(cmd=CMD_SERVICE))
+        server = FakeServer()
+        server.config = Config()
+        with self.assertRaises(AdminRequiredException):
+            AdminClient(FakeConnection(capacity=1024), server).handle(ServiceMessage(cmd=CMD_SERVICE))
+        server.config.admin_users = ['admin']
+        client = AdminClient(FakeConnection(capacity=1024 * 1024), server)
+        handled = METRICS.handlers[CMD_SERVICE].wall.count
+        client.recv(ServiceMessage(cmd=CMD_SERVICE).as_bytes() * 2)
+        replies = [DataParser().parse(frame) for frame in DataBuffer().push(client.conn.sent)]
+        self.assertEqual([(msg.cmd, msg.params) for msg in replies], [(CMD_INFO, [CMD_SERVICE])] * 2)
+        # every frame is timed, the first one is counted by the time of the second
+        self.assertEqual(json.loads(replies[1].payload)['handlers'][CMD_SERVICE]['count'], handled + 1)
+
+    def test_profile_request(self):
+        server = FakeServer()
+        server.config = Config()
+        with self.assertRaises(AdminRequiredException):
+            AdminClient(FakeConnection(capacity=1024), server).handle(ServiceMessage(cmd=CMD_SERVICE,
+                                                                                    params=[SERVICE_PROFILE]))
+        server.config.admin_users = ['admin']
+        client = AdminClient(FakeConnection(capacity=1024), server)
+        with self.assertRaises(InvalidServiceRequest):
+            client.handle(ServiceMessage(cmd=CMD_SERVICE, params=[SERVICE_PROFILE, 'soon']))
+        self.addCleanup(setattr, PROFILER, 'profile_requested', None)
+        client.handle(ServiceMessage(cmd=CMD_SERVICE, params=[SERVICE_PROFILE, '2']))
+        self.assertEqual(PROFILER.profile_requested, 2)
+        msg = DataParser().parse(client.conn.sent[:client.conn.sent.rindex(b'..')])
+        self.assertEqual((msg.cmd, msg.params), (CMD_INFO, [CMD_SERVICE, SERVICE_PROFILE]))
+        self.assertTrue(json.loads(msg.payload)['requested'])
+
+
+class TestDBCalls(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ManualExecutor()
+        self.client = QueryClient(FakeConnection(capacity=1024), db_executor=self.executor)
+
+    def test_commands_wait_for_db_call(self):
+        self.client.handle(NormalMessage(CMD_QUERY, ['a']))
+        self.client.handle(NormalMessage(CMD_PING, ['b']))
+        self.client.handle(NormalMessage(CMD_QUERY, ['c']))
+        self.client.handle(NormalMessage(CMD_PING, ['d']))
+        self.assertEqual(self.client.handled, [])
+
+        self.executor.complete()
+        self.assertEqual(self.client.handled, ['A', 'b'])
+        self.executor.complete()
+        self.assertEqual(self.client.handled, ['A', 'b', 'C', 'd'])
+        self.assertFalse(self.client.db_busy)
+
+    def test_failed_db_call(self):
+        self.client.run_db(int, 'x')
+        self.client.handle(NormalMessage(CMD_PING, ['a']))
+        with self.assertLogs('server.client', 'ERROR'):
+            self.executor.complete()
+        self.assertEqual(self.client.handled, ['a'])
+
+    def test_closed_client(self):
+        self.client.handle(NormalMessage(CMD_QUERY, ['a']))
+        self.client.handle(NormalMessage(CMD_PING, ['b']))
+        self.client.close()
+        self.executor.complete()
+        self.assertEqual(self.client.handled, [])
+
+
+class TestOfflineReplay(unittest.TestCase):
+
+    def test_replay_is_paced_by_watermarks(self):
+        conn = FakeConnection(capacity=0)
+        client = Client(conn, write_high_watermark=50, write_low_watermark=10)
+        loaded = []
+
+        def pages():
+            for n in range(10):
+                loaded.append(n)
+                yield [OfflineMessage(n, PERSONAL_CURSOR, 'userA', 'message {}'.format(n))]
+
+        client.replay = pages()
+        client.on_writable()
+        self.assertTrue(client.output_blocked)
+        self.assertEqual(len(loaded), 2)  # 2 frames of 25 bytes reach the high watermark
+
+        conn.capacity = 50
+        client.flush()
+        client.on_writable()
+        self.assertEqual(len(loaded), 4)
+        self.assertEqual(conn.sent, b'MSG userA 9||message 0..\nMSG userA 9||message 1..\n')
+        self.assertIsNotNone(client.replay)
+
+    def test_pages_loaded_right_away_are_sent_in_a_loop(self):
+        conn = FakeConnection(capacity=10 ** 9)
+        client = Client(conn)  # pages are loaded by INLINE_EXECUTOR
+        count = sys.getrecursionlimit() * 2
+
+        def pages():
+            for n in range(count):
+                yield [OfflineMessage(n, PERSONAL_CURSOR, 'userA', 'm')]
+            client.replay = None  # as if logged out, no DB call at the end of replay
+
+        client.replay = pages()
+        client.on_writable()
+        self.assertEqual(conn.sent.count(b'MSG userA 1||m..\n'), count)
+        self.assertEqual(client.delivered[PERSONAL_CURSOR], count - 1)
+
+
+class TestDeliveryCursors(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ManualExecutor()
+        self.client = ReplayClient(FakeConnection(capacity=10 ** 6), db_executor=self.executor)
+        self.client.replay_skip = []  # as if logged in
+
+    def start_replay(self, *pages):
+        """
+        Send first page of offline personal messages with given ids, the next one is being loaded
+        """
+        self.client.replay = iter([[OfflineMessage(n, PERSONAL_CURSOR, 'userA', 'm') for n in page]
+                                   for page in pages])
+        self.client.on_writable()
+        self.executor.complete()
+
+    def end_replay(self):
+        self.executor.complete()  # no more pages
+        self.assertIsNone(self.client.replay)
+        self.executor.calls.clear()  # last online time
+
+    def ack(self, message_id):
+        self.client.handle(NormalMessage(CMD_MSG_ACK, [str(message_id)]))
+
+    def logout_cursors(self):
+        self.client.logout()
+        func, args, callback, errback = self.executor.calls[-1]
+        self.assertIs(func, save_logout_state)
+        return args[1]
+
+    def test_logout_during_replay(self):
+        self.start_replay(range(101, 121), range(121, 200))
+        self.client.note_delivered(PERSONAL_CURSOR, 200)  # live message
+
+        self.assertEqual(self.logout_cursors(), {PERSONAL_CURSOR: 120})
+
+    def test_ack_during_replay(self):
+        self.client.protocol_version = PROTOCOL_V2
+        self.start_replay(range(101, 121), range(121, 200))
+        self.client.note_delivered(PERSONAL_CURSOR, 200)
+        self.ack(200)
+        self.ack(110)
+
+        self.assertEqual(self.logout_cursors(), {PERSONAL_CURSOR: 110})
+
+    def test_live_messages_are_merged_when_replay_ends(self):
+        self.start_replay(range(101, 121))
+        self.client.note_delivered(PERSONAL_CURSOR, 200)
+        self.client.note_delivered(PERSONAL_CURSOR, 115)  # saved before offline messages were looked up
+        self.assertEqual(self.client.delivered, {PERSONAL_CURSOR: 120})
+        self.end_replay()
+
+        self.assertEqual(self.logout_cursors(), {PERSONAL_CURSOR: 200})
+
+    def test_acks_of_live_messages_wait_for_replayed_ones(self):
+        self.client.protocol_version = PROTOCOL_V2
+        self.start_replay(range(101, 121))
+        self.client.note_delivered(PERSONAL_CURSOR, 200)
+        self.ack(200)
+        self.end_replay()
+        self.ack(119)
+        self.assertEqual(self.client.acknowledged, {PERSONAL_CURSOR: 119})
+        self.ack(120)
+
+        self.assertEqual(self.logout_cursors(), {PERSONAL_CURSOR: 200})
+
+    def test_cursors_are_saved_in_batches(self):
+        self.client.protocol_version = PROTOCOL_V2
+        self.client.replay_skip = None
+        self.client.cursors_saved_at = time.monotonic()
+        for n in range(1, CURSOR_SAVE_MOVES * 2 + 1):
+            self.ack(n)
+
+        saved = [args for func, args, callback, errback in self.executor.calls]
+        self.assertEqual(saved, [(1, {PERSONAL_CURSOR: CURSOR_SAVE_MOVES}),
+                                 (1, {PERSONAL_CURSOR: CURSOR_SAVE_MOVES * 2})])
+        self.assertTrue(all(call[0] is save_delivery_cursors for call in self.executor.calls))
+
+
+def online_client(test, name, version):
+    """
+    :return: Client of user `name` registered in ONLINE_USERS until the end of the test
+    """
+    client = type('OnlineClient', (Client,), {'user': SimpleNamespace(id=0, name=name)})(
+        FakeConnection(capacity=10 ** 6))
+    client.protocol_version = version
+    client.cursors_saved_at = time.monotonic()  # as if logged in just now
+    ONLINE_USERS.add(client)
+    test.addCleanup(ONLINE_USERS.remove, name)
+    return client
+
+
+class TestUnsafePayload(unittest.TestCase):
+
+    def test_mixed_chat(self):
+        v1 = online_client(self, 'userV1', PROTOCOL_V1)
+        v2 = online_client(self, 'userV2', PROTOCOL_V2)
+        roster = ChatRoster(7, 'userA', frozenset(['userA', 'userV1', 'userV2']))
+        row = SimpleNamespace(id=42)
+        # would be 'CMS 7 userA 9||one..' and 'two..' frames for v1 client
+        deliver_to_chat(roster, 'userA', PayloadMessage(CMD_CHAT_MESSAGE, ['7', 'userA'], 'one..\ntwo'), row)
+        deliver(v1.user.name, PayloadMessage(CMD_MESSAGE, ['userA'], 'one..\ntwo'), row)
+
+        self.assertEqual(v1.conn.sent, b'')
+        self.assertEqual(v2.conn.sent, b'CMS 7 userA 42 9||one..\ntwo..\n')
+        # skipped messages aren't replayed either
+        self.assertEqual((v1.delivered, v2.delivered), ({7: row, PERSONAL_CURSOR: row}, {7: row}))
+
+
+class TestImmediateDurability(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = MessageWriter(FakeSession(), batch_size=10, durability=DURABILITY_IMMEDIATE)
+        patcher = mock.patch('server.client.MESSAGE_WRITER', self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.v1 = online_client(self, 'userV1', PROTOCOL_V1)
+        self.v2 = online_client(self, 'userV2', PROTOCOL_V2)
+
+    def test_v2_clients_get_messages_with_ids(self):
+        row = SimpleNamespace(id=None)  # not committed yet
+        roster = ChatRoster(7, 'userA', frozenset(['userA', 'userV1', 'userV2']))
+        self.writer.add(row, on_commit=partial(deliver_to_chat, roster, 'userA',
+                                               PayloadMessage(CMD_CHAT_MESSAGE, ['7', 'userA'], 'hi')))
+        self.writer.add(row, on_commit=partial(deliver, 'userV2', PayloadMessage(CMD_MESSAGE, ['userA'], 'hey')))
+        self.assertEqual(self.v1.conn.sent, b'CMS 7 userA 2||hi..\n')
+        self.assertEqual(self.v2.conn.sent, b'')
+
+        row.id = 42
+        self.writer.flush()
+        self.assertEqual(self.v2.conn.sent, b'CMS 7 userA 42 2||hi..\nMSG userA 42 3||hey..\n')
+        self.assertEqual(self.v1.conn.sent, b'CMS 7 userA 2||hi..\n')
+
+
+class TestCacheMisses(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        init_db('sqlite:///:memory:')
+        users = create_users(name_pass=[('missA', 'passA'), ('missB', 'passB')])
+        make_friends(users['missA'], [users['missB']])
+        cls.chat_id = create_chat('misses', users['missA'], [users['missB']]).id
+
+    def setUp(self):
+        USER_CACHE.clear()
+        CHAT_CACHE.clear()
+        self.executor = ManualExecutor()
+        self.client = Client(FakeConnection(capacity=10 ** 6), db_executor=self.executor)
+
+    def submitted(self):
+        return [func for func, args, callback, errback in self.executor.calls]
+
+    def test_users_and_rosters_are_loaded_by_executor(self):
+        self.client.handle(NormalMessage(CMD_LOGIN, ['missA', 'passA']))
+        self.assertEqual(self.submitted(), [load_user])
+        self.executor.complete()
+        self.assertEqual(self.submitted(), [load_friend_names])
+        self.executor.complete()
+        self.addCleanup(setattr, self.client, 'user', None)
+        self.assertEqual(self.client.user.name, 'missA')
+        self.assertEqual(self.submitted(), [load_offline_messages])
+        while self.executor.calls:
+            self.executor.complete()
+
+        self.client.handle(PayloadMessage(CMD_CHAT_MESSAGE, [str(self.chat_id)], 'hi'))
+        self.assertEqual(self.submitted(), [load_chat_roster])
+        self.executor.complete()
+        self.assertEqual(CHAT_CACHE.rosters[self.chat_id].members, {'missA', 'missB'})
+
+    def test_wrong_password(self):
+        self.client.handle(NormalMessage(CMD_LOGIN, ['missA', 'passB']))
+        with self.assertRaises(InvalidUserCredentials):
+            self.executor.complete()
+        self.assertFalse(self.client.user)
+        self.assertFalse(self.client.db_busy)
+
+
+if __name__ == '__main__':
+    unittest.main()
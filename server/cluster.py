@@ -0,0 +1,373 @@
+import collections
+import logging
+import os
+import selectors
+import socket
+
+from server.online import ONLINE_USERS, REMOTE_USERS, PRESENCE_LISTENERS
+from server.models.utils import CHAT_CACHE
+from protocol.messages import Message, PROTOCOL_V1
+
+
+log = logging.getLogger(__name__)
+
+
+"""
+Presence and routing between worker processes (see `--workers` option of server/run.py).
+
+Every worker binds a unix datagram socket <run_dir>/worker-<id>.sock and tells other
+workers about presence changes of its local users. Packets are sent by non-blocking sockets connected
+to the peers, the ones a peer has no room for wait in its queue (see Peer). Packets:
+
+- HELLO <worker_id> - worker is up, peers reply with UP for all their online users
+- UP <worker_id> <name> <status> <protocol_version> - user is online (or changed status) on worker
+- DOWN <worker_id> <name> - user went offline
+- MSG <name>\\n<data> - deliver raw data to user connected to receiving worker
+- SEEN <name> <chat_id> <message_id> - message was delivered to user, moves user's delivery cursor
+- CHAT <chat_id> - members of the chat have changed, cached roster is dropped (loaded from DB when needed)
+- PART <worker_id>\n<data>, LAST <worker_id>\n<data> - packet bigger than PACKET_SIZE_MAX is sent in chunks,
+  the receiver joins data of PART packets of the worker and of the LAST one and handles the result
+"""
+
+PACKET_HELLO = b'HELLO'
+PACKET_UP = b'UP'
+PACKET_DOWN = b'DOWN'
+PACKET_MSG = b'MSG'
+PACKET_SEEN = b'SEEN'
+PACKET_CHAT = b'CHAT'
+PACKET_PART = b'PART'
+PACKET_LAST = b'LAST'
+
+PACKET_SIZE_MAX = 65536  # bytes, bigger packets are sent in chunks
+CHUNK_SIZE = PACKET_SIZE_MAX - 32  # room for the chunk header
+PEER_QUEUE_MAX = 64 * 1024 * 1024  # bytes waiting for a peer, packets are dropped beyond that
+
+
+class RemoteClient:
+    """
+    Stand-in for a client connected to another worker
+    """
+
+    def __init__(self, name, worker_id, status, router, protocol_version=PROTOCOL_V1):
+        self.name = name
+        self.worker_id = worker_id
+        self.status = status
+        self.router = router
+        self.protocol_version = protocol_version
+        # frames are forwarded to the worker as they are, payloads aren't compressed for the user's connection
+        self.compress = None
+
+    def __repr__(self):
+        return "RemoteClient({name}@{worker_id})".format(name=self.name, worker_id=self.worker_id)
+
+    def send(self, msg):
+        """
+        Route Message or bytes to the worker which user is connected to
+        @param msg: Message subclass instance or bytes or string or list of bytes-like chunks of a frame
+        """
+        if type(msg) is str:
+            msg = msg.encode('utf-8')
+        if isinstance(msg, Message):
+            msg = msg.as_bytes(self.protocol_version)
+        if type(msg) is list:
+            msg = b''.join(msg)
+        self.router.deliver(self.worker_id, self.name, msg)
+
+    def note_delivered(self, chat_id, message):
+        """
+        Delivery cursors of the user are kept by the worker which user is connected to
+        @param chat_id: chat id or PERSONAL_CURSOR
+        @param message: message id or saved message
+        """
+        message_id = getattr(message, 'id', message)
+        if message_id is not None:
+            self.router.send_to(self.worker_id, b' '.join([PACKET_SEEN, self.name.encode('utf-8'),
+                                                           str(chat_id).encode(), str(message_id).encode()]))
+
+
+class Peer:
+    """
+    Non-blocking datagram socket connected to another worker and packets waiting for room in its receive queue
+    """
+
+    def __init__(self, worker_id, path):
+        self.worker_id = worker_id
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        try:
+            self.socket.connect(path)
+        except OSError:
+            self.socket.close()
+            raise
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        self.registered = False  # waits for write events
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def flush(self):
+        """
+        Send queued packets while the peer has room for them
+        :return: True if all of them were sent
+        """
+        while self.queue:
+            try:
+                self.socket.send(self.queue[0])
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.queued_bytes -= len(self.queue.popleft())
+        return True
+
+    def close(self):
+        self.socket.close()
+
+
+class ClusterRouter:
+
+    def __init__(self, worker_id, workers, run_dir, local_users=ONLINE_USERS, remote_users=REMOTE_USERS,
+                 chat_cache=CHAT_CACHE):
+        self.worker_id = worker_id
+        self.workers = workers
+        self.run_dir = run_dir
+        self.local_users = local_users
+        self.remote_users = remote_users
+        self.chat_cache = chat_cache
+        self.socket = None  # bound, non-blocking, to receive packets
+        self.connections = {}  # {worker id: Peer}
+        self.partial = {}  # {worker id: chunks of a packet being received}
+        self.selector = None
+
+    def path(self, worker_id):
+        return os.path.join(self.run_dir, 'worker-{worker_id}.sock'.format(worker_id=worker_id))
+
+    @property
+    def peers(self):
+        return [worker_id for worker_id in range(self.workers) if worker_id != self.worker_id]
+
+    def setup(self, selector=None):
+        """
+        Bind worker socket and say hello to other workers
+        :param selector: server loop selector, worker socket and peers waiting for room are registered in it
+        :return: None
+        """
+        if not os.path.exists(self.run_dir):
+            os.makedirs(self.run_dir, exist_ok=True)
+        path = self.path(self.worker_id)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+        self.socket.setblocking(False)
+        self.selector = selector
+        if selector:
+            selector.register(fileobj=self.socket, events=selectors.EVENT_READ, data=self.on_read)
+        PRESENCE_LISTENERS.append(self.publish)
+        self.chat_cache.listeners.append(self.publish_chat)
+        self.broadcast(b' '.join([PACKET_HELLO, str(self.worker_id).encode()]))
+        log.info("Worker {worker_id} is listening on {path}".format(worker_id=self.worker_id, path=path))
+
+    def close(self):
+        if self.publish in PRESENCE_LISTENERS:
+            PRESENCE_LISTENERS.remove(self.publish)
+        if self.publish_chat in self.chat_cache.listeners:
+            self.chat_cache.listeners.remove(self.publish_chat)
+        for worker_id in list(self.connections):
+            self.disconnect(worker_id)
+        if self.socket:
+            if self.selector:
+                self.selector.unregister(self.socket)
+            self.socket.close()
+            self.socket = None
+        try:
+            os.unlink(self.path(self.worker_id))
+        except OSError:
+            pass
+
+    def send_to(self, worker_id, packet):
+        """
+        Send packet to another worker, or queue it until the worker has room for it
+        :return: True if packet was sent or queued
+        """
+        try:
+            peer = self.connections.get(worker_id) or self.connect(worker_id)
+        except FileNotFoundError:
+            return False  # worker is not up yet
+        except ConnectionRefusedError:
+            self.forget_worker(worker_id)
+            return False
+        if peer.queued_bytes + len(packet) > PEER_QUEUE_MAX:
+            log.error("Packet to worker {worker_id} dropped: {size} bytes are queued already".format(
+                worker_id=worker_id, size=peer.queued_bytes))
+            return False
+        was_empty = not peer.queue
+        packets = self.split(packet)
+        peer.queue.extend(packets)
+        peer.queued_bytes += sum(map(len, packets))
+        if was_empty:
+            self.flush(peer)
+        return True
+
+    def split(self, packet):
+        """
+        :return: list of packets to send: the packet itself or its chunks, see PACKET_PART
+        """
+        if len(packet) <= PACKET_SIZE_MAX:
+            return [packet]
+        worker_id = str(self.worker_id).encode()
+        view = memoryview(packet)
+        chunks = [view[i:i + CHUNK_SIZE] for i in range(0, len(packet), CHUNK_SIZE)]
+        return [b''.join([PACKET_PART if n < len(chunks) - 1 else PACKET_LAST, b' ', worker_id, b'\n', chunk])
+                for n, chunk in enumerate(chunks)]
+
+    def connect(self, worker_id):
+        peer = Peer(worker_id, self.path(worker_id))
+        self.connections[worker_id] = peer
+        return peer
+
+    def disconnect(self, worker_id):
+        peer = self.connections.pop(worker_id, None)
+        if peer:
+            if peer.registered:
+                self.selector.unregister(peer)
+            peer.close()
+
+    def flush(self, peer):
+        """
+        Send packets queued for the peer, wait for write event if it has no room for them
+        :return: None
+        """
+        while True:
+            try:
+                sent = peer.flush()
+                break
+            except ConnectionRefusedError:
+                self.forget_worker(peer.worker_id)
+                return
+            except OSError as e:
+                dropped = peer.queue.popleft()
+                peer.queued_bytes -= len(dropped)
+                log.error("Packet to worker {worker_id} dropped: {err!r}".format(worker_id=peer.worker_id, err=e))
+        if not self.selector:
+            return  # the rest is sent with the next packet
+        if sent and peer.registered:
+            self.selector.unregister(peer)
+            peer.registered = False
+        elif not sent and not peer.registered:
+            self.selector.register(fileobj=peer, events=selectors.EVENT_WRITE, data=self.on_writable)
+            peer.registered = True
+
+    def on_writable(self, peer, mask=None):
+        """
+        Callback for write events on a peer socket
+        :return: None
+        """
+        self.flush(peer)
+
+    def broadcast(self, packet):
+        for worker_id in self.peers:
+            self.send_to(worker_id, packet)
+
+    def forget_worker(self, worker_id):
+        """
+        Worker has gone: drop the connection to it, packets queued for it and its users
+        """
+        log.warning("Worker {worker_id} is not available".format(worker_id=worker_id))
+        self.disconnect(worker_id)
+        self.partial.pop(worker_id, None)
+        for name in [name for name, client in self.remote_users.items() if client.worker_id == worker_id]:
+            del self.remote_users[name]
+
+    def publish(self, name, status):
+        """
+        Presence listener: tell other workers about local user status
+        :param name: user name
+        :param status: new status, None if user went offline
+        :return: None
+        """
+        if status:
+            self.broadcast(self._up_packet(name, status))
+        else:
+            self.broadcast(b' '.join([PACKET_DOWN, str(self.worker_id).encode(), name.encode('utf-8')]))
+
+    def publish_chat(self, chat_id):
+        """
+        Chat cache listener: tell other workers to drop cached roster of the chat
+        :param chat_id: int
+        :return: None
+        """
+        self.broadcast(b' '.join([PACKET_CHAT, str(chat_id).encode()]))
+
+    def _up_packet(self, name, status):
+        client = self.local_users.get(name)
+        version = getattr(client, 'protocol_version', PROTOCOL_V1)
+        return b' '.join([PACKET_UP, str(self.worker_id).encode(), name.encode('utf-8'), status.encode('utf-8'),
+                          str(version).encode()])
+
+    def deliver(self, worker_id, name, data):
+        """
+        Send data to user connected to another worker
+        """
+        self.send_to(worker_id, PACKET_MSG + b' ' + name.encode('utf-8') + b'\n' + bytes(data))
+
+    def on_read(self, sock=None, mask=None):
+        """
+        Callback for read events on worker socket, handles all pending packets
+        :return: None
+        """
+        while True:
+            try:
+                packet = self.socket.recv(PACKET_SIZE_MAX)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                self.handle(packet)
+            except Exception:
+                log.exception("Unable to handle cluster packet {packet!r}".format(packet=packet[:64]))
+
+    def handle(self, packet):
+        header, _, data = packet.partition(b'\n')
+        fields = header.decode('utf-8').split(' ')
+        kind = fields[0].encode()
+        if kind == PACKET_MSG:
+            name = fields[1]
+            client = self.local_users.get(name)
+            if client:
+                client.send(data)
+            else:
+                log.warning("{name} isn't online on worker {worker_id}".format(name=name, worker_id=self.worker_id))
+        elif kind == PACKET_SEEN:
+            name, chat_id, message_id = fields[1], int(fields[2]), int(fields[3])
+            client = self.local_users.get(name)
+            if client:
+                client.note_delivered(chat_id, message_id)
+        elif kind == PACKET_CHAT:
+            self.chat_cache.drop(int(fields[1]))
+        elif kind == PACKET_PART:
+            self.partial.setdefault(int(fields[1]), []).append(data)
+        elif kind == PACKET_LAST:
+            chunks = self.partial.pop(int(fields[1]), [])
+            chunks.append(data)
+            self.handle(b''.join(chunks))
+        elif kind == PACKET_UP:
+            worker_id, name, status, version = int(fields[1]), fields[2], fields[3], int(fields[4])
+            remote = self.remote_users.get(name)
+            if remote and remote.worker_id == worker_id:
+                remote.status = status
+            else:
+                self.remote_users[name] = RemoteClient(name, worker_id, status, self, version)
+        elif kind == PACKET_DOWN:
+            worker_id, name = int(fields[1]), fields[2]
+            remote = self.remote_users.get(name)
+            if remote and remote.worker_id == worker_id:
+                del self.remote_users[name]
+        elif kind == PACKET_HELLO:
+            # worker has (re)started, packets queued for the previous one are dropped
+            worker_id = int(fields[1])
+            self.disconnect(worker_id)
+            self.partial.pop(worker_id, None)
+            for name, client in list(self.local_users.items()):
+                if client.status:
+                    self.send_to(worker_id, self._up_packet(name, client.status))
+        else:
+            log.warning("Unknown cluster packet {packet!r}".format(packet=packet[:64]))
@@ -0,0 +1,137 @@
+import selectors
+import shutil
+import tempfile
+import unittest
+
+from server.cluster import ClusterRouter, RemoteClient
+from server.models.utils import ChatCache, ChatRoster
+from server.online import PRESENCE_LISTENERS
+
+
+class FakeClient:
+
+    def __init__(self, status):
+        self.status = status
+        self.received = []
+        self.delivered = {}
+
+    def send(self, data):
+        self.received.append(data)
+
+    def note_delivered(self, chat_id, message_id):
+        self.delivered[chat_id] = message_id
+
+
+class TestClusterRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp()
+        self.local_users = [{}, {}]
+        self.remote_users = [{}, {}]
+        self.chat_caches = [ChatCache(), ChatCache()]
+        self.selectors = [selectors.DefaultSelector(), selectors.DefaultSelector()]
+        self.routers = [ClusterRouter(worker_id, 2, self.run_dir,
+                                      local_users=self.local_users[worker_id],
+                                      remote_users=self.remote_users[worker_id],
+                                      chat_cache=self.chat_caches[worker_id])
+                        for worker_id in range(2)]
+        for router, selector in zip(self.routers, self.selectors):
+            router.setup(selector)
+        self.routers[0].on_read()  # HELLO from the second worker
+
+    def tearDown(self):
+        for router in self.routers:
+            router.close()
+        for selector in self.selectors:
+            selector.close()
+        shutil.rmtree(self.run_dir)
+
+    def run_loops(self):
+        """
+        Handle events of both workers until there are none
+        """
+        while True:
+            events = [event for selector in self.selectors for event in selector.select(timeout=0)]
+            if not events:
+                return
+            for key, mask in events:
+                key.data(key.fileobj, mask)
+
+    def test_presence(self):
+        self.routers[0].publish('userA', 'ONLINE')
+        self.routers[1].on_read()
+        remote = self.remote_users[1]['userA']
+        self.assertIsInstance(remote, RemoteClient)
+        self.assertEqual((remote.worker_id, remote.status), (0, 'ONLINE'))
+
+        self.routers[0].publish('userA', 'BUSY')
+        self.routers[1].on_read()
+        self.assertEqual(self.remote_users[1]['userA'].status, 'BUSY')
+
+        self.routers[0].publish('userA', None)
+        self.routers[1].on_read()
+        self.assertNotIn('userA', self.remote_users[1])
+
+    def test_hello_gets_online_users(self):
+        self.local_users[1]['userB'] = FakeClient('ONLINE')
+        self.routers[0].send_to(1, b'HELLO 0')
+        self.routers[1].on_read()
+        self.routers[0].on_read()
+        self.assertEqual(self.remote_users[0]['userB'].status, 'ONLINE')
+
+    def test_deliver(self):
+        client = FakeClient('ONLINE')
+        self.local_users[1]['userB'] = client
+        self.routers[1].publish('userB', 'ONLINE')
+        self.routers[0].on_read()
+
+        self.remote_users[0]['userB'].send(b'MSG userA 4||ping..\n')
+        self.remote_users[0]['userB'].note_delivered(0, 42)
+        self.routers[1].on_read()
+        self.assertEqual(client.received, [b'MSG userA 4||ping..\n'])
+        self.assertEqual(client.delivered, {0: 42})
+
+    def test_deliver_big_frames(self):
+        client = FakeClient('ONLINE')
+        self.local_users[1]['userB'] = client
+        self.routers[1].publish('userB', 'ONLINE')
+        self.routers[0].on_read()
+
+        # chunks of the frames don't fit in receive queue of the worker, the rest waits for room
+        frames = [b'MSG userA 300000||' + bytes([n]) * 300000 + b'..\n' for n in range(20)]
+        for frame in frames:
+            self.remote_users[0]['userB'].send(frame)
+        peer = self.routers[0].connections[1]
+        self.assertTrue(peer.registered)
+
+        self.run_loops()
+        self.assertEqual(client.received, frames)
+        self.assertEqual((len(peer.queue), peer.queued_bytes, peer.registered), (0, 0, False))
+
+    def test_gone_worker_users_are_forgotten(self):
+        self.routers[1].publish('userB', 'ONLINE')
+        self.routers[0].on_read()
+        self.routers[1].socket.close()
+        self.routers[0].deliver(1, 'userB', b'data')
+        self.assertNotIn('userB', self.remote_users[0])
+
+    def test_chat_roster_is_dropped(self):
+        for cache in self.chat_caches:
+            cache.rosters[7] = ChatRoster(7, 'userA', frozenset(['userA']))
+        # userB is added to the chat by the first worker
+        self.chat_caches[0].rosters[7] = ChatRoster(7, 'userA', frozenset(['userA', 'userB']))
+        self.chat_caches[0].changed(7)
+        self.routers[1].on_read()
+        self.assertNotIn(7, self.chat_caches[1].rosters)
+        self.assertIn(7, self.chat_caches[0].rosters)
+
+    def test_listener_registration(self):
+        self.assertIn(self.routers[0].publish, PRESENCE_LISTENERS)
+        self.assertIn(self.routers[0].publish_chat, self.chat_caches[0].listeners)
+        self.routers[0].close()
+        self.assertNotIn(self.routers[0].publish, PRESENCE_LISTENERS)
+        self.assertNotIn(self.routers[0].publish_chat, self.chat_caches[0].listeners)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,25 @@
+import atexit
 import copy
+import logging
 import os
+import queue
 from logging import config as logging_config
+from logging.handlers import QueueHandler, QueueListener
 
 
 DEFAULT_LOGGING_PATH = './log'
 
+LOG_MODE_DEFAULT = 'default'
+LOG_MODE_DEBUG = 'debug'
+LOG_MODE_PRODUCTION = 'production'
+LOG_MODES = [LOG_MODE_DEFAULT, LOG_MODE_DEBUG, LOG_MODE_PRODUCTION]
+
+# per-message traces (received/sent data, parsed frames, ...) are logged at DEBUG level
+# and guarded by log.isEnabledFor(logging.DEBUG), so they cost nothing in production mode
+# unless sampling is enabled
+
+_listener = None  # QueueListener of production mode, writes log records in its own thread
+
 
 logging_config_template = {
     'version': 1,
@@ -42,16 +57,74 @@ logging_config_template = {
 }
 
 
-def build_config_dict(log_file_path):
+class SamplingFilter(logging.Filter):
+    """
+    Pass every record at INFO level and above and only each `rate`-th DEBUG record
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        self.count += 1
+        return self.count % self.rate == 0
+
+
+def build_config_dict(log_file_path, mode=LOG_MODE_DEFAULT, sample_rate=0):
     config = copy.deepcopy(logging_config_template)
     config['handlers']['base_handler']['filename'] = log_file_path + '/mess.log'
+    if mode == LOG_MODE_DEBUG:
+        config['root']['level'] = 'DEBUG'
+    elif mode == LOG_MODE_PRODUCTION:
+        # console output is the development convenience, sampled traces go to the file only
+        config['root']['handlers'] = ['base_handler']
+        config['root']['level'] = 'DEBUG' if sample_rate else 'INFO'
     return config
 
 
-def configure_logging(log_path=None):
+def stop_log_listener():
+    global _listener
+    if _listener:
+        # forked worker process has a copy of the listener without its thread
+        if _listener._thread and _listener._thread.is_alive():
+            _listener.stop()
+        _listener = None
+
+
+def configure_logging(log_path=None, mode=LOG_MODE_DEFAULT, sample_rate=0):
+    """
+    Configure root logger
+    :param log_path: directory for log files
+    :param mode: LOG_MODE_DEFAULT - INFO and above to the console and the file;
+                 LOG_MODE_DEBUG - everything, per-message traces included, to the console and the file;
+                 LOG_MODE_PRODUCTION - INFO and above to the file, written by a QueueListener thread
+    :param sample_rate: production mode only, log each `sample_rate`-th per-message trace, 0 - none
+    :return: None
+    """
+    global _listener
     print("Log file path: {path}".format(path=log_path))
     if not log_path:
         log_path = DEFAULT_LOGGING_PATH
     if not os.path.exists(log_path):
         os.makedirs(log_path)
-    logging_config.dictConfig(build_config_dict(log_path))
+    stop_log_listener()
+    logging_config.dictConfig(build_config_dict(log_path, mode, sample_rate))
+
+    if mode == LOG_MODE_PRODUCTION:
+        root = logging.getLogger()
+        handlers = list(root.handlers)
+        queue_handler = QueueHandler(queue.SimpleQueue())
+        if sample_rate:
+            queue_handler.addFilter(SamplingFilter(sample_rate))
+        for handler in handlers:
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        _listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+
+
+atexit.register(stop_log_listener)
@@ -0,0 +1,67 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from logging.handlers import QueueHandler
+
+from server.config.log import SamplingFilter, configure_logging, stop_log_listener, \
+    LOG_MODE_DEFAULT, LOG_MODE_DEBUG, LOG_MODE_PRODUCTION
+
+
+def make_record(level):
+    return logging.LogRecord('test', level, __file__, 0, 'msg', (), None)
+
+
+class TestSamplingFilter(unittest.TestCase):
+
+    def test_debug_records_are_sampled(self):
+        sampling_filter = SamplingFilter(rate=3)
+        passed = [sampling_filter.filter(make_record(logging.DEBUG)) for _ in range(9)]
+        self.assertEqual(passed.count(True), 3)
+
+    def test_info_records_pass(self):
+        sampling_filter = SamplingFilter(rate=1000)
+        self.assertTrue(all(sampling_filter.filter(make_record(logging.INFO)) for _ in range(10)))
+
+
+class TestProductionMode(unittest.TestCase):
+
+    def setUp(self):
+        self.log_path = tempfile.mkdtemp()
+        self.log = logging.getLogger('server.config.log_test')
+
+    def tearDown(self):
+        configure_logging(log_path=self.log_path, mode=LOG_MODE_DEFAULT)
+        shutil.rmtree(self.log_path)
+
+    def read_log(self):
+        stop_log_listener()  # flushes the queue
+        with open(os.path.join(self.log_path, 'mess.log')) as f:
+            return f.read()
+
+    def test_traces_are_logged_on_request_only(self):
+        configure_logging(log_path=self.log_path, mode=LOG_MODE_DEFAULT)
+        self.assertFalse(self.log.isEnabledFor(logging.DEBUG))
+        configure_logging(log_path=self.log_path, mode=LOG_MODE_DEBUG)
+        self.assertTrue(self.log.isEnabledFor(logging.DEBUG))
+
+    def test_records_are_written_through_queue(self):
+        configure_logging(log_path=self.log_path, mode=LOG_MODE_PRODUCTION)
+        root = logging.getLogger()
+        self.assertEqual([type(handler) for handler in root.handlers], [QueueHandler])
+        self.assertFalse(self.log.isEnabledFor(logging.DEBUG))
+
+        self.log.info("written %d", 1)
+        self.assertIn("written 1", self.read_log())
+
+    def test_sampled_traces(self):
+        configure_logging(log_path=self.log_path, mode=LOG_MODE_PRODUCTION, sample_rate=2)
+        for n in range(4):
+            self.log.debug("trace %d", n)
+        content = self.read_log()
+        self.assertEqual(content.count("trace"), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
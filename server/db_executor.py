@@ -0,0 +1,164 @@
+import collections
+import concurrent.futures
+import logging
+import os
+import select
+import time
+
+from server.metrics import METRICS
+
+
+log = logging.getLogger(__name__)
+
+
+class InlineExecutor:
+    """
+    Runs DB calls right away in the calling thread: scripts and tests
+    """
+
+    def submit(self, func, *args, callback=None, errback=None):
+        """
+        Call func(*args), then callback(result) or errback(exception) and re-raise it
+        :return: None
+        """
+        try:
+            result = func(*args)
+        except Exception as e:
+            if errback:
+                errback(e)
+            raise
+        if callback:
+            callback(result)
+
+
+INLINE_EXECUTOR = InlineExecutor()
+
+
+def _run_callback(callback, errback, result, error, submitted):
+    METRICS.db_calls.observe(time.perf_counter() - submitted)
+    try:
+        if error is None:
+            if callback:
+                callback(result)
+        else:
+            log.error("DB call failed", exc_info=error)
+            if errback:
+                errback(error)
+    except Exception:
+        log.exception("DB call callback failed")
+
+
+class DBExecutor:
+    """
+    Bounded thread pool for blocking DB calls of the selectors engine.
+
+    Workers put completed calls to a queue and wake the server loop up through a self-pipe,
+    the loop (see on_read) calls their callbacks in order of completion, so callbacks
+    can touch clients and caches like any other event handler.
+    Calls don't share anything with the loop: they get plain values and use their own sessions
+    (see server.models.session_scope).
+    """
+
+    def __init__(self, max_workers=4):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        self.completed = collections.deque()  # (callback, errback, result, exception, submitted) of done calls
+        self.pending = 0  # submitted calls whose callbacks haven't been called yet
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+
+    def fileno(self):
+        return self.wakeup_r
+
+    def submit(self, func, *args, callback=None, errback=None):
+        """
+        Call func(*args) in a worker thread, then callback(result) or errback(exception) in the server loop
+        :return: None
+        """
+        self.pending += 1
+        self.executor.submit(self._call, func, args, callback, errback, time.perf_counter())
+
+    def _call(self, func, args, callback, errback, submitted):
+        # worker thread
+        try:
+            self.completed.append((callback, errback, func(*args), None, submitted))
+        except Exception as e:
+            self.completed.append((callback, errback, None, e, submitted))
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            pass  # pipe is full, loop is going to wake up anyway
+
+    def on_read(self, fileobj=None, mask=None):
+        """
+        Selector callback: run callbacks of completed calls
+        :return: None
+        """
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.completed:
+            self.pending -= 1
+            _run_callback(*self.completed.popleft())
+
+    def drain(self, timeout=5):
+        """
+        Wait for submitted calls (and calls submitted by their callbacks) and run their callbacks
+        :return: True if nothing is pending
+        """
+        while self.pending:
+            ready, _, _ = select.select([self.wakeup_r], [], [], timeout)
+            if not ready:
+                log.warning("%d DB calls are still pending", self.pending)
+                return False
+            self.on_read()
+        return True
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+
+class HandoverExecutor:
+    """
+    Bounded thread pool for blocking DB calls of the asyncio engine.
+
+    Callbacks of completed calls are handed over to the thread running client handlers
+    (see AsyncMessServer.submit_threadsafe), so they run in order with handlers
+    and can touch clients and caches like them.
+    """
+
+    def __init__(self, handover, max_workers=4):
+        """
+        :param handover: callable(func, *args) calling func(*args) in the handlers thread, from any thread
+        :param max_workers: number of DB threads
+        """
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        self.handover = handover
+        self.pending = 0  # submitted calls whose callbacks haven't been called yet
+
+    def submit(self, func, *args, callback=None, errback=None):
+        """
+        Call func(*args) in a worker thread, then callback(result) or errback(exception) in the handlers thread
+        :return: None
+        """
+        self.pending += 1
+        self.executor.submit(self._call, func, args, callback, errback, time.perf_counter())
+
+    def _call(self, func, args, callback, errback, submitted):
+        # worker thread
+        try:
+            result, error = func(*args), None
+        except Exception as e:
+            result, error = None, e
+        self.handover(self._done, callback, errback, result, error, submitted)
+
+    def _done(self, *completed):
+        self.pending -= 1
+        _run_callback(*completed)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
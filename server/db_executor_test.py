@@ -0,0 +1,96 @@
+import queue
+import threading
+import unittest
+
+from server.db_executor import DBExecutor, InlineExecutor, HandoverExecutor
+
+
+class TestDBExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = DBExecutor(max_workers=2)
+        self.results = []
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_callbacks_are_called_by_loop(self):
+        threads = []
+
+        def query(n):
+            threads.append(threading.current_thread())
+            return n * 2
+
+        for n in range(3):
+            self.executor.submit(query, n, callback=self.results.append)
+        self.assertEqual(self.executor.pending, 3)
+        self.assertTrue(self.executor.drain())
+        self.assertEqual(sorted(self.results), [0, 2, 4])
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_errback(self):
+        self.executor.submit(int, 'not a number', callback=self.results.append, errback=self.results.append)
+        self.executor.drain()
+        self.assertIsInstance(self.results[0], ValueError)
+
+    def test_calls_submitted_by_callbacks(self):
+        def chain(n):
+            self.results.append(n)
+            if n < 3:
+                self.executor.submit(int, n + 1, callback=chain)
+
+        self.executor.submit(int, 0, callback=chain)
+        self.executor.drain()
+        self.assertEqual(self.results, [0, 1, 2, 3])
+
+
+class TestHandoverExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.handed_over = queue.Queue()
+        self.executor = HandoverExecutor(lambda func, *args: self.handed_over.put((func, args)), max_workers=2)
+        self.results = []
+
+    def tearDown(self):
+        self.executor.close()
+
+    def run_handed_over(self):
+        while self.executor.pending:
+            func, args = self.handed_over.get(timeout=5)
+            func(*args)
+
+    def test_callbacks_are_handed_over(self):
+        threads = []
+
+        def query(n):
+            threads.append(threading.current_thread())
+            return n * 2
+
+        for n in range(3):
+            self.executor.submit(query, n, callback=self.results.append)
+        self.assertEqual(self.executor.pending, 3)
+        self.run_handed_over()
+        self.assertEqual(sorted(self.results), [0, 2, 4])
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_errback(self):
+        self.executor.submit(int, 'not a number', callback=self.results.append, errback=self.results.append)
+        with self.assertLogs('server.db_executor', 'ERROR'):
+            self.run_handed_over()
+        self.assertIsInstance(self.results[0], ValueError)
+
+
+class TestInlineExecutor(unittest.TestCase):
+
+    def test_submit(self):
+        results = []
+        InlineExecutor().submit(int, '1', callback=results.append)
+        self.assertEqual(results, [1])
+        with self.assertRaises(ValueError):
+            InlineExecutor().submit(int, 'x', errback=results.append)
+        self.assertIsInstance(results[1], ValueError)
+
+
+if __name__ == '__main__':
+    unittest.main()
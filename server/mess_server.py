@@ -3,23 +3,43 @@ import socket
 import traceback
 import logging
 import sys
+import threading
+import time
 
+from server.base_client import PRESENCE, BATCH
 from server.client import Client
+from server.online import ONLINE_USERS
+from server.cluster import ClusterRouter
+from server.config import Config
+from server.db_executor import DBExecutor
+from server.metrics import METRICS, output_buffers
+from server.models.utils import MESSAGE_WRITER
+from server.profiler import PROFILER, SignalWakeup
 from protocol.messages import ErrorMessage
 
 
 log = logging.getLogger(__name__)
 
+# bytes read from a connection per read event at most
+READ_MAX_PER_EVENT = 1024 * 1024
+
 
 class MessServer:
 
-    def __init__(self, port=9090):
+    def __init__(self, port=9090, config=None, worker_id=0, workers=1):
         self.host = '127.0.0.1'
         self.port = port
+        self.config = config if config else Config()
+        self.worker_id = worker_id
+        self.workers = workers  # >1: one of worker processes sharing the port
+        self.router = ClusterRouter(worker_id, workers, self.config.run_dir) if workers > 1 else None
         self.clients = {}  # dict {socket: <Client> instance}
+        self.db = DBExecutor(max_workers=self.config.db_workers)  # blocking DB calls of clients and MessageWriter
         self.socket = None
         self._running = False
         self.selector = selectors.DefaultSelector()
+        self.lag_probe_due = None  # see probe_loop_lag
+        self.signal_wakeup = None
 
     def register_client(self, conn):
         """
@@ -27,9 +47,11 @@ class MessServer:
         :param conn: connection to register as a client
         :return: None
         """
-        self.clients[conn.fileno()] = Client(conn, self)
-        log.info("Register new client: {fileno}: {client}".format(fileno=conn.fileno(),
-                                                                  client=self.clients[conn.fileno()]))
+        self.clients[conn.fileno()] = Client(conn, self,
+                                             write_high_watermark=self.config.write_high_watermark,
+                                             write_low_watermark=self.config.write_low_watermark,
+                                             db_executor=self.db)
+        log.info("Register new client: %d: %r", conn.fileno(), self.clients[conn.fileno()])
 
     def unregister_client(self, conn):
         """
@@ -37,10 +59,11 @@ class MessServer:
         :param conn: connection to delete from clients
         :return: None
         """
-        log.info("Unregister client: {fileno}".format(fileno=conn.fileno()))
-        if self.clients[conn.fileno()].user:
-            self.clients[conn.fileno()].logout()
-        del self.clients[conn.fileno()]
+        log.info("Unregister client: %d", conn.fileno())
+        client = self.clients.pop(conn.fileno())
+        if client.user:
+            client.logout()
+        client.close()
 
     def on_accept(self, sock, mask):
         """
@@ -51,13 +74,61 @@ class MessServer:
         :return: None
         """
         new_connection, addr = self.socket.accept()
-        log.info('accept({})'.format(addr))
+        log.info('accept(%s)', addr)
         new_connection.setblocking(False)
         self.selector.register(fileobj=new_connection,
                                events=selectors.EVENT_READ,
-                               data=self.on_read)
+                               data=self.on_client_event)
         self.register_client(new_connection)
 
+    def pace_output(self, client):
+        """
+        Data is written (or queued by the client) right away, client.output_blocked is up to date,
+        nothing to do here
+        """
+        pass
+
+    def update_client_events(self, client):
+        """
+        Keep selector registration of client connection in sync with its buffers state:
+        EVENT_WRITE only while there is pending output, EVENT_READ unless reading is paused
+        :param client: Client instance
+        :return: None
+        """
+        events = 0 if client.reading_paused else selectors.EVENT_READ
+        if client.has_pending_output:
+            events |= selectors.EVENT_WRITE
+        try:
+            key = self.selector.get_key(client.conn)
+        except (KeyError, ValueError):
+            return  # connection is not registered (anymore)
+        if key.events != events:
+            self.selector.modify(client.conn, events, self.on_client_event)
+
+    def on_client_event(self, conn, mask):
+        """
+        Callback for events on client connections
+        :param conn: client connection
+        :param mask: selector events mask
+        :return: None
+        """
+        if mask & selectors.EVENT_WRITE:
+            self.on_write(conn, mask)
+        if mask & selectors.EVENT_READ and conn.fileno() in self.clients:
+            self.on_read(conn, mask)
+
+    def on_write(self, conn, mask):
+        """
+        Callback for write events, drains client outbound queue
+        :param conn: connection to write to
+        :param mask:
+        :return: None
+        """
+        client = self.clients[conn.fileno()]
+        client.flush()
+        if client.out_size <= client.write_low_watermark:
+            client.on_writable()
+
     def on_read(self, conn, mask):
         """
         Callback for read events
@@ -66,17 +137,41 @@ class MessServer:
         :return: None
         """
         client = self.clients[conn.fileno()]
+        started, started_cpu = time.perf_counter(), time.thread_time()
         try:
-            data = conn.recv(1024)
-            if data:
-                log.info('got data from {}: {!r}'.format(conn.getpeername(), data))
-                client.recv(data)
-            else:
-                self.on_close(conn)
+            read = 0
+            # read until the socket is drained, big frames are read by a few calls within one event
+            while True:
+                with client.read_buffer() as buffer:
+                    free = len(buffer)
+                    size = conn.recv_into(buffer)
+                    if size and log.isEnabledFor(logging.DEBUG):
+                        log.debug('got data from %s: %r', client.addr, buffer[:size].tobytes())
+                if not size:
+                    self.on_close(conn)
+                    break
+                client.received(size)
+                read += size
+                # short read means nothing is left, no need to wait for EAGAIN;
+                # other connections get their turn after READ_MAX_PER_EVENT bytes
+                if size < free or read >= READ_MAX_PER_EVENT or client.reading_paused or \
+                        conn.fileno() not in self.clients:
+                    break
+        except BlockingIOError:
+            pass
         except ConnectionResetError:
             self.on_error(conn)
         except Exception as e:
             log.error(traceback.format_exc())
+        METRICS.reads.observe(time.perf_counter() - started, time.thread_time() - started_cpu)
+
+    def on_db_completed(self, fileobj, mask):
+        """
+        Callback for DB executor wakeups: callbacks of completed calls (deliveries of committed messages
+        among them) are run as one batch, so their output is written once per client
+        """
+        with BATCH:
+            self.db.on_read(fileobj, mask)
 
     def on_error(self, conn):
         """
@@ -84,7 +179,7 @@ class MessServer:
         :param conn:
         :return: None
         """
-        log.info('closing connection to {0}'.format(self.clients[conn.fileno()].addr))
+        log.info('closing connection to %s', self.clients[conn.fileno()].addr)
         self.unregister_client(conn)
         self.selector.unregister(conn)
         conn.close()
@@ -95,7 +190,7 @@ class MessServer:
         :param conn: connection to close
         :return: None
         """
-        log.info('closing connection to {0}'.format(self.clients[conn.fileno()].addr))
+        log.info('closing connection to %s', self.clients[conn.fileno()].addr)
         self.unregister_client(conn)
         self.selector.unregister(conn)
         conn.close()
@@ -107,13 +202,36 @@ class MessServer:
         """
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.router:
+            # kernel balances incoming connections between worker processes
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind((self.host, self.port))
-        self.socket.listen(10)
+        self.socket.listen(self.config.listen_backlog)
 
         self.clients[self.socket.fileno()] = "SERVER"
         self.selector.register(fileobj=self.socket,
                                events=selectors.EVENT_READ,
                                data=self.on_accept)
+        if self.router:
+            self.router.setup(self.selector)
+        # DB workers wake the loop up to run callbacks of completed calls
+        self.selector.register(fileobj=self.db,
+                               events=selectors.EVENT_READ,
+                               data=self.on_db_completed)
+        # signals (profiling requests) wake the loop up, handlers can be installed in the main thread only
+        if threading.current_thread() is threading.main_thread():
+            self.signal_wakeup = SignalWakeup()
+            self.selector.register(fileobj=self.signal_wakeup,
+                                   events=selectors.EVENT_READ,
+                                   data=self.signal_wakeup.on_read)
+        MESSAGE_WRITER.configure(batch_size=self.config.message_batch_size,
+                                 flush_interval=self.config.message_flush_interval,
+                                 durability=self.config.message_durability,
+                                 executor=self.db)
+        PRESENCE.configure(flush_interval=self.config.presence_flush_interval)
+        PROFILER.configure(directory=self.config.log, seconds=self.config.profile_seconds)
+        METRICS.gauges.update(self.metrics_gauges())
+        self.lag_probe_due = time.monotonic() + self.config.message_flush_interval
         self._running = True
         log.info("Server({selector_impl}) is listening on {host}:{port}".format(
             selector_impl=type(self.selector), host=self.host, port=self.port))
@@ -127,7 +245,8 @@ class MessServer:
 
         while self._running:
             try:
-                events = self.selector.select()
+                # wake up in time to flush pending messages and status changes, to start or finish profiling
+                events = self.selector.select(timeout=self.timeout())
             except KeyboardInterrupt:
                 self.stop()
                 return
@@ -139,17 +258,61 @@ class MessServer:
                 except Exception:
                     log.error(traceback.format_exc())
                     continue
+            MESSAGE_WRITER.tick()
+            PRESENCE.tick()
+            PROFILER.tick()
+            self.probe_loop_lag()
+
+    def probe_loop_lag(self):
+        """
+        Loop lag is how late the loop gets to a timer: the probe is due every message flush interval,
+        the same as periodic flushes of the asyncio engine (see AsyncServer._flush_messages)
+        """
+        now = time.monotonic()
+        if now >= self.lag_probe_due:
+            METRICS.loop_lag.observe(now - self.lag_probe_due)
+            self.lag_probe_due = now + self.config.message_flush_interval
+
+    def metrics_gauges(self):
+        """
+        :return: {name: callable} server state reported by SRV command, see server.metrics
+        """
+        def clients():
+            return [client for client in self.clients.values() if isinstance(client, Client)]
+
+        return {'connected_clients': lambda: len(clients()),
+                'online_users': lambda: len(ONLINE_USERS),
+                'user_statuses': lambda: {status: count for status, count in ONLINE_USERS.status_counts.items() if count},
+                'output_buffers': lambda: output_buffers(clients()),
+                'db_calls_pending': lambda: self.db.pending,
+                'messages_pending': lambda: len(MESSAGE_WRITER.pending),
+                'status_changes_pending': lambda: len(PRESENCE.changes)}
+
+    def timeout(self):
+        timeouts = [t for t in (MESSAGE_WRITER.timeout(), PRESENCE.timeout(), PROFILER.timeout()) if t is not None]
+        return min(timeouts + [max(0, self.lag_probe_due - time.monotonic())])
 
     def stop(self):
         """
         Stop server
         :return: None
         """
-        log.warning("Server is stopping...")
-        for client in [c for c in self.clients.values() if isinstance(c, Client)]:
+        log.warning("Server is stopping, %d users online...", len(ONLINE_USERS))
+        clients = ONLINE_USERS.snapshot()
+        clients += [c for c in self.clients.values() if isinstance(c, Client) and not c.user]  # not logged in
+        for client in clients:
             client.send(ErrorMessage(err_code=repr("Server is stopping".encode('utf-8'))))
             client_conn = client.conn
             self.on_close(client_conn)
+        PRESENCE.flush()
+        MESSAGE_WRITER.flush()
+        self.db.drain()
+        MESSAGE_WRITER.executor = None
+        self.db.close()
+        if self.router:
+            self.router.close()
+        if self.signal_wakeup:
+            self.signal_wakeup.close()
         self.selector.close()
         self.socket.close()
         self._running = False
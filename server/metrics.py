@@ -0,0 +1,193 @@
+import bisect
+import collections
+import threading
+import time
+
+from sqlalchemy import event
+
+
+# upper bounds of latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# seconds the rates of meters are averaged over
+RATE_WINDOW = 10
+
+# connections with the biggest outbound buffers listed in snapshot
+TOP_BUFFERS = 5
+
+
+class Histogram:
+    """
+    Counts of observed values (seconds) per bucket, percentiles are estimated as bucket upper bounds
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is for values above the biggest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        :param p: percentile, 0..100
+        :return: upper bound of the bucket the value falls into (max for the last one), None if empty
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        def ms(value):
+            return round(value * 1000, 3) if value is not None else None
+
+        return {'count': self.count,
+                'avg_ms': ms(self.sum / self.count if self.count else None),
+                'p50_ms': ms(self.percentile(50)),
+                'p99_ms': ms(self.percentile(99)),
+                'max_ms': ms(self.max),
+                'buckets_ms': [[ms(bound), count] for bound, count in zip(self.bounds, self.counts) if count] +
+                              ([['inf', self.counts[-1]]] if self.counts[-1] else [])}
+
+
+class Timer:
+    """
+    Wall clock and CPU (thread) time of the same operations
+    """
+
+    def __init__(self):
+        self.wall = Histogram()
+        self.cpu = Histogram()
+
+    def observe(self, wall, cpu):
+        self.wall.observe(wall)
+        self.cpu.observe(cpu)
+
+    def snapshot(self):
+        snapshot = self.wall.snapshot()
+        snapshot['cpu'] = self.cpu.snapshot()
+        return snapshot
+
+
+class Meter:
+    """
+    Count of events and their rate per second over the last `window` whole seconds
+    """
+
+    def __init__(self, window=RATE_WINDOW, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.total = 0
+        self.seconds = collections.deque(maxlen=window + 1)  # [second, count] of the last seconds
+
+    def mark(self, n=1):
+        self.total += n
+        second = int(self.clock())
+        if self.seconds and self.seconds[-1][0] == second:
+            self.seconds[-1][1] += n
+        else:
+            self.seconds.append([second, n])
+
+    def rate(self):
+        now = int(self.clock())
+        return sum(count for second, count in self.seconds if now - self.window <= second < now) / self.window
+
+    def snapshot(self):
+        return {'total': self.total, 'per_sec': self.rate()}
+
+
+class Metrics:
+    """
+    Runtime metrics of the server process, snapshot() is sent in reply to SRV command.
+
+    Counters are updated by the thread handling client events, DB queries are timed
+    by whatever thread runs them, so their histogram is guarded by a lock.
+    Servers register gauges: {name: callable returning JSON serializable value}, evaluated on snapshot.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.messages_in = Meter(clock=clock)
+        self.messages_out = Meter(clock=clock)
+        self.bytes_in = Meter(clock=clock)
+        self.bytes_out = Meter(clock=clock)
+        self.handlers = collections.defaultdict(Timer)  # {cmd: handler wall and CPU time}
+        self.reads = Timer()  # read events of connections (selectors engine), parsing and handling included
+        self.db_calls = Histogram()  # DB executor calls, from submit to callback
+        self.db_queries = Histogram()
+        self.db_queries_lock = threading.Lock()
+        self.loop_lag = Histogram()  # how late the server loop runs timers
+        self.gauges = {}
+
+    def observe_handler(self, cmd, wall, cpu):
+        self.handlers[cmd].observe(wall, cpu)
+
+    def observe_db_query(self, elapsed):
+        with self.db_queries_lock:
+            self.db_queries.observe(elapsed)
+
+    def snapshot(self):
+        """
+        :return: dict
+        """
+        with self.db_queries_lock:
+            db_queries = self.db_queries.snapshot()
+        snapshot = {'uptime': round(self.clock() - self.started, 3),
+                    'messages_in': self.messages_in.snapshot(),
+                    'messages_out': self.messages_out.snapshot(),
+                    'bytes_in': self.bytes_in.snapshot(),
+                    'bytes_out': self.bytes_out.snapshot(),
+                    'handlers': {cmd: timer.snapshot() for cmd, timer in sorted(self.handlers.items())},
+                    'reads': self.reads.snapshot(),
+                    'db_calls': self.db_calls.snapshot(),
+                    'db_queries': db_queries,
+                    'loop_lag': self.loop_lag.snapshot()}
+        for name, gauge in self.gauges.items():
+            snapshot[name] = gauge()
+        return snapshot
+
+
+def output_buffers(clients):
+    """
+    Summary of outbound buffers of connections
+    :param clients: iterable of Client instances
+    :return: dict: total and max bytes, connections with pending output and sizes of the biggest buffers
+        (without peer addresses)
+    """
+    sizes = sorted((client.out_size for client in clients if client.out_size), reverse=True)
+    return {'total': sum(sizes),
+            'max': sizes[0] if sizes else 0,
+            'connections': len(sizes),
+            'top': sizes[:TOP_BUFFERS]}
+
+
+def instrument_engine(engine):
+    """
+    Count and time queries of SQLAlchemy engine
+    :param engine: Engine
+    :return: None
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_started'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        METRICS.observe_db_query(time.perf_counter() - conn.info['query_started'])
+
+
+METRICS = Metrics()
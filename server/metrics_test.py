@@ -0,0 +1,71 @@
+import unittest
+from types import SimpleNamespace
+
+from server.metrics import Histogram, Meter, Metrics, Timer, output_buffers
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram(bounds=(0.001, 0.01, 0.1))
+        for value in [0.0005] * 98 + [0.05, 0.5]:
+            histogram.observe(value)
+        self.assertEqual(histogram.percentile(50), 0.001)
+        self.assertEqual(histogram.percentile(99), 0.1)
+        self.assertEqual(histogram.percentile(100), 0.5)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['max_ms'], 500)
+        self.assertEqual(snapshot['buckets_ms'], [[1, 98], [100, 1], ['inf', 1]])
+
+    def test_empty(self):
+        self.assertIsNone(Histogram().snapshot()['p50_ms'])
+
+
+class TestTimer(unittest.TestCase):
+
+    def test_snapshot(self):
+        timer = Timer()
+        timer.observe(0.002, 0.0005)
+        snapshot = timer.snapshot()
+        self.assertEqual(snapshot['max_ms'], 2)
+        self.assertEqual(snapshot['cpu']['max_ms'], 0.5)
+
+
+class TestMeter(unittest.TestCase):
+
+    def test_rate_of_last_seconds(self):
+        now = [100.5]
+        meter = Meter(window=2, clock=lambda: now[0])
+        meter.mark(10)
+        now[0] = 101.2
+        meter.mark(4)
+        self.assertEqual(meter.rate(), 5)  # second 101 isn't over yet
+        now[0] = 102.1
+        self.assertEqual(meter.rate(), 7)
+        now[0] = 103.1
+        self.assertEqual(meter.rate(), 2)
+        self.assertEqual(meter.total, 14)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_snapshot(self):
+        metrics = Metrics()
+        metrics.observe_handler('MSG', 0.002, 0.001)
+        metrics.observe_db_query(0.001)
+        metrics.gauges['online_users'] = lambda: 3
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['handlers']['MSG']['count'], 1)
+        self.assertEqual(snapshot['handlers']['MSG']['cpu']['count'], 1)
+        self.assertEqual(snapshot['db_queries']['count'], 1)
+        self.assertEqual(snapshot['online_users'], 3)
+
+    def test_output_buffers(self):
+        clients = [SimpleNamespace(out_size=size, addr=str(n)) for n, size in enumerate([0, 10, 300, 20])]
+        self.assertEqual(output_buffers(clients), {'total': 330, 'max': 300, 'connections': 3,
+                                                   'top': [300, 20, 10]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,19 @@
-from sqlalchemy import create_engine
+import contextlib
+
+from sqlalchemy import inspect
 from sqlalchemy.ext.declarative import declarative_base
 
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+from server.metrics import instrument_engine
+from server.models.engine import create_db_engine
 
 
 Base = declarative_base()
 
-# looks like works fine without scoped session
-session = sessionmaker()  # scoped_session(sessionmaker())
+# server loop uses one long-lived session (server.models.utils.s),
+# work done by other threads gets a session per unit of work, see session_scope()
+session = sessionmaker()
 
 
 from server.models.user import User
@@ -15,10 +21,55 @@ from server.models.chat import Chat
 from server.models.message import Message
 
 
-def init_db(db='sqlite:///../mess.db', enable_logging=False):
-    engine = create_engine(db,
-                           echo=enable_logging  # enables sqlalchemy logging
-                           )
+def init_db(db='sqlite:///../mess.db', enable_logging=False, pool_size=5, pool_pre_ping=False, sqlite_wal=True):
+    """
+    Connect to database and create missing tables, see create_db_engine for options
+    """
+    engine = create_db_engine(db, enable_logging=enable_logging, pool_size=pool_size,
+                              pool_pre_ping=pool_pre_ping, sqlite_wal=sqlite_wal)
+    instrument_engine(engine)
+    previous_engine = Base.metadata.bind
     Base.metadata.bind = engine
     session.configure(bind=engine)
     Base.metadata.create_all(engine)
+    create_missing_indexes(engine)
+
+    from server.models.utils import s, USER_CACHE, CHAT_CACHE
+    # loaded and cached users and chats belong to previous database
+    s.close()
+    # explicit bind, statements cached by lazy loaders remember the engine they were first executed with
+    s.bind = engine
+    USER_CACHE.clear()
+    CHAT_CACHE.clear()
+    if previous_engine is not None:
+        previous_engine.dispose()
+
+
+@contextlib.contextmanager
+def session_scope(**kwargs):
+    """
+    Session for one unit of work: committed if the block succeeds, rolled back otherwise, closed in any case.
+    Unlike the shared server.models.utils.s it can be used from any thread.
+    :param kwargs: Session options, e.g. expire_on_commit=False to use loaded objects after the block
+    """
+    db_session = session(**kwargs)
+    try:
+        yield db_session
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    finally:
+        db_session.close()
+
+
+def create_missing_indexes(engine):
+    """
+    create_all() doesn't touch existing tables, add indexes introduced after the tables were created
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
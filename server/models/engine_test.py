@@ -0,0 +1,68 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from server.models import init_db, session_scope
+from server.models.engine import create_db_engine
+from server.models.user import User
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.db = 'sqlite:///{}'.format(os.path.join(self.db_dir, 'engine.db'))
+
+    def tearDown(self):
+        for name in os.listdir(self.db_dir):
+            os.remove(os.path.join(self.db_dir, name))
+        os.rmdir(self.db_dir)
+
+    def pragma(self, engine, name):
+        return engine.execute('PRAGMA {}'.format(name)).scalar()
+
+    def test_sqlite_wal(self):
+        engine = create_db_engine(self.db, pool_size=2)
+        self.assertEqual(self.pragma(engine, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(engine, 'synchronous'), 1)  # NORMAL
+        self.assertEqual(engine.pool.size(), 2)
+        engine.dispose()
+
+    def test_sqlite_without_wal(self):
+        engine = create_db_engine(self.db, sqlite_wal=False)
+        self.assertEqual(self.pragma(engine, 'journal_mode'), 'delete')
+        engine.dispose()
+
+    def test_sqlite_memory(self):
+        engine = create_db_engine('sqlite:///:memory:')
+        self.assertEqual(self.pragma(engine, 'journal_mode'), 'memory')
+        engine.dispose()
+
+    def test_session_scope(self):
+        init_db(self.db)
+        with session_scope() as db_session:
+            db_session.add(User('scopeA', 'passA'))
+
+        with self.assertRaises(ValueError):
+            with session_scope() as db_session:
+                db_session.add(User('scopeB', 'passB'))
+                db_session.flush()
+                raise ValueError()
+
+        # pooled connections can be used by other threads
+        names = []
+
+        def load_names():
+            with session_scope() as db_session:
+                names.extend(name for name, in db_session.query(User.name))
+
+        thread = threading.Thread(target=load_names)
+        thread.start()
+        thread.join()
+        self.assertEqual(names, ['scopeA'])
+        init_db('sqlite:///:memory:')  # releases the file
+
+
+if __name__ == '__main__':
+    unittest.main()
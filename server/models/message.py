@@ -1,7 +1,8 @@
 import logging
 import datetime
 
-from sqlalchemy import Column, Integer, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index, LargeBinary
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import relationship
 
 from server.models import Base
@@ -10,6 +11,28 @@ from server.models import Base
 log = logging.getLogger(__name__)
 
 
+class Payload(TypeDecorator):
+    """
+    Message payload is stored as the client sent it: bytes-like objects are passed to the driver as they are,
+    str (messages created by the server itself) is encoded. Loaded as bytes, rows saved as text by previous
+    versions (SQLite keeps value types per row) are loaded as str, both are sent to clients as they are.
+    """
+
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return value.encode('utf-8')
+        return value
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            if value is None or isinstance(value, (bytes, str)):
+                return value
+            return bytes(value)  # memoryview (psycopg2)
+        return process
+
+
 # TODO: create base class for messages classes
 
 
@@ -19,7 +42,7 @@ class ChatMessage(Base):
 
     id = Column(Integer, primary_key=True)
     created_ts = Column(DateTime, default=datetime.datetime.utcnow)
-    data = Column(Text, nullable=False)
+    data = Column(Payload, nullable=False)
 
     chat_id = Column(Integer, ForeignKey('chat.id'))
     chat = relationship('Chat', foreign_keys=[chat_id])
@@ -27,10 +50,21 @@ class ChatMessage(Base):
     sent_by = Column(Integer, ForeignKey('user.id'))
     by = relationship('User', foreign_keys=[sent_by, ])
 
-    def __init__(self, data, chat, by):
+    __table_args__ = (
+        Index('ix_chat_message_chat_id_id', 'chat_id', 'id'),  # offline messages replay from delivery cursor
+    )
+
+    def __init__(self, data, chat=None, by=None, chat_id=None, sent_by=None):
         self.data = data
-        self.chat = chat
-        self.by = by
+        # by ids: chat and sender aren't loaded or belong to another session, see server.models.utils
+        if chat is not None:
+            self.chat = chat
+        else:
+            self.chat_id = chat_id
+        if by is not None:
+            self.by = by
+        else:
+            self.sent_by = sent_by
 
     def __repr__(self):
         return "ChatMessage(id={id}, ts={ts}, data={data}, chat={chat}, by={by})".format(
@@ -43,7 +77,7 @@ class Message(Base):
 
     id = Column(Integer, primary_key=True)
     created_ts = Column(DateTime, default=datetime.datetime.utcnow)
-    data = Column(Text, nullable=False)
+    data = Column(Payload, nullable=False)
 
     to_id = Column(Integer, ForeignKey('user.id'))
     to = relationship('User', foreign_keys=[to_id, ])
@@ -51,11 +85,46 @@ class Message(Base):
     by_id = Column(Integer, ForeignKey('user.id'))
     by = relationship('User', foreign_keys=[by_id, ])
 
-    def __init__(self, data, by, to):
+    __table_args__ = (
+        Index('ix_message_to_id_id', 'to_id', 'id'),  # offline messages replay from delivery cursor
+    )
+
+    def __init__(self, data, by=None, to=None, by_id=None, to_id=None):
         self.data = data
-        self.to = to
-        self.by = by
+        # by ids: users belong to another session, see server.models.utils.create_message
+        if to is not None:
+            self.to = to
+        else:
+            self.to_id = to_id
+        if by is not None:
+            self.by = by
+        else:
+            self.by_id = by_id
 
     def __repr__(self):
         return "Message(id={id}, ts={ts}, data={data}, to={to}, by={by})".format(
-            id=self.id, ts=self.created_ts, data=self.data, by=self.by, to=self.to)
\ No newline at end of file
+            id=self.id, ts=self.created_ts, data=self.data, by=self.by, to=self.to)
+
+# chat_id of delivery cursors of personal messages
+PERSONAL_CURSOR = 0
+
+
+class DeliveryCursor(Base):
+    """
+    Id of the last message delivered to user: personal (chat_id is PERSONAL_CURSOR) or in the chat
+    """
+
+    __tablename__ = 'delivery_cursor'
+
+    user_id = Column(Integer, ForeignKey('user.id'), primary_key=True)
+    chat_id = Column(Integer, primary_key=True, autoincrement=False)
+    message_id = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, user_id, chat_id, message_id):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    def __repr__(self):
+        return "DeliveryCursor(user_id={user_id}, chat_id={chat_id}, message_id={message_id})".format(
+            user_id=self.user_id, chat_id=self.chat_id, message_id=self.message_id)
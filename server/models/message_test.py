@@ -1,5 +1,7 @@
 import unittest
 
+from sqlalchemy import text
+
 from server.models import session, init_db
 from server.models.user import User
 from server.models.message import Message
@@ -38,6 +40,21 @@ class TestMessageModel(unittest.TestCase):
         # verify received message
         self.assertEqual(message_from_db, message)
 
+    def test_payload(self):
+        user1, user2 = User('payload1', 'pass1'), User('payload2', 'pass2')
+        self.db_session.add_all([user1, user2])
+        self.db_session.commit()
+        received = memoryview(b'MSG payload2 6||\xd0\xbf\xd1\x80\xd0\xb8')[16:]
+        message = Message(received, user1, user2)
+        self.db_session.add(message)
+        self.db_session.commit()
+        # saved as text by previous versions
+        self.db_session.execute(text("INSERT INTO message (data, by_id, to_id) VALUES ('old', :by, :to)"),
+                                {'by': user1.id, 'to': user2.id})
+        self.db_session.expire_all()
+        data = [m.data for m in self.db_session.query(Message).filter(Message.to == user2).order_by(Message.id)]
+        self.assertEqual(data, ['привет'.encode('utf-8')[:6], 'old'])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -24,7 +24,7 @@ class Friendship(Base):
 
     __table_args__ = (
         UniqueConstraint('friend_a_id', 'friend_b_id', name='unique_friendship'),
-        CheckConstraint('NOT(friend_a_id == friend_b_id)', name='check_self_friend')
+        CheckConstraint('friend_a_id <> friend_b_id', name='check_self_friend')
     )
 
     def __init__(self, friend_a, friend_b):
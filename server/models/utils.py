@@ -1,12 +1,129 @@
+import collections
 import datetime
 
-from server.models import session
-from server.models.user import User
-from server.models.chat import Chat
-from server.models.message import Message, ChatMessage
+from functools import partial
 
+from sqlalchemy import event, and_, or_, func, text
 
-s = session()
+from server.models import session, session_scope
+from server.models.user import User, friendship_union
+from server.models.chat import Chat, chat_to_user
+from server.models.message import Message, ChatMessage, DeliveryCursor, PERSONAL_CURSOR
+from server.models.writer import MessageWriter
+
+
+# used by the server loop thread only, other threads use server.models.session_scope;
+# loaded users and chats are cached (see below), they aren't reloaded after every commit
+s = session(expire_on_commit=False)
+
+# messages are saved in batches, see server.models.writer
+MESSAGE_WRITER = MessageWriter(s, session_scope=partial(session_scope, expire_on_commit=False))
+
+REPLAY_PAGE_SIZE = 100  # offline messages loaded by one query
+
+
+class UserCache:
+    """
+    Directory of users loaded by the module session: {name: User}, {id: User}
+    and friend names of users {user id: frozenset of names}
+    """
+
+    def __init__(self):
+        self.by_name = {}
+        self.by_id = {}
+        self.friend_names = {}
+
+    def add(self, user):
+        self.by_name[user.name] = user
+        self.by_id[user.id] = user
+
+    def forget(self, user):
+        self.by_name.pop(user.name, None)
+        self.by_id.pop(user.id, None)
+        self.forget_friends(user)
+
+    def forget_friends(self, *users):
+        for user in users:
+            self.friend_names.pop(user.id, None)
+
+    def clear(self):
+        self.by_name.clear()
+        self.by_id.clear()
+        self.friend_names.clear()
+
+
+USER_CACHE = UserCache()
+
+
+@event.listens_for(User.friends, 'append')
+@event.listens_for(User.friends, 'remove')
+def on_friendship_change(user, friend, initiator):
+    # friendship is symmetric (see User.all_friends)
+    USER_CACHE.forget_friends(user, friend)
+
+
+@event.listens_for(User, 'after_delete')
+def on_user_delete(mapper, connection, user):
+    USER_CACHE.forget(user)
+
+
+# members and owner are user names
+ChatRoster = collections.namedtuple('ChatRoster', ['chat_id', 'owner', 'members'])
+
+
+class ChatCache:
+    """
+    Rosters of chats {chat id: ChatRoster}.
+    Each worker process has its own cache, rosters changed by one of them are dropped by others,
+    see changed() and server.cluster
+    """
+
+    def __init__(self):
+        self.rosters = {}
+        self.listeners = []  # callables (chat_id) notified about rosters changed by this process
+        # bumped by every change, rosters loaded meanwhile by other threads aren't cached, see cache_chat_roster
+        self.generation = 0
+
+    def forget(self, chat):
+        self.drop(chat.id)
+
+    def drop(self, chat_id):
+        self.rosters.pop(chat_id, None)
+        self.generation += 1
+
+    def changed(self, chat_id):
+        """
+        Members of the chat were changed (and committed) by this process
+        :param chat_id: int
+        :return: None
+        """
+        self.generation += 1
+        for listener in self.listeners:
+            listener(chat_id)
+
+    def clear(self):
+        self.rosters.clear()
+        self.generation += 1
+
+
+CHAT_CACHE = ChatCache()
+
+
+@event.listens_for(Chat.users, 'append')
+@event.listens_for(Chat.users, 'remove')
+def on_chat_users_change(chat, user, initiator):
+    CHAT_CACHE.forget(chat)
+
+
+@event.listens_for(User.chats, 'append')
+@event.listens_for(User.chats, 'remove')
+def on_user_chats_change(user, chat, initiator):
+    CHAT_CACHE.forget(chat)
+
+
+@event.listens_for(Chat, 'after_delete')
+def on_chat_delete(mapper, connection, chat):
+    CHAT_CACHE.forget(chat)
 
 
 def create_user(name, password):
@@ -17,6 +134,7 @@ def create_user(name, password):
         user = User(name, password)
         s.add(user)
         s.commit()
+        USER_CACHE.add(user)
 
     return user
 
@@ -43,11 +161,16 @@ def make_friends(user, new_friends):
     """
     user.friends += new_friends
     s.commit()
+    USER_CACHE.forget_friends(user, *new_friends)
 
 
 def get_user_by_name(name):
+    user = USER_CACHE.by_name.get(name)
+    if user is not None:
+        return user
     res = s.query(User).filter(User.name == name).all()
     if len(res) == 1:
+        USER_CACHE.add(res[0])
         return res[0]
     elif res:
         raise Exception("More than one user with name {name} was found".format(name=name))
@@ -55,18 +178,89 @@ def get_user_by_name(name):
         return None
 
 
-def update_user_last_online_ts(user):
-    user.last_online_ts = datetime.datetime.utcnow()
-    s.commit()
+def load_user(name):
+    """
+    get_user_by_name for DB executor threads, see cache_user
+    :return: User detached from the session of the thread or None
+    """
+    with session_scope(expire_on_commit=False) as db_session:
+        return db_session.query(User).filter(User.name == name).one_or_none()
 
 
-def create_message(to_user, from_user, data):
-    message = Message(data, by=from_user, to=to_user)
-    s.add(message)
-    s.commit()
+def cache_user(user):
+    """
+    Cache user loaded by load_user (server loop thread)
+    :return: cached User (attached to the module session) or None
+    """
+    if user is None:
+        return None
+    cached = USER_CACHE.by_name.get(user.name)
+    if cached is None:
+        # loaded state is copied, no query
+        cached = s.merge(user, load=False)
+        USER_CACHE.add(cached)
+    return cached
+
+
+def get_user_by_id(user_id):
+    user = USER_CACHE.by_id.get(user_id)
+    if user is None:
+        user = s.query(User).get(user_id)
+        if user is not None:
+            USER_CACHE.add(user)
+    return user
+
+
+def get_friend_names(user):
+    """
+    Names of user's friends (both directions of friendship)
+    :param user: User instance
+    :return: frozenset of names
+    """
+    names = USER_CACHE.friend_names.get(user.id)
+    if names is None:
+        names = _query_friend_names(s, user.id)
+        USER_CACHE.friend_names[user.id] = names
+    return names
+
+
+def load_friend_names(user_id):
+    """
+    get_friend_names for DB executor threads, server loop caches the result with cache_friend_names
+    :param user_id: User id
+    :return: frozenset of names
+    """
+    with session_scope() as db_session:
+        return _query_friend_names(db_session, user_id)
+
+
+def cache_friend_names(user_id, names):
+    """
+    :return: cached friend names of the user, loaded ones if there are none
+    """
+    return USER_CACHE.friend_names.setdefault(user_id, names)
+
+
+def _query_friend_names(db_session, user_id):
+    return frozenset(name for name, in db_session.query(User.name).join(
+        friendship_union, User.id == friendship_union.c.friend_b_id).filter(
+        friendship_union.c.friend_a_id == user_id))
+
+
+def create_message(to_user, from_user, data, on_commit=None):
+    """
+    Save message, see MessageWriter.add
+    :param on_commit: callable to deliver the message
+    :return: Message instance, saved by MessageWriter later
+    """
+    message = Message(data, by_id=from_user.id, to_id=to_user.id)
+    message.created_ts = datetime.datetime.utcnow()  # time of sending, not of the batch commit
+    MESSAGE_WRITER.add(message, on_commit)
+    return message
 
 
 def get_messages(to_user, by_user=None, from_ts=None, to_ts=None):
+    MESSAGE_WRITER.flush()
     if not from_ts:
         from_ts = 0
     if not to_ts:
@@ -82,13 +276,23 @@ def get_messages(to_user, by_user=None, from_ts=None, to_ts=None):
             Message.created_ts.between(from_ts, to_ts)).all()
 
 
-def create_chat_message(to_chat, from_user, data):
-    message = ChatMessage(data, chat=to_chat, by=from_user)
-    s.add(message)
-    s.commit()
+def create_chat_message(chat_id, from_user, data, on_commit=None):
+    """
+    Save chat message, see MessageWriter.add
+    :param chat_id: id of the chat, chat itself isn't loaded
+    :param from_user: User instance of the sender
+    :param data: message text
+    :param on_commit: callable to deliver the message
+    :return: ChatMessage instance, saved by MessageWriter later
+    """
+    message = ChatMessage(data, chat_id=chat_id, sent_by=from_user.id)
+    message.created_ts = datetime.datetime.utcnow()
+    MESSAGE_WRITER.add(message, on_commit)
+    return message
 
 
 def get_chat_messages(chat_id, from_ts=None, to_ts=None):
+    MESSAGE_WRITER.flush()
     if not from_ts:
         from_ts = 0
     if not to_ts:
@@ -112,6 +316,8 @@ def create_chat(name, chat_owner, participants=None):
     chat.users = participants
     s.add(chat)
     s.commit()
+    CHAT_CACHE.rosters[chat.id] = ChatRoster(chat.id, chat_owner.name,
+                                             frozenset(user.name for user in participants))
     return chat
 
 
@@ -124,6 +330,52 @@ def get_chat_by_id(chat_id):
     return s.query(Chat).filter(Chat.id == chat_id).first()
 
 
+def get_chat_roster(chat_id):
+    """
+    Find out owner and members of the chat, DB is queried once per chat
+    :param chat_id: chat id, int or string
+    :return: ChatRoster or None if there is no chat with such ID
+    """
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        return None
+    roster = CHAT_CACHE.rosters.get(chat_id)
+    if roster is None:
+        roster = _chat_roster(get_chat_by_id(chat_id))
+        if roster is not None:
+            CHAT_CACHE.rosters[chat_id] = roster
+    return roster
+
+
+def load_chat_roster(chat_id):
+    """
+    get_chat_roster for DB executor threads, server loop caches the result with cache_chat_roster
+    :param chat_id: int
+    :return: ChatRoster or None if there is no chat with such ID
+    """
+    with session_scope() as db_session:
+        return _chat_roster(db_session.query(Chat).get(chat_id))
+
+
+def cache_chat_roster(generation, roster):
+    """
+    Cache roster loaded by load_chat_roster unless rosters were changed since the load was submitted
+    :param generation: CHAT_CACHE.generation at submit time
+    :param roster: ChatRoster or None
+    :return: roster
+    """
+    if roster is not None and generation == CHAT_CACHE.generation:
+        CHAT_CACHE.rosters.setdefault(roster.chat_id, roster)
+    return roster
+
+
+def _chat_roster(chat):
+    if chat is None:
+        return None
+    return ChatRoster(chat.id, chat.owner.name if chat.owner else None, frozenset(user.name for user in chat.users))
+
+
 def add_chat_participant(chat_id, participant_name):
     """
     Add chat participant to existent chat
@@ -131,46 +383,179 @@ def add_chat_participant(chat_id, participant_name):
     :param participant_name: User name
     :return: None
     """
+    roster = get_chat_roster(chat_id)
     chat = get_chat_by_id(chat_id)
-    chat.users.append(s.query(User).filter(User.name == participant_name).first())
+    chat.users.append(get_user_by_name(participant_name))
     s.add(chat)
     s.commit()
+    CHAT_CACHE.rosters[roster.chat_id] = roster._replace(members=roster.members | {participant_name})
 
 
-def create_chat(name, chat_owner, participants=None):
+# Functions below are called by DB worker threads of the server (see server.db_executor):
+# they get and return plain values and use a session per call
+
+
+def update_user_last_online_ts(user_id):
     """
-    Create chat
-    :param name: name of new chat
-    :param chat_owner: User instance of chat owner
-    :param participants: List of Users instants
-    :return: chat object
+    :param user_id: User id
+    :return: new last online time
     """
-    participants = participants if participants else []
-    chat = Chat(name, chat_owner)
-    participants.append(chat_owner)
-    chat.users = participants
-    s.add(chat)
-    s.commit()
-    return chat
+    last_online_ts = datetime.datetime.utcnow()
+    with session_scope() as db_session:
+        db_session.query(User).filter(User.id == user_id).update(
+            {User.last_online_ts: last_online_ts}, synchronize_session=False)
+    return last_online_ts
 
 
-def get_chat_by_id(chat_id):
+def get_delivery_cursors(user_id):
     """
-    Find out Chat in DB by chat id
-    :param chat_id: chat id
-    :return: Chat object if or None if there is no chat this such ID
+    Find ids of the last messages delivered to user, personal ones and in every chat of the user.
+    Missing cursors (new chats, users without cursors yet) are created from user's last online time.
+    :param user_id: User id
+    :return: dict {chat id or PERSONAL_CURSOR: message id}
     """
-    return s.query(Chat).filter(Chat.id == chat_id).first()
+    with session_scope() as db_session:
+        cursors = dict(db_session.query(DeliveryCursor.chat_id, DeliveryCursor.message_id).filter(
+            DeliveryCursor.user_id == user_id))
+        chat_ids = [chat_id for chat_id, in db_session.query(chat_to_user.c.chat_id).filter(
+            chat_to_user.c.user_id == user_id)]
+        last_online_ts = db_session.query(User.last_online_ts).filter(User.id == user_id).scalar()
+
+        missing = {}
+        if PERSONAL_CURSOR not in cursors:
+            missing[PERSONAL_CURSOR] = db_session.query(func.max(Message.id)).filter(
+                Message.to_id == user_id).filter(
+                Message.created_ts <= last_online_ts).scalar() or 0
+        missing_chats = [chat_id for chat_id in chat_ids if chat_id not in cursors]
+        if missing_chats:
+            missing.update({chat_id: 0 for chat_id in missing_chats})
+            missing.update(db_session.query(ChatMessage.chat_id, func.max(ChatMessage.id)).filter(
+                ChatMessage.chat_id.in_(missing_chats)).filter(
+                ChatMessage.created_ts <= last_online_ts).group_by(ChatMessage.chat_id))
+        _save_delivery_cursors(db_session, user_id, missing)
+    cursors.update(missing)
+    # user could leave some chats
+    return {chat_id: message_id for chat_id, message_id in cursors.items()
+            if chat_id == PERSONAL_CURSOR or chat_id in chat_ids}
+
+
+def save_delivery_cursors(user_id, cursors):
+    """
+    Move delivery cursors of user forward, cursors never go back
+    :param user_id: User id
+    :param cursors: dict {chat id or PERSONAL_CURSOR: message id}
+    :return: None
+    """
+    with session_scope() as db_session:
+        _save_delivery_cursors(db_session, user_id, cursors)
 
 
-def add_chat_participant(chat_id, participant_name):
+# one statement (SQLite 3.24+, PostgreSQL 9.5+): logout and the next login save cursors from different threads,
+# reading the row and inserting the missing one made both of them insert it
+UPSERT_DELIVERY_CURSOR = text(
+    "INSERT INTO delivery_cursor (user_id, chat_id, message_id) VALUES (:user_id, :chat_id, :message_id) "
+    "ON CONFLICT (user_id, chat_id) DO UPDATE SET message_id = excluded.message_id "
+    "WHERE delivery_cursor.message_id < excluded.message_id")
+
+
+def _save_delivery_cursors(db_session, user_id, cursors):
+    if cursors:
+        db_session.execute(UPSERT_DELIVERY_CURSOR, [{'user_id': user_id, 'chat_id': chat_id, 'message_id': message_id}
+                                                    for chat_id, message_id in cursors.items()])
+
+
+def get_offline_messages(user_id, cursors, page_size=REPLAY_PAGE_SIZE):
     """
-    Add chat participant to existent chat
-    :param chat_id: Chat object
-    :param participant_name: User name
+    Find messages sent to user and to user's chats after delivery cursors.
+    Messages saved later aren't looked up (they are delivered to online user),
+    messages are loaded by pages, every page is a separate range query by id in its own session,
+    so nothing is kept open between pages and pages can be loaded by different threads.
+    :param user_id: User id
+    :param cursors: dict {chat id or PERSONAL_CURSOR: id of the last delivered message}, see get_delivery_cursors
+    :return: iterator of pages, lists of OfflineMessage
+    """
+    with session_scope() as db_session:
+        last_message_id = db_session.query(func.max(Message.id)).scalar() or 0
+        last_chat_message_id = db_session.query(func.max(ChatMessage.id)).scalar() or 0
+
+    def personal(db_session):
+        return db_session.query(Message.id, Message.data, User.name.label('by')).join(
+            User, Message.by_id == User.id).filter(
+            Message.to_id == user_id).filter(
+            Message.id > cursors.get(PERSONAL_CURSOR, 0)).filter(
+            Message.id <= last_message_id)
+
+    chat_cursors = [and_(ChatMessage.chat_id == chat_id, ChatMessage.id > message_id)
+                    for chat_id, message_id in cursors.items() if chat_id != PERSONAL_CURSOR]
+
+    def chat(db_session):
+        return db_session.query(ChatMessage.id, ChatMessage.data, User.name.label('by'), ChatMessage.chat_id).join(
+            User, ChatMessage.sent_by == User.id).filter(
+            or_(*chat_cursors)).filter(
+            ChatMessage.id <= last_chat_message_id)
+
+    return _iter_offline_messages(personal, chat if chat_cursors else None, page_size)
+
+
+OfflineMessage = collections.namedtuple('OfflineMessage', ['id', 'chat_id', 'by', 'data'])
+
+
+def _iter_offline_messages(personal, chat, page_size):
+    for row_page in _paginate(personal, Message, page_size):
+        yield [OfflineMessage(row.id, PERSONAL_CURSOR, row.by, row.data) for row in row_page]
+    if chat is not None:
+        for row_page in _paginate(chat, ChatMessage, page_size):
+            yield [OfflineMessage(row.id, row.chat_id, row.by, row.data) for row in row_page]
+
+
+def _paginate(make_query, model, page_size):
+    """
+    Keyset pagination by id, uses (recipient, id) indexes
+    :param make_query: callable building the query for a session
+    """
+    last_id = None
+    while True:
+        with session_scope() as db_session:
+            page_query = make_query(db_session)
+            if last_id is not None:
+                page_query = page_query.filter(model.id > last_id)
+            rows = page_query.order_by(model.id).limit(page_size).all()
+        if rows:
+            yield rows
+            last_id = rows[-1].id
+        if len(rows) < page_size:
+            return
+
+
+def insert_chat(name, owner_id):
+    """
+    Create chat with the owner as the only member
+    :param name: name of new chat
+    :param owner_id: User id of chat owner
+    :return: new chat id
+    """
+    with session_scope() as db_session:
+        chat_id = db_session.execute(Chat.__table__.insert().values(
+            name=name, owner_id=owner_id, created_ts=datetime.datetime.utcnow())).inserted_primary_key[0]
+        db_session.execute(chat_to_user.insert().values(chat_id=chat_id, user_id=owner_id))
+    return chat_id
+
+
+def insert_chat_member(chat_id, user_id):
+    """
+    Add user to existent chat
+    :param chat_id: Chat id
+    :param user_id: User id
     :return: None
     """
-    chat = get_chat_by_id(chat_id)
-    chat.users.append(s.query(User).filter(User.name == participant_name).first())
-    s.add(chat)
-    s.commit()
+    with session_scope() as db_session:
+        db_session.execute(chat_to_user.insert().values(chat_id=chat_id, user_id=user_id))
+
+
+def get_user_chats_info(user_id):
+    """
+    :param user_id: User id
+    :return: text describing chats of the user
+    """
+    with session_scope() as db_session:
+        return str(db_session.query(User).get(user_id).chats)
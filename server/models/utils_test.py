@@ -0,0 +1,249 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from sqlalchemy import event, inspect
+
+from server.models import Base, init_db, create_missing_indexes, session_scope
+from server.models.utils import s, USER_CACHE, CHAT_CACHE, create_users, make_friends, get_user_by_name, \
+    get_user_by_id, get_friend_names, create_chat, add_chat_participant, get_chat_roster, get_chat_messages, \
+    create_chat_message, create_message, get_offline_messages, get_delivery_cursors, save_delivery_cursors, \
+    update_user_last_online_ts, PERSONAL_CURSOR, _save_delivery_cursors, load_user, cache_user, load_friend_names, \
+    cache_friend_names, load_chat_roster, cache_chat_roster
+
+
+class TestUserCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        init_db('sqlite:///:memory:')
+        cls.users = create_users(name_pass=[('cacheA', 'passA'), ('cacheB', 'passB'), ('cacheC', 'passC')])
+
+    def setUp(self):
+        self.queries = []
+        event.listen(Base.metadata.bind, 'before_cursor_execute', self.count_query)
+
+    def tearDown(self):
+        event.remove(Base.metadata.bind, 'before_cursor_execute', self.count_query)
+
+    def count_query(self, conn, cursor, statement, *args):
+        self.queries.append(statement)
+
+    def test_user_lookups_are_cached(self):
+        user = self.users['cacheA']
+        USER_CACHE.clear()
+        self.assertIs(get_user_by_name('cacheA'), user)
+        queries = len(self.queries)
+        self.assertIs(get_user_by_name('cacheA'), user)
+        self.assertIs(get_user_by_id(user.id), user)
+        self.assertEqual(len(self.queries), queries)
+
+    def test_unknown_user(self):
+        self.assertIsNone(get_user_by_name('cacheX'))
+        self.assertNotIn('cacheX', USER_CACHE.by_name)
+
+    def test_user_loaded_by_other_session(self):
+        USER_CACHE.clear()
+        user = cache_user(load_user('cacheB'))
+        self.assertIs(user, get_user_by_name('cacheB'))
+        self.assertIn(user, s)  # usable by the module session like the ones it loads
+        self.assertIsNone(cache_user(load_user('cacheX')))
+
+        names = load_friend_names(user.id)
+        self.assertIs(cache_friend_names(user.id, names), names)
+        self.assertIs(get_friend_names(user), names)
+
+    def test_friend_names(self):
+        user_a, user_b, user_c = self.users['cacheA'], self.users['cacheB'], self.users['cacheC']
+        make_friends(user_a, [user_b])
+        self.assertEqual(get_friend_names(user_a), {'cacheB'})
+        self.assertEqual(get_friend_names(user_b), {'cacheA'})
+        queries = len(self.queries)
+        self.assertIn('cacheB', get_friend_names(user_a))
+        self.assertEqual(len(self.queries), queries)
+
+        # invalidated by writes to the relationship
+        user_c.friends.append(user_a)
+        s.commit()
+        self.assertEqual(get_friend_names(user_a), {'cacheB', 'cacheC'})
+        user_a.friends.remove(user_b)
+        s.commit()
+        self.assertEqual(get_friend_names(user_a), {'cacheC'})
+        self.assertEqual(get_friend_names(user_b), set())
+
+
+class TestChatCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        init_db('sqlite:///:memory:')
+        cls.users = create_users(name_pass=[('chatA', 'passA'), ('chatB', 'passB'), ('chatC', 'passC')])
+
+    def setUp(self):
+        self.queries = []
+        event.listen(Base.metadata.bind, 'before_cursor_execute', self.count_query)
+
+    def tearDown(self):
+        event.remove(Base.metadata.bind, 'before_cursor_execute', self.count_query)
+
+    def count_query(self, conn, cursor, statement, *args):
+        self.queries.append(statement)
+
+    def test_roster(self):
+        chat_id = create_chat('roster', self.users['chatA'], [self.users['chatB']]).id
+        queries = len(self.queries)
+        roster = get_chat_roster(str(chat_id))
+        self.assertEqual(roster.chat_id, chat_id)
+        self.assertEqual(roster.owner, 'chatA')
+        self.assertEqual(roster.members, {'chatA', 'chatB'})
+        self.assertEqual(len(self.queries), queries)
+
+        add_chat_participant(chat_id, 'chatC')
+        queries = len(self.queries)
+        self.assertEqual(get_chat_roster(chat_id).members, {'chatA', 'chatB', 'chatC'})
+        self.assertEqual(len(self.queries), queries)
+
+    def test_roster_is_loaded_once(self):
+        chat_id = create_chat('loaded', self.users['chatA'], [self.users['chatC']]).id
+        CHAT_CACHE.clear()
+        self.assertEqual(get_chat_roster(chat_id).members, {'chatA', 'chatC'})
+        queries = len(self.queries)
+        get_chat_roster(chat_id)
+        self.assertEqual(len(self.queries), queries)
+
+    def test_direct_writes_invalidate_roster(self):
+        chat = create_chat('direct', self.users['chatA'])
+        get_chat_roster(chat.id)
+        chat.users.append(self.users['chatB'])
+        s.commit()
+        self.assertEqual(get_chat_roster(chat.id).members, {'chatA', 'chatB'})
+
+    def test_roster_loaded_by_other_session(self):
+        chat_id = create_chat('other', self.users['chatA'], [self.users['chatB']]).id
+        CHAT_CACHE.clear()
+        generation = CHAT_CACHE.generation
+        roster = load_chat_roster(chat_id)
+        self.assertEqual(roster.members, {'chatA', 'chatB'})
+        self.assertIsNone(load_chat_roster(100500))
+
+        # members changed while the roster was loaded, it isn't cached
+        CHAT_CACHE.changed(chat_id)
+        self.assertIs(cache_chat_roster(generation, roster), roster)
+        self.assertNotIn(chat_id, CHAT_CACHE.rosters)
+        cache_chat_roster(CHAT_CACHE.generation, roster)
+        self.assertIs(CHAT_CACHE.rosters[chat_id], roster)
+
+    def test_unknown_chat(self):
+        self.assertIsNone(get_chat_roster(100500))
+        self.assertIsNone(get_chat_roster('not an id'))
+
+    def test_chat_message_by_id(self):
+        chat = create_chat('messages', self.users['chatA'])
+        create_chat_message(chat.id, self.users['chatA'], 'hello')
+        self.assertEqual([m.data for m in get_chat_messages(chat.id)], [b'hello'])  # payloads are stored as bytes
+
+
+class TestOfflineMessages(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        init_db('sqlite:///:memory:')
+        cls.users = create_users(name_pass=[('replayA', 'passA'), ('replayB', 'passB'), ('replayC', 'passC')])
+
+    def test_indexes(self):
+        indexes = {index['name']: index['column_names'] for index in inspect(Base.metadata.bind).get_indexes('message')}
+        self.assertEqual(indexes['ix_message_to_id_id'], ['to_id', 'id'])
+
+        next(iter(Base.metadata.tables['chat_message'].indexes)).drop(bind=Base.metadata.bind)
+        create_missing_indexes(Base.metadata.bind)
+        indexes = [index['name'] for index in inspect(Base.metadata.bind).get_indexes('chat_message')]
+        self.assertEqual(indexes, ['ix_chat_message_chat_id_id'])
+
+    def test_pages(self):
+        user_a, user_b, user_c = self.users['replayA'], self.users['replayB'], self.users['replayC']
+        seen = create_message(user_a, user_b, 'seen')
+        for n in range(5):
+            create_message(user_a, user_b, 'personal {}'.format(n))
+        create_message(user_b, user_c, 'not for replayA')
+        chat_id = create_chat('replay', user_c, [user_a]).id
+        chat_seen = create_chat_message(chat_id, user_c, 'chat seen')
+        create_chat_message(chat_id, user_c, 'chat')
+
+        pages = get_offline_messages(user_a.id, {PERSONAL_CURSOR: seen.id, chat_id: chat_seen.id}, page_size=2)
+        create_message(user_a, user_b, 'delivered as soon as saved')
+        pages = list(pages)
+        self.assertEqual([len(page) for page in pages], [2, 2, 1, 1])
+        messages = [m for page in pages for m in page]
+        self.assertEqual([m.data for m in messages], [b'personal %d' % n for n in range(5)] + [b'chat'])
+        self.assertEqual(messages[0].by, 'replayB')
+        self.assertEqual(messages[0].chat_id, PERSONAL_CURSOR)
+        self.assertEqual((messages[-1].chat_id, messages[-1].by), (chat_id, 'replayC'))
+        self.assertLess(messages[0].id, messages[1].id)
+
+    def test_delivery_cursors(self):
+        user_a, user_b, user_c = self.users['replayA'], self.users['replayB'], self.users['replayC']
+        chat_id = create_chat('cursors', user_b, [user_c]).id
+        seen = create_message(user_c, user_a, 'seen')
+        chat_seen = create_chat_message(chat_id, user_b, 'seen')
+        update_user_last_online_ts(user_c.id)
+        unseen = create_message(user_c, user_a, 'unseen')
+
+        # created from last online time
+        self.assertEqual(get_delivery_cursors(user_c.id), {PERSONAL_CURSOR: seen.id, chat_id: chat_seen.id})
+
+        save_delivery_cursors(user_c.id, {PERSONAL_CURSOR: unseen.id})
+        save_delivery_cursors(user_c.id, {PERSONAL_CURSOR: seen.id})  # never goes back
+        self.assertEqual(get_delivery_cursors(user_c.id)[PERSONAL_CURSOR], unseen.id)
+
+
+class TestDeliveryCursorsConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        init_db('sqlite:///{}'.format(os.path.join(self.db_dir, 'cursors.db')))
+
+    def tearDown(self):
+        init_db('sqlite:///:memory:')  # releases the file
+        for name in os.listdir(self.db_dir):
+            os.remove(os.path.join(self.db_dir, name))
+        os.rmdir(self.db_dir)
+
+    def test_missing_cursor_saved_by_two_threads(self):
+        # logout and the next login save the same missing cursor from different DB threads
+        user_id = create_users(name_pass=[('raceA', 'passA')])['raceA'].id
+        errors = []
+        saved, release = threading.Event(), threading.Event()
+
+        def logout():
+            try:
+                with session_scope() as db_session:
+                    _save_delivery_cursors(db_session, user_id, {PERSONAL_CURSOR: 1})
+                    saved.set()
+                    release.wait()
+            except Exception as e:
+                errors.append(e)
+
+        def login():
+            try:
+                save_delivery_cursors(user_id, {PERSONAL_CURSOR: 2})
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=logout), threading.Thread(target=login)]
+        threads[0].start()
+        saved.wait(1)
+        threads[1].start()
+        time.sleep(0.2)  # second one waits for the first one's commit
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        with session_scope() as db_session:
+            self.assertEqual(db_session.execute('SELECT message_id FROM delivery_cursor').fetchall(), [(2,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
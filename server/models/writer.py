@@ -0,0 +1,178 @@
+import collections
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+# when callbacks of added rows (delivery to recipients) are called
+DURABILITY_FLUSH = 'flush'  # after the row is committed
+DURABILITY_IMMEDIATE = 'immediate'  # right away, the row is committed later
+DURABILITIES = [DURABILITY_FLUSH, DURABILITY_IMMEDIATE]
+
+
+class MessageWriter:
+    """
+    Write-behind persistence of Message/ChatMessage rows with group commit:
+    added rows are committed in one transaction once `batch_size` rows are pending
+    or the oldest of them waits for `flush_interval` seconds.
+
+    Server loop calls tick() (and waits for timeout() seconds at most), flush() drains pending rows.
+    Defaults (batch of 1 row) keep the commit per row behaviour for scripts and tests.
+    Rows added between hold() and release() (frames of one read, see server.base_client.FrameBatch)
+    don't trigger a flush by batch size until release(), so a burst of them is committed together.
+
+    Rows are committed by `session` in the calling thread, or with an executor (see server.db_executor)
+    by its worker threads with sessions of `session_scope`: one batch at a time, batches queued
+    meanwhile are committed together, callbacks are called by the server loop in order.
+    """
+
+    def __init__(self, session, batch_size=1, flush_interval=0.05, durability=DURABILITY_FLUSH,
+                 clock=time.monotonic, session_scope=None):
+        self.session = session
+        self.session_scope = session_scope
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.clock = clock
+        self.executor = None
+        self.pending = []
+        self.callbacks = []
+        self.oldest_ts = None  # clock() when the oldest pending row was added
+        self.holds = 0  # nested hold() calls
+        self.committing = None  # (rows, callbacks) being committed by executor
+        self.queued = collections.deque()  # (rows, callbacks) waiting for it
+
+    def configure(self, batch_size, flush_interval, durability, executor=None):
+        if durability not in DURABILITIES:
+            raise ValueError(durability)
+        self.flush()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.executor = executor
+
+    def add(self, row, on_commit=None):
+        """
+        Queue row for insert
+        :param row: model instance
+        :param on_commit: callable taking the row, called according to durability
+                          (row.id is not known yet in DURABILITY_IMMEDIATE mode)
+        :return: None
+        """
+        if not self.pending:
+            self.oldest_ts = self.clock()
+        self.pending.append(row)
+        if on_commit:
+            if self.durability == DURABILITY_IMMEDIATE:
+                on_commit(row)
+            else:
+                self.callbacks.append((on_commit, row))
+        if len(self.pending) >= self.batch_size and not self.holds:
+            self.flush()
+
+    def after_commit(self, row, callback):
+        """
+        Call callback(row) once pending row is committed, whatever the durability
+        (e.g. on_commit of DURABILITY_IMMEDIATE mode which needs row.id for some recipients)
+        :return: None
+        """
+        self.callbacks.append((callback, row))
+
+    def hold(self):
+        """
+        Don't flush by batch size until release(), interval flushes (tick, timeout) work as usual
+        :return: None
+        """
+        self.holds += 1
+
+    def release(self):
+        """
+        End of hold(): flush if pending rows have reached the batch size meanwhile
+        :return: None
+        """
+        self.holds -= 1
+        if not self.holds and len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def timeout(self):
+        """
+        :return: seconds until pending rows have to be flushed, None if there are no pending rows
+        """
+        if not self.pending:
+            return None
+        return max(0, self.oldest_ts + self.flush_interval - self.clock())
+
+    def tick(self):
+        """
+        Flush pending rows if the oldest of them has waited long enough
+        :return: None
+        """
+        if self.pending and self.clock() - self.oldest_ts >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit all pending rows in one transaction and call their callbacks,
+        with executor the transaction is only started
+        :return: number of committed (or submitted) rows
+        """
+        if not self.pending:
+            return 0
+        rows, callbacks = self.pending, self.callbacks
+        self.pending, self.callbacks, self.oldest_ts = [], [], None
+        if self.executor is None:
+            return self._commit_in_session(rows, callbacks)
+        self.queued.append((rows, callbacks))
+        if self.committing is None:
+            self._commit_next()
+        return len(rows)
+
+    def _commit_in_session(self, rows, callbacks):
+        try:
+            self.session.add_all(rows)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            log.exception("%d messages were not saved", len(rows))
+            return 0
+        self._committed(rows, callbacks)
+        return len(rows)
+
+    def _committed(self, rows, callbacks):
+        log.debug("%d messages were saved", len(rows))
+        for callback, row in callbacks:
+            try:
+                callback(row)
+            except Exception:
+                log.exception("Message callback failed")
+
+    def _commit_next(self):
+        rows, callbacks = [], []
+        while self.queued:
+            batch_rows, batch_callbacks = self.queued.popleft()
+            rows += batch_rows
+            callbacks += batch_callbacks
+        self.committing = rows, callbacks
+        self.executor.submit(self._commit_in_thread, rows, callback=self._on_commit, errback=self._on_error)
+
+    def _commit_in_thread(self, rows):
+        # executor worker thread
+        with self.session_scope() as db_session:
+            db_session.add_all(rows)
+        return len(rows)
+
+    def _on_commit(self, count):
+        rows, callbacks = self.committing
+        self.committing = None
+        if self.queued:
+            self._commit_next()
+        self._committed(rows, callbacks)
+
+    def _on_error(self, error):
+        rows, callbacks = self.committing
+        self.committing = None
+        log.error("%d messages were not saved: %r", len(rows), error)
+        if self.queued:
+            self._commit_next()
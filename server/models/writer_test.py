@@ -0,0 +1,184 @@
+import contextlib
+import unittest
+
+from server.models.writer import MessageWriter, DURABILITY_FLUSH, DURABILITY_IMMEDIATE
+
+
+class FakeSession:
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.added = []
+        self.commits = []
+        self.rollbacks = 0
+
+    def add_all(self, rows):
+        self.added.extend(rows)
+
+    def commit(self):
+        if self.fail:
+            raise Exception("commit failed")
+        self.commits.append(list(self.added))
+        self.added = []
+
+    def rollback(self):
+        self.added = []
+        self.rollbacks += 1
+
+
+class ManualExecutor:
+    """
+    Runs submitted calls when test says so
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, func, *args, callback=None, errback=None):
+        self.calls.append((func, args, callback, errback))
+
+    def complete(self):
+        func, args, callback, errback = self.calls.pop(0)
+        try:
+            result = func(*args)
+        except Exception as e:
+            errback(e)
+        else:
+            if callback:
+                callback(result)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMessageWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        self.clock = FakeClock()
+        self.writer = MessageWriter(self.session, batch_size=3, flush_interval=0.5, clock=self.clock)
+        self.delivered = []
+
+    def test_batch_size(self):
+        for row in ['a', 'b']:
+            self.writer.add(row, on_commit=self.delivered.append)
+        self.assertEqual(self.session.commits, [])
+        self.assertEqual(self.delivered, [])
+
+        self.writer.add('c', on_commit=self.delivered.append)
+        self.assertEqual(self.session.commits, [['a', 'b', 'c']])
+        self.assertEqual(self.delivered, ['a', 'b', 'c'])
+        self.assertIsNone(self.writer.timeout())
+
+    def test_hold(self):
+        self.writer.hold()
+        for row in ['a', 'b', 'c', 'd']:
+            self.writer.add(row, on_commit=self.delivered.append)
+        self.assertEqual(self.session.commits, [])
+        self.writer.release()
+        self.assertEqual(self.session.commits, [['a', 'b', 'c', 'd']])
+        self.assertEqual(self.delivered, ['a', 'b', 'c', 'd'])
+
+        # below the batch size rows wait for the interval as usual
+        self.writer.hold()
+        self.writer.add('e')
+        self.writer.release()
+        self.assertEqual(len(self.session.commits), 1)
+        self.assertEqual(self.writer.pending, ['e'])
+
+    def test_flush_interval(self):
+        self.assertIsNone(self.writer.timeout())
+        self.writer.add('a')
+        self.clock.now += 0.25
+        self.assertEqual(self.writer.timeout(), 0.25)
+        self.writer.add('b')
+        self.writer.tick()
+        self.assertEqual(self.session.commits, [])
+
+        self.clock.now += 0.25
+        self.assertEqual(self.writer.timeout(), 0)
+        self.writer.tick()
+        self.assertEqual(self.session.commits, [['a', 'b']])
+
+    def test_immediate_durability(self):
+        self.writer.durability = DURABILITY_IMMEDIATE
+        self.writer.add('a', on_commit=self.delivered.append)
+        self.assertEqual(self.delivered, ['a'])
+        self.assertEqual(self.session.commits, [])
+        self.assertEqual(self.writer.flush(), 1)
+
+    def test_after_commit(self):
+        self.writer.durability = DURABILITY_IMMEDIATE
+        self.writer.add('a', on_commit=lambda row: self.writer.after_commit(row, self.delivered.append))
+        self.assertEqual(self.delivered, [])
+        self.writer.flush()
+        self.assertEqual(self.delivered, ['a'])
+
+    def test_failed_commit(self):
+        self.writer.session = FakeSession(fail=True)
+        self.writer.add('a', on_commit=self.delivered.append)
+        self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(self.writer.session.rollbacks, 1)
+        self.assertEqual(self.delivered, [])
+        self.assertFalse(self.writer.pending)
+
+    def test_configure(self):
+        self.writer.add('a')
+        self.writer.configure(batch_size=10, flush_interval=1, durability=DURABILITY_FLUSH)
+        self.assertEqual(self.session.commits, [['a']])
+        with self.assertRaises(ValueError):
+            self.writer.configure(batch_size=10, flush_interval=1, durability='never')
+
+
+class TestMessageWriterExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        self.executor = ManualExecutor()
+        self.writer = MessageWriter(None, session_scope=self.session_scope)
+        self.writer.configure(batch_size=1, flush_interval=0.5, durability=DURABILITY_FLUSH, executor=self.executor)
+        self.delivered = []
+
+    @contextlib.contextmanager
+    def session_scope(self):
+        try:
+            yield self.session
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def test_batches_are_committed_in_order(self):
+        self.writer.add('a', on_commit=self.delivered.append)
+        self.assertEqual(len(self.executor.calls), 1)
+        # queued while 'a' is being committed, committed together
+        self.writer.add('b', on_commit=self.delivered.append)
+        self.writer.add('c', on_commit=self.delivered.append)
+        self.assertEqual(len(self.executor.calls), 1)
+
+        self.executor.complete()
+        self.assertEqual(self.delivered, ['a'])
+        self.executor.complete()
+        self.assertEqual(self.session.commits, [['a'], ['b', 'c']])
+        self.assertEqual(self.delivered, ['a', 'b', 'c'])
+        self.assertIsNone(self.writer.committing)
+
+    def test_failed_commit(self):
+        self.writer.add('a', on_commit=self.delivered.append)
+        self.writer.add('b', on_commit=self.delivered.append)
+        self.session.fail = True
+        self.executor.complete()
+        self.session.fail = False
+        self.executor.complete()
+        self.assertEqual(self.delivered, ['b'])
+        self.assertEqual(self.session.rollbacks, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,28 +5,145 @@ import logging
 log = logging.getLogger(__name__)
 
 
-class DictProxy(collections.MutableMapping):
+class PresenceRegistry:
+    """
+    Clients of users logged in to this process by user name,
+    counts of users per status and reverse index of subscribers - online friends to notify
+    about status changes of a user (friendship goes both ways, so that's friends of the user
+    which are online). Friend names are taken on login and on status changes, see subscribe().
+    """
 
-    def __init__(self, *args, **kwargs):
-        self.store = dict()
-        self.update(dict(*args, **kwargs))
+    def __init__(self):
+        self.by_name = {}
+        self.statuses = {}  # {name: status}
+        self.status_counts = collections.Counter()
+        self.friend_names = {}  # {name: friend names the subscribers were built from}
+        self.online_friends = {}  # {name: set of names of online friends}
 
-    def __getitem__(self, key):
-        return self.store[key]
+    def add(self, client, friend_names=()):
+        """
+        Register client of a logged in user
+        :param client: Client instance with user set
+        :param friend_names: names of user's friends
+        :return: None
+        """
+        name = client.user.name
+        self.by_name[name] = client
+        self.online_friends[name] = set()
+        self.subscribe(name, friend_names)
+        log.debug("%s is online, %d users online", name, len(self.by_name))
 
-    def __setitem__(self, key, value):
-        self.store[key] = value
-        log.info(str(self.store))
+    def remove(self, name):
+        """
+        Unregister client of user
+        :param name: user name
+        :return: None
+        """
+        del self.by_name[name]
+        self.set_status(name, None)
+        del self.friend_names[name]
+        for friend_name in self.online_friends.pop(name):
+            self.online_friends[friend_name].discard(name)
+        log.debug("%s is offline, %d users online", name, len(self.by_name))
 
-    def __delitem__(self, key):
-        del self.store[key]
-        log.info(str(self.store))
+    def set_status(self, name, status, friend_names=None):
+        """
+        :param name: name of online user
+        :param status: new status, None on logout
+        :param friend_names: refresh subscribers with current friend names, see subscribe()
+        :return: None
+        """
+        previous = self.statuses.pop(name, None)
+        if previous is not None:
+            self.status_counts[previous] -= 1
+        if status is not None:
+            self.statuses[name] = status
+            self.status_counts[status] += 1
+        if friend_names is not None:
+            self.subscribe(name, friend_names)
+
+    def subscribe(self, name, friend_names):
+        """
+        Update subscribers of online user (and the user's subscriptions) to given friend names,
+        nothing to do if that's the same (cached) set of names as the last time
+        :return: None
+        """
+        if self.friend_names.get(name) is friend_names:
+            return
+        self.friend_names[name] = friend_names
+        online = {friend_name for friend_name in friend_names if friend_name in self.by_name and friend_name != name}
+        current = self.online_friends[name]
+        for friend_name in current - online:
+            self.online_friends[friend_name].discard(name)
+        for friend_name in online - current:
+            self.online_friends[friend_name].add(name)
+        self.online_friends[name] = online
+
+    def subscribers(self, name):
+        """
+        :return: frozenset of names of online users to notify about status changes of the user
+        """
+        return frozenset(self.online_friends.get(name, ()))
+
+    def get(self, name, default=None):
+        return self.by_name.get(name, default)
+
+    def items(self):
+        return self.by_name.items()
+
+    def snapshot(self):
+        """
+        :return: list of clients, safe to iterate while clients log out
+        """
+        return list(self.by_name.values())
+
+    def __contains__(self, name):
+        return name in self.by_name
 
     def __iter__(self):
-        return iter(self.store)
+        return iter(self.by_name)
 
     def __len__(self):
-        return len(self.store)
+        return len(self.by_name)
+
+
+ONLINE_USERS = PresenceRegistry()
+
+# users connected to other worker processes {name: RemoteClient}, see server.cluster
+REMOTE_USERS = {}
+
+# callables (name, status) notified about status changes of local users, status is None on logout
+PRESENCE_LISTENERS = []
+
+
+def get_online_client(name):
+    """
+    Find client of online user
+    :param name: user name
+    :return: local Client, RemoteClient if user is connected to another worker or None
+    """
+    client = ONLINE_USERS.get(name)
+    return client if client is not None else REMOTE_USERS.get(name)
+
+
+def is_online(name):
+    return name in ONLINE_USERS or name in REMOTE_USERS
+
+
+def get_subscribers(name, friend_names):
+    """
+    Names of users to notify about status changes of local user: online friends of this process
+    and, with other workers running, friends connected to them
+    :param name: user name
+    :param friend_names: names of user's friends
+    :return: frozenset of names
+    """
+    subscribers = ONLINE_USERS.subscribers(name)
+    if REMOTE_USERS:
+        subscribers |= {friend_name for friend_name in friend_names if friend_name in REMOTE_USERS}
+    return subscribers
 
 
-ONLINE_USERS = DictProxy()
+def publish_presence(name, status):
+    for listener in PRESENCE_LISTENERS:
+        listener(name, status)
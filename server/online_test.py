@@ -0,0 +1,59 @@
+import unittest
+from types import SimpleNamespace
+
+from server.online import PresenceRegistry
+
+
+def make_client(name):
+    return SimpleNamespace(user=SimpleNamespace(name=name))
+
+
+class TestPresenceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = PresenceRegistry()
+        self.alice = make_client('alice')
+        self.bob = make_client('bob')
+        self.carol = make_client('carol')
+
+    def test_lookups(self):
+        self.registry.add(self.alice)
+        self.assertIs(self.registry.get('alice'), self.alice)
+        self.assertIn('alice', self.registry)
+        self.assertEqual(self.registry.snapshot(), [self.alice])
+
+        self.registry.remove('alice')
+        self.assertIsNone(self.registry.get('alice'))
+        self.assertEqual(len(self.registry), 0)
+
+    def test_status_counts(self):
+        self.registry.add(self.alice)
+        self.registry.add(self.bob)
+        self.registry.set_status('alice', 'ONLINE')
+        self.registry.set_status('bob', 'ONLINE')
+        self.registry.set_status('bob', 'BUSY')
+        self.assertEqual(self.registry.status_counts['ONLINE'], 1)
+        self.assertEqual(self.registry.status_counts['BUSY'], 1)
+        self.registry.remove('bob')
+        self.assertEqual(self.registry.status_counts['BUSY'], 0)
+
+    def test_subscribers(self):
+        self.registry.add(self.alice, frozenset(['bob', 'carol']))
+        self.assertEqual(self.registry.subscribers('alice'), set())
+        self.registry.add(self.bob, frozenset(['alice']))
+        self.registry.add(self.carol, frozenset())
+        self.assertEqual(self.registry.subscribers('alice'), {'bob'})
+        self.assertEqual(self.registry.subscribers('bob'), {'alice'})
+
+        # friendship of alice and carol is seen by carol's next status change
+        self.registry.set_status('carol', 'ONLINE', frozenset(['alice']))
+        self.assertEqual(self.registry.subscribers('alice'), {'bob', 'carol'})
+        self.assertEqual(self.registry.subscribers('carol'), {'alice'})
+
+        self.registry.remove('alice')
+        self.assertEqual(self.registry.subscribers('bob'), set())
+        self.assertEqual(self.registry.subscribers('carol'), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
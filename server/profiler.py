@@ -0,0 +1,207 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import socket
+import time
+import tracemalloc
+
+
+log = logging.getLogger(__name__)
+
+
+# lines of text reports written next to the dumps
+REPORT_LINES = 50
+
+# frames kept per traceback of traced memory blocks
+TRACEMALLOC_FRAMES = 10
+
+# seconds a capture runs unless requested otherwise
+DEFAULT_SECONDS = 30
+
+
+class Profiler:
+    """
+    On-demand captures from the live process, requested by a signal (see install_signal_handlers)
+    or SRV command (see Client.service_info): cProfile of the thread running client handlers for some seconds,
+    or tracemalloc snapshot of memory allocated during some seconds.
+    Dumps and text reports are written to `directory` (log directory of the server).
+
+    Requests only set the duration, server loop calls tick() to start and finish captures
+    (and waits for timeout() seconds at most), so they run in the thread handling clients,
+    as cProfile works per thread, and nothing is done in a signal handler.
+    Signals wake an idle selectors loop up through SignalWakeup.
+    """
+
+    def __init__(self, directory='.', seconds=DEFAULT_SECONDS, clock=time.monotonic):
+        self.directory = directory
+        self.seconds = seconds
+        self.clock = clock
+        self.profile_requested = None  # seconds to profile for
+        self.memory_requested = None
+        self.profile = None
+        self.profile_until = None
+        self.memory_until = None
+        self.memory_tracing_started = False  # tracing was started by the capture, it stops it too
+
+    def configure(self, directory, seconds=DEFAULT_SECONDS):
+        self.directory = directory
+        self.seconds = seconds
+
+    @property
+    def profiling(self):
+        return self.profile is not None
+
+    @property
+    def capturing_memory(self):
+        return self.memory_until is not None
+
+    def request_profile(self, seconds=None):
+        """
+        :param seconds: duration of profiling, configured one by default
+        :return: False if profiling is requested or running already
+        """
+        if self.profiling or self.profile_requested is not None:
+            return False
+        self.profile_requested = seconds or self.seconds
+        return True
+
+    def request_memory_capture(self, seconds=None):
+        """
+        :param seconds: duration of tracing memory allocations, configured one by default
+        :return: False if capture is requested or running already
+        """
+        if self.capturing_memory or self.memory_requested is not None:
+            return False
+        self.memory_requested = seconds or self.seconds
+        return True
+
+    def timeout(self):
+        """
+        :return: seconds until a capture has to be started or finished, None if nothing is requested or running
+        """
+        if self.profile_requested is not None or self.memory_requested is not None:
+            return 0
+        deadlines = [deadline for deadline in (self.profile_until, self.memory_until) if deadline is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - self.clock())
+
+    def tick(self):
+        """
+        Start requested captures, finish the ones which have run long enough
+        :return: None
+        """
+        if self.profile_requested is not None:
+            self.start_profile(self.profile_requested)
+        elif self.profile_until is not None and self.clock() >= self.profile_until:
+            self.stop_profile()
+        if self.memory_requested is not None:
+            self.start_memory_capture(self.memory_requested)
+        elif self.memory_until is not None and self.clock() >= self.memory_until:
+            self.take_memory_snapshot()
+
+    def start_profile(self, seconds):
+        log.warning("Profiling for %ss", seconds)
+        self.profile_requested = None
+        self.profile = cProfile.Profile()
+        self.profile_until = self.clock() + seconds
+        self.profile.enable()
+
+    def start_memory_capture(self, seconds):
+        log.warning("Tracing memory allocations for %ss", seconds)
+        self.memory_requested = None
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.memory_tracing_started = True
+        self.memory_until = self.clock() + seconds
+
+    def dump_path(self, kind, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, '{kind}-{pid}-{ts}.{ext}'.format(
+            kind=kind, pid=os.getpid(), ts=time.strftime('%Y%m%d-%H%M%S'), ext=extension))
+
+    def stop_profile(self):
+        """
+        Stop profiling, write stats (for pstats/snakeviz) and report of the top functions by cumulative time
+        :return: path of the stats file
+        """
+        profile, self.profile, self.profile_until = self.profile, None, None
+        profile.disable()
+        path = self.dump_path('profile', 'prof')
+        profile.dump_stats(path)
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(REPORT_LINES)
+        with open(path[:-len('prof')] + 'txt', 'w') as f:
+            f.write(report.getvalue())
+        log.warning("Profile is written to %s", path)
+        return path
+
+    def take_memory_snapshot(self):
+        """
+        Write tracemalloc snapshot (for tracemalloc.Snapshot.load) and report of the top allocation sites
+        :return: path of the snapshot file
+        """
+        snapshot = tracemalloc.take_snapshot()
+        self.memory_until = None
+        if self.memory_tracing_started:
+            tracemalloc.stop()
+            self.memory_tracing_started = False
+        path = self.dump_path('memory', 'snapshot')
+        snapshot.dump(path)
+        with open(path[:-len('snapshot')] + 'txt', 'w') as f:
+            for stat in snapshot.statistics('lineno')[:REPORT_LINES]:
+                f.write('{}\n'.format(stat))
+        log.warning("Memory snapshot is written to %s", path)
+        return path
+
+
+def install_signal_handlers(profiler):
+    """
+    SIGUSR1 - profile, SIGUSR2 - capture memory allocations, for configured number of seconds.
+    Must be called from the main thread.
+    :param profiler: Profiler
+    :return: None
+    """
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.request_profile())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.request_memory_capture())
+
+
+class SignalWakeup:
+    """
+    Makes select() return when a signal arrives: signal.set_wakeup_fd writes to one socket of a pair,
+    the other one is registered in the selector. Python handlers run before select() returns,
+    so the loop ticks with the requests they made (select() waiting without timeout would be
+    resumed after the handlers otherwise).
+    Must be created in the main thread.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+        self.previous_fd = signal.set_wakeup_fd(self.writer.fileno(), warn_on_full_buffer=False)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def on_read(self, fileobj=None, mask=None):
+        """
+        Selector callback: drop signal numbers written by the wakeups
+        :return: None
+        """
+        try:
+            while self.reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        signal.set_wakeup_fd(self.previous_fd)
+        self.reader.close()
+        self.writer.close()
+
+
+PROFILER = Profiler()
@@ -0,0 +1,82 @@
+import os
+import pstats
+import selectors
+import signal
+import tempfile
+import tracemalloc
+import unittest
+
+from server.profiler import Profiler, SignalWakeup, install_signal_handlers
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.now = [100.0]
+        self.profiler = Profiler(self.directory.name, seconds=5, clock=lambda: self.now[0])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def dumps(self):
+        return sorted(os.listdir(self.directory.name))
+
+    def test_profile(self):
+        self.assertIsNone(self.profiler.timeout())
+        self.assertTrue(self.profiler.request_profile())
+        self.assertFalse(self.profiler.request_profile())
+        self.assertEqual(self.profiler.timeout(), 0)  # started by the next tick
+
+        self.profiler.tick()
+        self.assertTrue(self.profiler.profiling)
+        sorted(range(1000))
+        self.now[0] += 4
+        self.assertEqual(self.profiler.timeout(), 1)
+        self.profiler.tick()
+        self.assertTrue(self.profiler.profiling)
+
+        self.now[0] += 1
+        self.profiler.tick()
+        self.assertFalse(self.profiler.profiling)
+        self.assertIsNone(self.profiler.timeout())
+        dumps = self.dumps()
+        self.assertEqual([os.path.splitext(name)[1] for name in dumps], ['.prof', '.txt'])
+        stats = pstats.Stats(os.path.join(self.directory.name, dumps[0]))
+        self.assertIn('sorted', ' '.join(str(func) for func in stats.stats))
+
+    def test_memory_capture(self):
+        tracing = tracemalloc.is_tracing()
+        self.assertTrue(self.profiler.request_memory_capture(seconds=1))
+        self.profiler.tick()
+        self.assertTrue(self.profiler.capturing_memory)
+        self.assertTrue(tracemalloc.is_tracing())
+        self.now[0] += 1
+        self.profiler.tick()
+        self.assertFalse(self.profiler.capturing_memory)
+        self.assertEqual(tracemalloc.is_tracing(), tracing)
+        dumps = self.dumps()
+        self.assertEqual([os.path.splitext(name)[1] for name in dumps], ['.snapshot', '.txt'])
+        tracemalloc.Snapshot.load(os.path.join(self.directory.name, dumps[0]))
+
+    def test_signal_wakes_loop_up(self):
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        install_signal_handlers(self.profiler)
+        wakeup = SignalWakeup()
+        self.addCleanup(wakeup.close)
+        selector = selectors.DefaultSelector()
+        self.addCleanup(selector.close)
+        selector.register(wakeup, selectors.EVENT_READ, wakeup.on_read)
+
+        os.kill(os.getpid(), signal.SIGUSR1)
+        events = selector.select(timeout=5)  # idle loop waits without timeout
+        self.assertEqual([key.fileobj for key, mask in events], [wakeup])
+        self.assertEqual(self.profiler.timeout(), 0)
+        for key, mask in events:
+            key.data(key.fileobj, mask)
+        self.assertEqual(selector.select(timeout=0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
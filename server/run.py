@@ -1,15 +1,27 @@
+import os
+import signal
+import traceback
 from optparse import OptionParser
 
+from sqlalchemy.engine.url import make_url
+
 from server.mess_server import MessServer
+from server.async_server import AsyncMessServer
 from server.models import session, init_db
 from server.models.chat import Chat
 from server.models.utils import create_users, create_chat
 from server.config import Config, TestConfig
-from server.config.log import configure_logging
+from server.config.log import configure_logging, LOG_MODES, LOG_MODE_DEFAULT
+from server.profiler import PROFILER, install_signal_handlers
 
 
 RUN_MODE_TEST = 'test'
 
+ENGINE_SELECTORS = 'selectors'
+ENGINE_ASYNCIO = 'asyncio'
+ENGINES = {ENGINE_SELECTORS: MessServer,
+           ENGINE_ASYNCIO: AsyncMessServer}
+
 
 def fill_db():
     users = create_users([('userA', 'passA'),
@@ -35,23 +47,94 @@ def fill_db():
         create_chat(chat_name, users[chat_owner], [users['userC'], users['userB']])
 
 
-def main(mode=None, create_config=False):
+def init_db_from_config(config):
+    init_db(db=config.db, enable_logging=False, pool_size=config.db_pool_size,
+            pool_pre_ping=config.db_pool_pre_ping, sqlite_wal=config.db_sqlite_wal)
+
+
+def run_worker(worker_id, workers, config, port):
+    """
+    Worker process entry point, never returns
+    """
+    exit_code = 0
+    try:
+        # parent process stops workers with SIGTERM, Ctrl+C goes to parent only
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        install_signal_handlers(PROFILER)
+        # log listener thread (production log mode) isn't inherited by forked process
+        configure_logging(log_path=config.log, mode=config.log_mode, sample_rate=config.log_sample_rate)
+        init_db_from_config(config)  # don't share DB connections with parent
+        MessServer(port=port, config=config, worker_id=worker_id, workers=workers).run()
+    except SystemExit as e:
+        exit_code = e.code or 0
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+
+def run_workers(workers, config, port):
+    """
+    Fork worker processes sharing the same port (SO_REUSEPORT) and wait for them
+    """
+    pids = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(worker_id, workers, config, port)
+        pids.append(pid)
+    print("Started {workers} workers: {pids}".format(workers=workers, pids=pids))
+
+    def forward(signum, frame):
+        for pid in pids:
+            os.kill(pid, signum)
+
+    # profiling requests are sent to the parent process for all the workers
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGUSR2, forward)
+
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
+def main(mode=None, create_config=False, engine=ENGINE_SELECTORS, port=9090, workers=1,
+         log_mode=LOG_MODE_DEFAULT, log_sample_rate=0):
     if mode == RUN_MODE_TEST:
         config = TestConfig()
     else:
         config = Config()
+    config.log_mode = log_mode
+    config.log_sample_rate = log_sample_rate
 
     print("LOG_PATH={log_path}".format(log_path=config.log))
-    print("DB_PATH={db_path}".format(db_path=config.db))
+    print("DB_PATH={db_path}".format(db_path=repr(make_url(config.db))))  # without password
 
-    configure_logging(log_path=config.log)
-    init_db(db=config.db, enable_logging=False)
+    configure_logging(log_path=config.log, mode=config.log_mode, sample_rate=config.log_sample_rate)
+    init_db_from_config(config)
 
     if mode != RUN_MODE_TEST and create_config:
         print("Creating configuration...")
         fill_db()
 
-    MessServer().run()
+    if workers > 1:
+        run_workers(workers, config, port)
+    else:
+        install_signal_handlers(PROFILER)
+        ENGINES[engine](port=port, config=config).run()
 
 
 if __name__ == '__main__':
@@ -66,6 +149,40 @@ if __name__ == '__main__':
                       dest="config",
                       default=False,
                       help="create basic configuration")
+    parser.add_option("-e",
+                      "--engine",
+                      dest="engine",
+                      type="choice",
+                      choices=list(ENGINES),
+                      default=ENGINE_SELECTORS,
+                      help="server engine: {engines}".format(engines=', '.join(ENGINES)))
+    parser.add_option("-p",
+                      "--port",
+                      dest="port",
+                      type="int",
+                      default=9090,
+                      help="port to listen on")
+    parser.add_option("-w",
+                      "--workers",
+                      dest="workers",
+                      type="int",
+                      default=1,
+                      help="number of worker processes sharing the port")
+    parser.add_option("-l",
+                      "--log-mode",
+                      dest="log_mode",
+                      type="choice",
+                      choices=LOG_MODES,
+                      default=LOG_MODE_DEFAULT,
+                      help="logging mode: {modes}".format(modes=', '.join(LOG_MODES)))
+    parser.add_option("--log-sample",
+                      dest="log_sample_rate",
+                      type="int",
+                      default=0,
+                      help="production logging mode: log every N-th per-message trace, 0 - none")
     (options, args) = parser.parse_args()
+    if options.workers > 1 and options.engine != ENGINE_SELECTORS:
+        parser.error("--workers is supported by {engine} engine only".format(engine=ENGINE_SELECTORS))
 
-    main(mode=options.mode, create_config=options.config)
+    main(mode=options.mode, create_config=options.config, engine=options.engine, port=options.port,
+         workers=options.workers, log_mode=options.log_mode, log_sample_rate=options.log_sample_rate)
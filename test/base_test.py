@@ -24,10 +24,12 @@ class TestFunctional(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         print("Deleting sqlite db file...")
-        try:
-            os.remove(cls.server.config.db_path)
-        except OSError:
-            pass
+        # with write-ahead log and its index
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                os.remove(cls.server.config.db_path + suffix)
+            except OSError:
+                pass
 
     def setUp(self):
         self.user1 = TestUser(self.name_pass1[0], self.name_pass1[1])
@@ -1,8 +1,9 @@
+import json
 import unittest
 import time
 
 from server.base_client import USER_STATUS_DEFAULT, CLIENT_OFFLINE
-from protocol.messages import NormalMessage, CMD_CHANGE_STATUS
+from protocol.messages import NormalMessage, ServiceMessage, CMD_CHANGE_STATUS, CMD_INFO, CMD_SERVICE
 
 from test.base_test import TestFunctional
 
@@ -27,6 +28,7 @@ class TestFunctionalBasic(TestFunctional):
         self.user2.connect()
 
         self.user1.login()
+        time.sleep(0.1)  # let server handle logins in order
 
         self.user2.login()
         msg1 = self.user1.recv_msg(timeout=1)
@@ -60,6 +62,29 @@ class TestFunctionalBasic(TestFunctional):
         self.user2.disconnect()
         self.user3.disconnect()
 
+    def test_service_info(self):
+        print("== Runtime metrics")
+        self.user1.connect()
+        self.user2.connect()
+        self.user2.client.send(ServiceMessage(cmd=CMD_SERVICE))  # not logged in, no reply
+        self.user1.login()
+        time.sleep(0.1)
+
+        # user1 is an admin user of the test config
+        self.user1.client.send(ServiceMessage(cmd=CMD_SERVICE))
+        msg = self.user1.recv_msg()
+        self.assertEqual((msg.cmd, msg.params), (CMD_INFO, [CMD_SERVICE]))
+        metrics = json.loads(msg.payload)
+        self.assertEqual(metrics['connected_clients'], 2)
+        self.assertEqual(metrics['online_users'], 1)
+        self.assertGreaterEqual(metrics['messages_in']['total'], 3)
+        self.assertIn('p99_ms', metrics['loop_lag'])
+        self.assertEqual(metrics['handlers'][CMD_SERVICE]['count'], 1)  # the rejected one, every frame is timed
+
+        self.user1.logout()
+        self.user1.disconnect()
+        self.user2.disconnect()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -21,10 +21,12 @@ class TestFunctional(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         print("Deleting sqlite db file...")
-        try:
-            os.remove(cls.server.config.db_path)
-        except OSError:
-            pass
+        # with write-ahead log and its index
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                os.remove(cls.server.config.db_path + suffix)
+            except OSError:
+                pass
 
     @classmethod
     def setUpClass(cls):
@@ -4,7 +4,9 @@ import protocol.messages
 
 class TestClient:
 
-    def __init__(self):
+    def __init__(self, protocol_version=protocol.messages.PROTOCOL_V1):
+        self.protocol_version = protocol_version
+        self.compress = None  # compressor of payloads, set once compression is enabled at login
         self.__connected = False
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -18,7 +20,7 @@ class TestClient:
 
     def send(self, msg):
         if isinstance(msg, protocol.messages.Message):
-            msg = msg.as_bytes()
+            msg = b''.join(msg.as_chunks(self.protocol_version, self.compress))
         elif isinstance(msg, str):
             msg = msg.encode('utf-8')
         elif not isinstance(msg, bytes):
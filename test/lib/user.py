@@ -1,8 +1,10 @@
+import collections
 from functools import wraps
 
-from protocol.messages import CMD_LOGIN, CMD_LOGOUT, CMD_MESSAGE
-from protocol.messages import Message, NormalMessage, PayloadMessage
-from protocol.data_utils import DataParser
+from protocol.messages import CMD_LOGIN, CMD_LOGOUT, CMD_MESSAGE, CMD_MSG_ACK, CMD_VERSION, PROTOCOL_V1
+from protocol.messages import NormalMessage, PayloadMessage
+from protocol.data_utils import DataBuffer, DataParser
+from protocol.compression import LOGIN_COMPRESSION, StreamCompressor, decompress_payload
 from test.lib.client import TestClient
 
 
@@ -25,11 +27,16 @@ def connected(func):
 
 class TestUser:
 
-    def __init__(self, name, password, server_host='127.0.0.1', server_port=9090):
+    def __init__(self, name, password, server_host='127.0.0.1', server_port=9090, protocol_version=PROTOCOL_V1,
+                 compression=False):
         self.name = name
         self.password = password
+        self.compression = compression  # payload compression is requested at login (protocol v2)
         self.client = None
-        self.parser = DataParser()
+        self.protocol_version = protocol_version
+        self.data_buffer = DataBuffer(protocol_version)
+        self.parser = DataParser(protocol_version)
+        self.frames = collections.deque()  # received but not yet read frames
         self.server_host = server_host
         self.server_port = server_port
         self.__loggedin = False
@@ -43,23 +50,45 @@ class TestUser:
         return self.__loggedin
 
     def connect(self):
-        self.client = TestClient()
-        return self.client.connect(self.server_host, self.server_port)
+        self.client = TestClient(self.protocol_version)
+        self.data_buffer.flush()
+        self.frames.clear()
+        self.parser.decompress = None
+        res = self.client.connect(self.server_host, self.server_port)
+        if self.protocol_version != PROTOCOL_V1:
+            self.client.send(NormalMessage(cmd=CMD_VERSION, params=[str(self.protocol_version)]))
+            reply = self.recv_msg()
+            assert reply == NormalMessage(cmd=CMD_VERSION, params=[str(self.protocol_version)]), reply
+        return res
 
     @connected
     def login(self):
-        self.client.send(NormalMessage(cmd=CMD_LOGIN, params=[self.name, self.password]))
+        if self.compression:
+            self.client.send(NormalMessage(cmd=CMD_LOGIN, params=[self.name, self.password, LOGIN_COMPRESSION]))
+            if self.client.compress is None:
+                self.client.compress = StreamCompressor()
+                self.parser.decompress = decompress_payload
+        else:
+            self.client.send(NormalMessage(cmd=CMD_LOGIN, params=[self.name, self.password]))
         self.__loggedin = True
 
     @connected
     def recv_msg(self, timeout=5):
-        data = self.client.recv(timeout=timeout)
-        print("{user} received [{data}]".format(user=self.name, data=data))
-        data = data.split(Message.TERM_SEQUENCE)[0]
-        msg = self.parser.parse(data)
+        while not self.frames:
+            data = self.client.recv(timeout=timeout)
+            print("{user} received [{data}]".format(user=self.name, data=data))
+            if not data:
+                raise ConnectionError("{user}: connection closed by server".format(user=self.name))
+            self.frames.extend(bytes(frame) for frame in self.data_buffer.push(data))
+        msg = self.parser.parse(self.frames.popleft())
 
         return msg
 
+    @connected
+    def ack(self, msg_id, chat_id=None):
+        params = [msg_id] if chat_id is None else [chat_id, msg_id]
+        self.client.send(NormalMessage(cmd=CMD_MSG_ACK, params=params))
+
     @connected
     def send_message(self, msg):
         self.client.send(msg)
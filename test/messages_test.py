@@ -1,9 +1,10 @@
+import time
 import unittest
 
 from test.base_test import TestFunctional
 from server.base_client import USER_STATUS_DEFAULT, CLIENT_OFFLINE
 
-from protocol.messages import NormalMessage, PayloadMessage, CMD_CHANGE_STATUS, CMD_MESSAGE
+from protocol.messages import NormalMessage, PayloadMessage, CMD_CHANGE_STATUS, CMD_MESSAGE, PROTOCOL_V1
 
 
 class TestFunctionalOfflineMessages(TestFunctional):
@@ -18,6 +19,7 @@ class TestFunctionalOfflineMessages(TestFunctional):
         self.user2.connect()
 
         self.user1.login()
+        time.sleep(0.1)  # let server handle logins in order
 
         self.user2.login()
         msg1 = self.user1.recv_msg(timeout=1)
@@ -53,6 +55,7 @@ class TestFunctionalOfflineMessages(TestFunctional):
         self.user2.connect()
 
         self.user1.login()
+        time.sleep(0.1)  # let server handle logins in order
 
         self.user1.send(msg=self.SIMPLE_MESSAGE_STR, to=self.user2.name)
         self.user1.send(msg=self.ANOTHER_ONE_MESSAGE_STR, to=self.user2.name)
@@ -106,6 +109,32 @@ class TestFunctionalOfflineMessages(TestFunctional):
         self.user1.disconnect()
         self.user2.disconnect()
 
+    def test_burst_of_messages(self):
+        print("== Burst of personal messages sent by one write")
+        self.user1.connect()
+        self.user2.connect()
+        self.user1.login()
+        time.sleep(0.1)  # let server handle logins in order
+        self.user2.login()
+        msg1 = self.user1.recv_msg(timeout=1)
+        self.assertEqual(
+            NormalMessage(cmd=CMD_CHANGE_STATUS, params=[self.user2.name, USER_STATUS_DEFAULT]),
+            msg1)
+
+        burst = ['burst %d' % n for n in range(50)]
+        self.user1.send_message(b''.join(
+            PayloadMessage(cmd=CMD_MESSAGE, params=[self.user2.name, ], payload=payload).as_bytes(PROTOCOL_V1)
+            for payload in burst))
+        for payload in burst:
+            self.assertEqual(
+                PayloadMessage(cmd=CMD_MESSAGE, params=[self.user1.name, ], payload=payload),
+                self.user2.recv_msg(timeout=1))
+
+        self.user1.logout()
+        self.user2.logout()
+        self.user1.disconnect()
+        self.user2.disconnect()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,180 @@
+import unittest
+import time
+
+from test.base_test import TestFunctional
+from test.lib.user import TestUser
+from server.base_client import USER_STATUS_DEFAULT
+
+from protocol.messages import NormalMessage, PayloadMessage, CMD_CHANGE_STATUS, CMD_MESSAGE, PROTOCOL_V2
+
+
+class TestFunctionalProtocolV2(TestFunctional):
+
+    PAYLOAD_WITH_SEPARATORS = "one..two||three.."
+    SIMPLE_MESSAGE_STR = "ping"
+    LONG_TEXT = " ".join("message {n}: see you at the station at {n} o'clock, don't be late".format(n=n)
+                         for n in range(20))
+
+    def setUp(self):
+        super().setUp()
+        self.user1 = TestUser(self.name_pass1[0], self.name_pass1[1], protocol_version=PROTOCOL_V2)
+        self.user2 = TestUser(self.name_pass2[0], self.name_pass2[1], protocol_version=PROTOCOL_V2)
+        self.users = [self.user1, self.user2, self.user3]
+
+    def test_v2_payload_with_separators(self):
+        print("== Protocol v2: payload containing separators")
+        self.user1.connect()
+        self.user2.connect()
+
+        self.user1.login()
+        time.sleep(0.1)  # let server handle logins in order
+        self.user2.login()
+        msg1 = self.user1.recv_msg(timeout=1)
+        self.assertEqual(
+            NormalMessage(cmd=CMD_CHANGE_STATUS, params=[self.user2.name, USER_STATUS_DEFAULT]),
+            msg1)
+
+        self.user1.send(msg=self.PAYLOAD_WITH_SEPARATORS, to=self.user2.name)
+        msg2 = self.user2.recv_msg(timeout=1)
+        msg_id = msg2.params.pop()  # v2 messages carry id
+        self.assertTrue(msg_id.isdigit())
+        self.user2.ack(msg_id)
+        self.assertEqual(
+            PayloadMessage(cmd=CMD_MESSAGE, params=[self.user1.name, ], payload=self.PAYLOAD_WITH_SEPARATORS),
+            msg2)
+
+        self.user1.logout()
+        self.user2.logout()
+        self.user1.disconnect()
+        self.user2.disconnect()
+
+    def test_v1_and_v2_clients(self):
+        print("== Protocol v1 client talks to v2 client")
+        self.user1.connect()
+        self.user3.connect()
+
+        self.user3.login()
+        time.sleep(0.1)  # let server handle logins in order
+        self.user1.login()
+        msg1 = self.user3.recv_msg(timeout=1)
+        self.assertEqual(
+            NormalMessage(cmd=CMD_CHANGE_STATUS, params=[self.user1.name, USER_STATUS_DEFAULT]),
+            msg1)
+
+        self.user1.send(msg=self.SIMPLE_MESSAGE_STR, to=self.user3.name)
+        msg2 = self.user3.recv_msg(timeout=1)
+        self.assertEqual(
+            PayloadMessage(cmd=CMD_MESSAGE, params=[self.user1.name, ], payload=self.SIMPLE_MESSAGE_STR),
+            msg2)
+
+        self.user3.send(msg=self.SIMPLE_MESSAGE_STR, to=self.user1.name)
+        msg3 = self.user1.recv_msg(timeout=1)
+        self.user1.ack(msg3.params.pop())
+        self.assertEqual(
+            PayloadMessage(cmd=CMD_MESSAGE, params=[self.user3.name, ], payload=self.SIMPLE_MESSAGE_STR),
+            msg3)
+
+        self.user1.logout()
+        self.user3.logout()
+        self.user1.disconnect()
+        self.user3.disconnect()
+
+    def test_unsafe_payload_to_v1_client(self):
+        print("== Payload with TERM_SEQUENCE isn't sent to v1 client")
+        self.user1.connect()
+        self.user3.connect()
+
+        self.user3.login()
+        time.sleep(0.1)  # let server handle logins in order
+        self.user1.login()
+        self.user3.recv_msg(timeout=1)  # CHG of user1
+
+        # would be 'MSG user1 17||one..' and 'two||three..' frames for user3, skipped
+        self.user1.send(msg=self.PAYLOAD_WITH_SEPARATORS, to=self.user3.name)
+        self.user1.send(msg=self.SIMPLE_MESSAGE_STR, to=self.user3.name)
+        msg = self.user3.recv_msg(timeout=1)
+        self.assertEqual(
+            PayloadMessage(cmd=CMD_MESSAGE, params=[self.user1.name, ], payload=self.SIMPLE_MESSAGE_STR),
+            msg)
+        self.assertFalse(self.user3.frames)
+
+        self.user1.logout()
+        self.user3.logout()
+        self.user1.disconnect()
+        self.user3.disconnect()
+
+    def test_unacknowledged_messages_are_sent_again(self):
+        print("== Protocol v2: messages are replayed until acknowledged")
+        self.user1.connect()
+        self.user1.login()
+        time.sleep(0.1)
+        self.user1.send(msg=self.SIMPLE_MESSAGE_STR, to=self.user2.name)
+        self.user1.send(msg=self.PAYLOAD_WITH_SEPARATORS, to=self.user2.name)
+        time.sleep(0.1)
+
+        for ack in [False, True]:
+            self.user2.connect()
+            self.user2.login()
+            msg1 = self.user2.recv_msg(timeout=1)
+            msg2 = self.user2.recv_msg(timeout=1)
+            self.assertEqual([msg1.payload, msg2.payload], [self.SIMPLE_MESSAGE_STR, self.PAYLOAD_WITH_SEPARATORS])
+            if ack:
+                self.user2.ack(msg2.params[-1])
+            self.user2.logout()
+            self.user2.disconnect()
+            time.sleep(0.1)
+            self.user1.recv_msg(timeout=1)  # user2 is online
+            self.user1.recv_msg(timeout=1)  # user2 is offline
+
+        self.user2.connect()
+        self.user2.login()
+        self.user1.recv_msg(timeout=1)
+        self.assertRaises(TimeoutError, self.user2.recv_msg, timeout=0.5)
+
+        self.user1.logout()
+        self.user2.logout()
+        self.user1.disconnect()
+        self.user2.disconnect()
+
+    def test_compressed_payloads(self):
+        print("== Protocol v2: payload compression enabled at login")
+        self.user1 = TestUser(self.name_pass1[0], self.name_pass1[1], protocol_version=PROTOCOL_V2, compression=True)
+        self.user2 = TestUser(self.name_pass2[0], self.name_pass2[1], protocol_version=PROTOCOL_V2, compression=True)
+        self.users = [self.user1, self.user2, self.user3]
+        self.user1.connect()
+        self.user2.connect()
+        self.user3.connect()
+
+        self.user1.login()
+        time.sleep(0.1)  # let server handle logins in order
+        self.user2.login()
+        self.user3.login()
+        # status changes of both users, in one CHG frame if they are handled within one loop iteration
+        changes = []
+        while len(changes) < 4:
+            changes += self.user1.recv_msg(timeout=1).params
+
+        # the same text twice: the second one refers to the first one in the stream of user1
+        payloads = [self.LONG_TEXT, self.LONG_TEXT, self.SIMPLE_MESSAGE_STR]
+        for payload in payloads:
+            self.user1.send(msg=payload, to=self.user2.name)
+        for payload in payloads:
+            msg = self.user2.recv_msg(timeout=1)
+            self.user2.ack(msg.params.pop())
+            self.assertEqual(PayloadMessage(cmd=CMD_MESSAGE, params=[self.user1.name, ], payload=payload), msg)
+
+        # protocol v1 client gets it as it is
+        self.user1.send(msg=self.LONG_TEXT, to=self.user3.name)
+        self.assertEqual(PayloadMessage(cmd=CMD_MESSAGE, params=[self.user1.name, ], payload=self.LONG_TEXT),
+                         self.user3.recv_msg(timeout=1))
+
+        self.user1.logout()
+        self.user2.logout()
+        self.user3.logout()
+        self.user1.disconnect()
+        self.user2.disconnect()
+        self.user3.disconnect()
+
+
+if __name__ == '__main__':
+    unittest.main()